@@ -0,0 +1,393 @@
+"""Benchmarks for biostructmap, using synthetic structures and alignments.
+
+Each stage of a typical analysis (importing biostructmap, reading files,
+finding nearby residues, aligning reference sequences, building
+sub-alignments, population statistics and writing output), along with each
+built-in mapping method, is timed at several scales. Peak memory allocated
+during each stage is measured in a separate run, using tracemalloc.
+
+Results are written as JSON, and can be compared against a stored baseline:
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --scales small --baseline results.json
+
+When comparing, stages that are slower than the baseline by more than the
+given threshold, that fail, or that are in the baseline but weren't run, are
+reported as regressions, and the exit status is non-zero.
+Baselines should be recorded on the same machine as the comparison run.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+from Bio.Data.IUPACData import protein_letters_1to3
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import biostructmap
+from biostructmap import pdbtools, population_stats
+from biostructmap.biostructmap import Structure, SequenceAlignment
+from biostructmap.biostructmap import mapping_methods
+from biostructmap.seqtools import _construct_sub_align_from_chains
+import synthetic
+
+# Sizes for each scale: residues per chain, chains, isolates in each
+# alignment, and radius used for 3D windows.
+SCALES = {
+    'small': {'residues': 100, 'chains': 1, 'isolates': 20, 'radius': 10},
+    'medium': {'residues': 300, 'chains': 2, 'isolates': 50, 'radius': 12},
+    'large': {'residues': 1000, 'chains': 2, 'isolates': 100, 'radius': 15},
+    }
+# Scales run by default. Mapping methods using alignments are slow for the
+# large scale.
+DEFAULT_SCALES = ('small', 'medium')
+
+# Fraction of polymorphic sites and uncertain bases in synthetic alignments.
+SNP_RATE = 0.02
+N_RATE = 0.0
+
+# Stages slower than the baseline by more than this factor are reported as
+# regressions.
+REGRESSION_THRESHOLD = 1.25
+
+
+class Inputs(object):
+    '''Synthetic inputs for a single scale.'''
+    def __init__(self, residues, chains, isolates, radius, n_rate=N_RATE):
+        self.radius = radius
+        self.pdb, self.sequences = synthetic.structure_pdb(residues, chains)
+        self.chains = tuple(sorted(self.sequences))
+        # All chains share the sequence of the first chain, as for a
+        # homo-oligomer, so that a single alignment covers all chains.
+        cds = synthetic.coding_sequence(self.sequences['A'])
+        self.dna_ref = {chain: cds for chain in self.chains}
+        self.seqs = synthetic.alignment_sequences(cds, isolates, SNP_RATE,
+                                                  n_rate)
+        self.fasta = synthetic.alignment_fasta(self.seqs)
+
+    def structure(self):
+        '''Read a new Structure object.'''
+        return Structure(io.StringIO(self.pdb))
+
+    def alignment(self):
+        '''Read a new SequenceAlignment object.'''
+        return SequenceAlignment(io.StringIO(self.fasta))
+
+    def homo_structure(self):
+        '''Read a structure in which all chains have the same sequence.'''
+        pdb = self.pdb
+        for chain in self.chains[1:]:
+            pdb = _replace_chain_sequence(pdb, chain, self.sequences['A'])
+        return Structure(io.StringIO(pdb))
+
+
+def _replace_chain_sequence(pdb, chain, sequence):
+    '''Set residue names of a chain in a synthetic PDB file.'''
+    lines = []
+    for line in pdb.splitlines(True):
+        if line.startswith('ATOM') and line[21] == chain:
+            resname = protein_letters_1to3[sequence[int(line[22:26]) - 1]]
+            line = line[:17] + resname.upper() + line[20:]
+        lines.append(line)
+    return ''.join(lines)
+
+
+def _method_arguments(inputs, structure, alignment):
+    '''Get `data`, `ref` and other arguments to `Structure.map` for each
+    built-in mapping method.'''
+    protein_ref = {chain: structure.sequences[chain] for chain in
+                   inputs.chains}
+    n_residues = len(inputs.sequences['A'])
+    alignment_args = {'data': {inputs.chains: alignment},
+                      'ref': inputs.dna_ref, 'map_to_dna': True}
+    return {
+        'default': {'data': {inputs.chains: list(range(n_residues + 1))},
+                    'ref': protein_ref},
+        'snps': {'data': {inputs.chains: list(range(1, n_residues, 7))},
+                 'ref': protein_ref},
+        'aa_scale': {'data': 'kd', 'ref': protein_ref},
+        'count_residues': {'data': None, 'ref': protein_ref},
+        'tajimasd': alignment_args,
+        'wattersons_theta': alignment_args,
+        'nucleotide_diversity': alignment_args,
+        'shannon_entropy': alignment_args,
+        'normalized_shannon_entropy': alignment_args,
+        }
+
+
+def stages(inputs):
+    '''Get benchmark stages for a set of inputs.
+
+    Yields:
+        tuple: Stage name, and a setup function returning a function to be
+            timed. Setup is not included in timings, and is repeated for each
+            run so that cached results are not reused.
+    '''
+    radius = inputs.radius
+
+    def warm_structure():
+        '''Read a structure, with nearby residues and reference numbering
+        already calculated.'''
+        structure = inputs.homo_structure()
+        structure.nearby(radius=radius)
+        structure._map_pdb_numbering_to_reference(inputs.dna_ref, True)
+        return structure
+
+    def import_biostructmap():
+        '''Import biostructmap in a new interpreter. Timings include
+        interpreter startup.'''
+        command = [sys.executable, '-c', 'import biostructmap']
+        return lambda: subprocess.check_call(command, cwd=REPO_DIR)
+
+    def read_structure():
+        return inputs.structure
+
+    def build_bio_structure():
+        structure = inputs.structure()
+        return lambda: structure.structure
+
+    def nearby_arrays():
+        structure = inputs.structure()
+        return lambda: structure.nearby_arrays(radius)
+
+    def pdbtools_nearby():
+        atoms = inputs.structure().atoms()
+        return lambda: pdbtools.nearby(atoms, radius)
+
+    def residue_table():
+        structure = inputs.structure()
+        return structure.residue_table
+
+    def rsa_shrake_rupley():
+        structure = inputs.structure()
+        return lambda: structure.residue_table_column('rsa', 'shrake-rupley')
+
+    def read_alignment():
+        return inputs.alignment
+
+    def reference_numbering_dna():
+        structure = inputs.homo_structure()
+        return lambda: structure._map_pdb_numbering_to_reference(
+            inputs.dna_ref, True)
+
+    def count_differences():
+        return lambda: population_stats.count_differences(inputs.seqs)
+
+    def sub_alignments():
+        structure = warm_structure()
+        alignments = {inputs.chains: inputs.alignment()}
+        ref = structure._map_pdb_numbering_to_reference(inputs.dna_ref, True)
+        windows = list(structure.nearby(radius=radius).values())[:50]
+        codon_sets = [{(inputs.chains, ref[res][1]) for res in window if res
+                       in ref} for window in windows]
+        return lambda: [_construct_sub_align_from_chains(alignments, codons,
+                                                         fasta=True)
+                        for codons in codon_sets]
+
+    def write_pdb_b_factor():
+        structure = warm_structure()
+        data_map = structure.map(None, method='count_residues', radius=radius,
+                                 ref=inputs.dna_ref, map_to_dna=True)
+        return lambda: data_map.write_data_to_pdb_b_factor(
+            fileobj=io.StringIO())
+
+    for setup in (import_biostructmap, read_structure, build_bio_structure,
+                  nearby_arrays, pdbtools_nearby, residue_table,
+                  rsa_shrake_rupley, read_alignment, reference_numbering_dna,
+                  count_differences):
+        yield setup.__name__, setup
+    yield 'sub_alignments_50_windows', sub_alignments
+    yield 'write_pdb_b_factor', write_pdb_b_factor
+
+    for method in sorted(mapping_methods):
+        def map_method(method=method):
+            structure = warm_structure()
+            args = dict(_method_arguments(inputs, structure,
+                                          inputs.alignment())[method])
+            data = args.pop('data')
+            return lambda: structure.map(data, method=method, radius=radius,
+                                         **args)
+        yield 'map_' + method, map_method
+
+
+def run_stage(setup, repeats):
+    '''Time a benchmark stage, and measure peak memory allocated.
+
+    Args:
+        setup (function): Returns a function to be timed.
+        repeats (int): Number of timed runs.
+    Returns:
+        dict: Times for each run (seconds), minimum and median time, and
+            peak memory allocated (bytes) during a single run.
+    '''
+    # An untimed run first, so that one-off costs (eg. importing scipy) are
+    # not counted.
+    setup()()
+    times = []
+    for _ in range(repeats):
+        func = setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    func = setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'times': times, 'min': min(times),
+            'median': statistics.median(times), 'peak_memory': peak}
+
+
+def run_benchmarks(scales, repeats=3, stage_filter=None, n_rate=N_RATE,
+                   log=sys.stderr):
+    '''Run benchmarks at each scale.
+
+    Args:
+        scales (list): Scale names (see SCALES).
+        repeats (int, optional): Number of timed runs for each stage.
+        stage_filter (str, optional): Only run stages with names containing
+            this string.
+        n_rate (float, optional): Fraction of uncertain bases ('N') in
+            synthetic alignments.
+        log (file-like object, optional): Progress is written here.
+    Returns:
+        dict: Benchmark results, with `metadata` and a list of `results`.
+    '''
+    results = []
+    for scale in scales:
+        params = dict(SCALES[scale], n_rate=n_rate)
+        inputs = Inputs(**params)
+        for name, setup in stages(inputs):
+            if stage_filter is not None and stage_filter not in name:
+                continue
+            result = {'scale': scale, 'stage': name, 'params': params}
+            try:
+                result.update(run_stage(setup, repeats))
+            except Exception as error:
+                result['error'] = '{0}: {1}'.format(type(error).__name__,
+                                                    error)
+            results.append(result)
+            if log is not None:
+                print(_format_result(result), file=log)
+    metadata = {'biostructmap': biostructmap.__version__,
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'repeats': repeats, 'scales': list(scales),
+                'stage_filter': stage_filter}
+    return {'metadata': metadata, 'results': results}
+
+
+def _format_result(result, baseline=None):
+    '''Format a single result as a line of text.'''
+    label = '{0:<8s} {1:<36s}'.format(result['scale'], result['stage'])
+    if 'error' in result:
+        return '{0} ERROR {1}'.format(label, result['error'])
+    line = '{0} {1:10.4f} s {2:10.1f} MiB'.format(
+        label, result['min'], result['peak_memory'] / 2 ** 20)
+    if baseline is not None and 'min' in baseline:
+        line += '  {0:6.2f}x baseline'.format(result['min'] / baseline['min'])
+    return line
+
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD,
+            log=sys.stderr):
+    '''Compare benchmark results against a baseline.
+
+    Stages are regressions if they are slower than the baseline by more than
+    `threshold`, if they failed, or if they are in the baseline (at a scale
+    and matching a stage filter used for the current results) but are missing
+    from the current results.
+
+    Args:
+        current (dict): Results from `run_benchmarks`.
+        baseline (dict): Baseline results, in the same format.
+        threshold (float, optional): Stages slower than the baseline by more
+            than this factor (using minimum times) are regressions.
+        log (file-like object, optional): Comparison is written here.
+    Returns:
+        list: (scale, stage, description) for each regression.
+    '''
+    baseline_results = {(x['scale'], x['stage']): x for x in
+                        baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = baseline_results.pop((result['scale'], result['stage']), None)
+        if log is not None:
+            print(_format_result(result, base), file=log)
+        if 'error' in result:
+            regressions.append((result['scale'], result['stage'],
+                                'failed ({0})'.format(result['error'])))
+        elif base is not None and 'min' in base:
+            ratio = result['min'] / base['min']
+            if ratio > threshold:
+                regressions.append((result['scale'], result['stage'],
+                                    '{0:.2f}x slower than baseline'.format(
+                                        ratio)))
+    metadata = current['metadata']
+    stage_filter = metadata.get('stage_filter')
+    for (scale, stage), base in sorted(baseline_results.items()):
+        if (scale in metadata.get('scales', ()) and 'min' in base and
+                (stage_filter is None or stage_filter in stage)):
+            regressions.append((scale, stage, 'missing from results'))
+    if log is not None:
+        for scale, stage, description in regressions:
+            print('REGRESSION {0} {1}: {2}'.format(scale, stage, description),
+                  file=log)
+    return regressions
+
+
+def main(argv=None):
+    '''Command line entry point.'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES),
+                        default=list(DEFAULT_SCALES))
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="Number of timed runs for each stage.")
+    parser.add_argument('--stage', default=None,
+                        help="Only run stages with names containing this "
+                             "string.")
+    parser.add_argument('--n-rate', type=float, default=N_RATE,
+                        help="Fraction of uncertain bases (N) in synthetic "
+                             "alignments.")
+    parser.add_argument('--output', default=None,
+                        help="Write results to this JSON file.")
+    parser.add_argument('--baseline', default=None,
+                        help="Compare results against this JSON file.")
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help="Slowdown factor reported as a regression.")
+    args = parser.parse_args(argv)
+    # Warnings (eg. from Biopython) are not relevant to timings.
+    warnings.simplefilter('ignore')
+    current = run_benchmarks(args.scales, args.repeats, args.stage,
+                             args.n_rate,
+                             log=None if args.baseline else sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
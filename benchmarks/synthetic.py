@@ -0,0 +1,161 @@
+"""Synthetic structures and sequence alignments for benchmarking.
+
+Structures are built by threading each chain along a compact serpentine path,
+with 3.8 Angstrom between consecutive CA atoms and a residue density close to
+that of a folded protein. Backbone atoms are placed so that consecutive
+residues form peptide bonds, so that sequences can be read from the atoms.
+Chains are packed next to each other, giving interfaces between chains.
+
+Alignments are generated from a coding sequence for each chain, which
+translates to the chain sequence. This allows reference sequences to be
+matched to structures without requiring BLAST+ or Exonerate.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from Bio.Data.CodonTable import standard_dna_table
+from Bio.Data.IUPACData import protein_letters_1to3
+
+# Distance (Angstrom) between consecutive CA atoms.
+CA_SPACING = 3.8
+
+# Atom names and distances (Angstrom) from the CA atom along the side chain,
+# giving a typical number of atoms per residue.
+SIDE_CHAIN_ATOMS = (('CB', 1.5), ('CG', 3.0), ('CD', 4.5))
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+_CODONS = {}
+for _codon, _aa in sorted(standard_dna_table.forward_table.items()):
+    _CODONS.setdefault(_aa, []).append(_codon)
+
+
+def _serpentine_path(n_points):
+    '''Get lattice points (in units of CA_SPACING) along a path filling a
+    cube. Rows run along x, and layers are separated by two lattice units, so
+    that residue density is similar to that of a folded protein.'''
+    side = int(np.ceil((2 * n_points) ** (1 / 3))) + 1
+    points = []
+    y_range = list(range(side))
+    x_range = list(range(side))
+    z = 0
+    while len(points) < n_points:
+        for y in y_range:
+            points.extend((x, y, z) for x in x_range)
+            x_range.reverse()
+        y_range.reverse()
+        # Step to the next layer, via an intermediate point.
+        points.append((points[-1][0], points[-1][1], z + 1))
+        z += 2
+    return np.array(points[:n_points], dtype=float), side
+
+
+def structure_pdb(n_residues, n_chains=1, seed=0):
+    '''Generate a synthetic PDB file.
+
+    Args:
+        n_residues (int): Number of residues in each chain.
+        n_chains (int, optional): Number of chains.
+        seed (int, optional): Random seed.
+    Returns:
+        str: Contents of a PDB file.
+        dict: Protein sequence for each chain, accessed by chain id.
+    '''
+    rng = np.random.RandomState(seed)
+    lines = []
+    sequences = {}
+    serial = 1
+    path, side = _serpentine_path(n_residues)
+    for chain_index in range(n_chains):
+        chain_id = chr(ord('A') + chain_index)
+        sequence = ''.join(rng.choice(list(AMINO_ACIDS), n_residues))
+        sequences[chain_id] = sequence
+        # Chains are packed side by side along x.
+        offset = np.array([chain_index * (side * CA_SPACING + 4.0), 0, 0])
+        ca_coords = path * CA_SPACING + offset
+        steps = np.diff(ca_coords, axis=0)
+        forward = np.vstack((steps, steps[-1:])) / CA_SPACING
+        backward = np.vstack((steps[:1], steps)) / CA_SPACING
+        # Side chains point away from the backbone in a random direction
+        # perpendicular to the chain.
+        side_chain = np.cross(forward, rng.normal(size=(n_residues, 3)))
+        side_chain /= np.linalg.norm(side_chain, axis=1)[:, np.newaxis]
+        for i, aa in enumerate(sequence):
+            ca = ca_coords[i]
+            atoms = [('N', ca - 1.2 * backward[i]), ('CA', ca),
+                     ('C', ca + 1.2 * forward[i]),
+                     ('O', ca + 1.2 * forward[i] - 1.2 * side_chain[i])]
+            atoms.extend((name, ca + distance * side_chain[i]) for
+                         name, distance in SIDE_CHAIN_ATOMS)
+            resname = protein_letters_1to3[aa].upper()
+            for name, coord in atoms:
+                lines.append(
+                    'ATOM  {0:5d}  {1:<3s} {2:3s} {3:1s}{4:4d}    '
+                    '{5:8.3f}{6:8.3f}{7:8.3f}  1.00 20.00           '
+                    '{8:1s}  \n'.format(serial, name, resname, chain_id, i + 1,
+                                        coord[0], coord[1], coord[2],
+                                        name[0]))
+                serial += 1
+        lines.append('TER   \n')
+    lines.append('END   \n')
+    return ''.join(lines), sequences
+
+
+def coding_sequence(protein_sequence, seed=0):
+    '''Generate a DNA coding sequence for a protein sequence.
+
+    Args:
+        protein_sequence (str): Protein sequence.
+        seed (int, optional): Random seed.
+    Returns:
+        str: DNA sequence, which translates to `protein_sequence`.
+    '''
+    rng = np.random.RandomState(seed)
+    return ''.join(_CODONS[aa][rng.randint(len(_CODONS[aa]))] for aa in
+                   protein_sequence)
+
+
+def alignment_sequences(reference, n_isolates, snp_rate=0.01, n_rate=0.0,
+                        seed=0):
+    '''Generate aligned DNA sequences for a population of isolates.
+
+    Polymorphic sites are chosen at random, and each isolate carries the
+    reference base or a single alternative base at each polymorphic site.
+
+    Args:
+        reference (str): Reference DNA sequence, used as the first sequence.
+        n_isolates (int): Total number of sequences.
+        snp_rate (float, optional): Fraction of sites that are polymorphic.
+        n_rate (float, optional): Fraction of bases (other than in the
+            reference sequence) that are uncertain ('N').
+        seed (int, optional): Random seed.
+    Returns:
+        list: DNA sequences (str).
+    '''
+    rng = np.random.RandomState(seed)
+    bases = np.array(list('ACGT'))
+    ref = np.array(list(reference))
+    seqs = np.tile(ref, (n_isolates, 1))
+    sites = np.flatnonzero(rng.random_sample(len(ref)) < snp_rate)
+    # Alternative base differs from the reference base.
+    alternative = bases[(np.searchsorted(bases, ref[sites]) +
+                         rng.randint(1, 4, len(sites))) % 4]
+    carriers = rng.random_sample((n_isolates, len(sites))) < 0.3
+    carriers[0] = False
+    seqs[:, sites] = np.where(carriers, alternative, ref[sites])
+    uncertain = rng.random_sample(seqs.shape) < n_rate
+    uncertain[0] = False
+    seqs[uncertain] = 'N'
+    return [''.join(seq) for seq in seqs]
+
+
+def alignment_fasta(sequences):
+    '''Format aligned sequences as a FASTA file.
+
+    Args:
+        sequences (list): Aligned sequences (str).
+    Returns:
+        str: Contents of a FASTA file, with isolates named `isolate_<n>`.
+    '''
+    return ''.join('>isolate_{0}\n{1}\n'.format(i, seq) for i, seq in
+                   enumerate(sequences))
@@ -5,7 +5,8 @@ incorporation of structural information into genetic tests of selection pressure
 such as Tajima's D.
 """
 
-from .biostructmap import Structure, SequenceAlignment
+from .biostructmap import Structure, SequenceAlignment, DataMap
+from .trajectory import Trajectory
 
 __version__ = '0.4.0'
-__all__ = ["biostructmap", "seqtools", "pdbtools", "gentests", "map_functions", "protein_tests", "population_stats"]
+__all__ = ["biostructmap", "seqtools", "pdbtools", "gentests", "map_functions", "protein_tests", "population_stats", "trajectory", "instrument"]
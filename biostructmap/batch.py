@@ -0,0 +1,325 @@
+"""Batch mapping of data over many structures and sequence alignments.
+
+Part of the biostructmap package. Jobs are described by a manifest file in
+JSON Lines format, with one JSON object per line for each structure and
+(optional) sequence alignment to be analysed:
+
+    {"structure": "structures/1zrl.pdb", "alignment": "msa/ama1.fasta",
+     "chains": ["A"], "methods": ["tajimasd", "nucleotide_diversity"],
+     "radii": [10, 15], "map_to_dna": true}
+
+Recognised keys are:
+    structure (str): PDB or mmCIF file. Required.
+    mmcif (bool): Set true for mmCIF files. Defaults to true if the file name
+        ends with `.cif`.
+    name (str): Name for the structure, used in output file names. Defaults
+        to the file name without extension.
+    alignment (str): Multiple sequence alignment file. If given, the
+        alignment is passed as data for all chains (eg. `{('A',): msa}`).
+    alignment_format (str): Alignment file format. Defaults to 'fasta'.
+    reference (str): FASTA file containing a reference sequence for all
+        chains. Defaults to the first sequence in the alignment, or to
+        sequences from the structure if there is no alignment.
+    chains (list): Chains to map data over. Defaults to all chains.
+    methods (list): Mapping methods (see `Structure.map`). Required.
+    radii (list): Radii for 3D windows. Defaults to [15].
+    selector (str), map_to_dna (bool), method_params (dict): As for
+        `Structure.map`.
+Relative file paths are relative to the directory containing the manifest.
+
+Each (structure, alignment, method, radius) result is written to its own
+checkpoint file (see `DataMap.write_to_npz`) in the output directory as soon
+as it is finished. Results with an existing checkpoint file are skipped, so an
+interrupted batch can be resumed by running it again. Structures are processed
+in parallel using a pool of processes.
+
+Usage:
+    biostructmap-batch manifest.jsonl --output-dir results --processes 8
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Bio import SeqIO
+from .biostructmap import Structure, SequenceAlignment
+
+# Default radius if none are given for a manifest entry.
+DEFAULT_RADII = (15,)
+
+# Number of alignments kept in memory by each process (see `_read_alignment`).
+ALIGNMENT_CACHE_SIZE = 4
+
+
+def read_manifest(manifest):
+    '''Read a batch manifest file, and expand each entry into a set of
+    mapping tasks (one per method and radius).
+
+    Args:
+        manifest (str): Path to a manifest file (JSON Lines format). See the
+            module documentation for details.
+    Returns:
+        list: A dictionary describing each task. Tasks for the same structure
+            file share the same `structure` key.
+    '''
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    tasks = []
+    with open(manifest, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as error:
+                raise ValueError("Invalid JSON on line {0} of manifest: "
+                                 "{1}".format(line_number, error))
+            for key in ('structure', 'methods'):
+                if key not in entry:
+                    raise ValueError("Manifest entry on line {0} is missing "
+                                     "'{1}'.".format(line_number, key))
+            tasks.extend(_expand_entry(entry, base_dir))
+    return tasks
+
+
+def _expand_entry(entry, base_dir):
+    '''Expand a manifest entry into one task for each method and radius.'''
+    def resolve(path):
+        if path is None:
+            return None
+        return os.path.join(base_dir, path)
+    name = entry.get('name', os.path.splitext(
+        os.path.basename(entry['structure']))[0])
+    label = name
+    if entry.get('alignment') is not None:
+        label += '_' + os.path.splitext(os.path.basename(
+            entry['alignment']))[0]
+    tasks = []
+    for method in entry['methods']:
+        for radius in entry.get('radii', DEFAULT_RADII):
+            task = {
+                'structure': entry['structure'],
+                'mmcif': entry.get('mmcif', entry['structure'].endswith('.cif')),
+                'name': name,
+                'alignment': entry.get('alignment'),
+                'alignment_format': entry.get('alignment_format', 'fasta'),
+                'reference': entry.get('reference'),
+                'chains': entry.get('chains'),
+                'method': method,
+                'radius': radius,
+                'selector': entry.get('selector', 'all'),
+                'map_to_dna': entry.get('map_to_dna', False),
+                'method_params': entry.get('method_params', {}),
+                }
+            # Checkpoint names are readable, with a hash of all task settings
+            # so that changed settings give a new checkpoint.
+            digest = hashlib.sha1(json.dumps(task, sort_keys=True).encode(
+                'utf-8')).hexdigest()[:10]
+            task['id'] = re.sub(r'[^\w.-]', '_', '{0}_{1}_{2}_{3}'.format(
+                label, method, radius, digest))
+            for key in ('structure', 'alignment', 'reference'):
+                task[key] = resolve(task[key])
+            tasks.append(task)
+    return tasks
+
+
+@functools.lru_cache(maxsize=ALIGNMENT_CACHE_SIZE)
+def _read_alignment(path, file_format):
+    '''Read a sequence alignment. Worker processes run tasks for many
+    structures, so the most recently used alignments are kept, and an
+    alignment shared by several structures is usually only read once by each
+    worker.'''
+    return SequenceAlignment(path, file_format=file_format)
+
+
+def _load_data(task, structure):
+    '''Get data and reference sequences for a task, reading alignments and
+    reference sequence files as required.'''
+    chains = task['chains']
+    if chains is None:
+        chains = sorted(structure.sequences)
+    data = None
+    ref = None
+    if task['alignment'] is not None:
+        alignment = _read_alignment(task['alignment'],
+                                    task['alignment_format'])
+        data = {tuple(chains): alignment}
+        ref = {chain: str(alignment[0].seq) for chain in chains}
+    if task['reference'] is not None:
+        reference = str(SeqIO.read(task['reference'], 'fasta').seq)
+        ref = {chain: reference for chain in chains}
+    return data, ref
+
+
+def _write_checkpoint(data_map, path):
+    '''Write a DataMap to a checkpoint file. The file is written to a
+    temporary file first, so that an interrupted write never leaves a
+    checkpoint behind.'''
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            data_map.write_to_npz(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def run_structure_tasks(tasks, output_dir):
+    '''Run all mapping tasks for a single structure file. The structure is
+    read once, and recently used alignments are kept by each process (see
+    `_read_alignment`).
+
+    Args:
+        tasks (list): Tasks (see `read_manifest`) for the same structure.
+        output_dir (str): Directory for checkpoint files.
+    Returns:
+        list: A tuple (task id, error message or None, time taken) for each
+            task.
+    '''
+    results = []
+    start = time.time()
+    first = tasks[0]
+    try:
+        structure = Structure(first['structure'], pdbname=first['name'],
+                              mmcif=first['mmcif'])
+    except Exception as error:
+        message = 'Unable to read structure: {0}: {1}'.format(
+            type(error).__name__, error)
+        return [(task['id'], message, time.time() - start) for task in tasks]
+    for task in tasks:
+        try:
+            data, ref = _load_data(task, structure)
+            data_map = structure.map(data, method=task['method'], ref=ref,
+                                     radius=task['radius'],
+                                     selector=task['selector'],
+                                     map_to_dna=task['map_to_dna'],
+                                     method_params=task['method_params'])
+            _write_checkpoint(data_map, checkpoint_path(task, output_dir))
+            message = None
+        except Exception as error:
+            message = '{0}: {1}'.format(type(error).__name__, error)
+        results.append((task['id'], message, time.time() - start))
+        start = time.time()
+    return results
+
+
+def checkpoint_path(task, output_dir):
+    '''Get the checkpoint file path for a task.
+
+    Args:
+        task (dict): A task (see `read_manifest`).
+        output_dir (str): Directory for checkpoint files.
+    Returns:
+        str: Path to the checkpoint file. The result can be loaded using
+            `DataMap.from_npz`.
+    '''
+    return os.path.join(output_dir, task['id'] + '.npz')
+
+
+def run_batch(manifest, output_dir, processes=None, log=sys.stderr):
+    '''Run all tasks in a batch manifest, skipping tasks that already have a
+    checkpoint file.
+
+    Args:
+        manifest (str): Path to a manifest file. See the module documentation
+            for details.
+        output_dir (str): Directory for checkpoint files. Created if it does
+            not exist.
+        processes (int, optional): Number of worker processes. Defaults to
+            the number of CPUs. If 1, tasks are run in this process.
+        log (file-like object, optional): Progress and throughput are written
+            here. Set to None to disable.
+    Returns:
+        dict: Numbers of tasks `completed`, `skipped` (already checkpointed)
+            and `failed`, along with `errors` (a dictionary of error messages
+            for failed tasks, accessed by task id) and total `seconds`.
+    '''
+    start = time.time()
+    tasks = read_manifest(manifest)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    pending = [task for task in tasks if not
+               os.path.exists(checkpoint_path(task, output_dir))]
+    groups = {}
+    for task in pending:
+        groups.setdefault((task['structure'], task['mmcif']), []).append(task)
+    # Structures sharing an alignment are run together, so that the alignment
+    # is usually still cached (see `_read_alignment`).
+    ordered_groups = sorted(groups.values(), key=lambda group: sorted(
+        (task['alignment'] or '', task['alignment_format']) for task in group))
+    summary = {'completed': 0, 'skipped': len(tasks) - len(pending),
+               'failed': 0, 'errors': {}}
+    _log(log, "{0} tasks for {1} structures ({2} already completed)".format(
+        len(tasks), len(groups), summary['skipped']))
+
+    def record(results):
+        for task_id, message, _ in results:
+            if message is None:
+                summary['completed'] += 1
+            else:
+                summary['failed'] += 1
+                summary['errors'][task_id] = message
+                _log(log, "Failed {0}: {1}".format(task_id, message))
+        elapsed = time.time() - start
+        done = summary['completed'] + summary['failed']
+        _log(log, "{0}/{1} tasks done, {2:.2f} tasks/s".format(
+            done, len(pending), done / elapsed if elapsed else 0))
+
+    if processes == 1:
+        for group in ordered_groups:
+            record(run_structure_tasks(group, output_dir))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(run_structure_tasks, group, output_dir)
+                       for group in ordered_groups]
+            for future in as_completed(futures):
+                record(future.result())
+    summary['seconds'] = time.time() - start
+    _log(log, "Completed {0} tasks ({1} failed, {2} skipped) in "
+         "{3:.1f} s".format(summary['completed'], summary['failed'],
+                           summary['skipped'], summary['seconds']))
+    return summary
+
+
+def _log(log, message):
+    '''Write a progress message, if logging is enabled.'''
+    if log is not None:
+        print(message, file=log)
+        log.flush()
+
+
+def main(argv=None):
+    '''Command line entry point (`biostructmap-batch`).
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+    Returns:
+        int: Exit status. Non-zero if any tasks failed.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Map data over many structures, as described by a "
+                    "manifest file. Completed results are checkpointed, and "
+                    "skipped if the batch is run again.")
+    parser.add_argument('manifest', help="Manifest file (JSON Lines).")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="Directory for results (default: current "
+                             "directory).")
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help="Number of worker processes (default: number of "
+                             "CPUs).")
+    args = parser.parse_args(argv)
+    summary = run_batch(args.manifest, args.output_dir, args.processes,
+                        log=sys.stderr)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
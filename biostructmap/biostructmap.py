@@ -42,16 +42,31 @@ interest).
 '''
 from __future__ import absolute_import, division, print_function
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import contextlib
-from copy import deepcopy
+import io
+import hashlib
+import numbers
 import json
+import pickle
+import shutil
 import itertools
+import time
+import numpy as np
+import warnings
 from tempfile import NamedTemporaryFile
 from Bio.PDB import DSSP, PDBIO, PDBParser, FastMMCIFParser
 from Bio import AlignIO
 from Bio.PDB.MMCIF2Dict import MMCIF2Dict
-from . import pdbtools, gentests
-from .pdbtools import match_pdb_residue_num_to_seq, SS_LOOKUP_DICT, mmcif_sequence_to_res_id
+from . import pdbtools, gentests, instrument, readers, sasa, secstruct
+from .cache import DiskCache
+from .residue_table import (ResidueTable, residue_id_arrays,
+                            residue_ids_from_arrays)
+from .writers import MMCIFTemplate, PDBTemplate
+from .pdbtools import SS_LOOKUP_DICT
 from .map_functions import (_tajimas_d, _default_mapping, _snp_mapping,
                             _map_amino_acid_scale, _count_residues,
                             _nucleotide_diversity, _wattersons_theta,
@@ -68,6 +83,33 @@ mapping_methods = {"default":_default_mapping,
                    "shannon_entropy": _shannon_entropy,
                    "normalized_shannon_entropy": _normalized_shannon_entropy}
 
+#Cache DSSP results on disk, keyed by model coordinates. See biostructmap.cache
+#for the location of the cache directory.
+USE_DSSP_CACHE = True
+#Maximum number of DSSP results to keep in the cache.
+DSSP_CACHE_SIZE = 1000
+
+#Default method used to calculate relative solvent accessibility. Either
+#'dssp' (requires the DSSP program) or 'shrake-rupley' (calculated within
+#biostructmap, see biostructmap.sasa). If DSSP is not available, RSA values
+#are calculated using the Shrake-Rupley method instead.
+RSA_METHOD = 'dssp'
+RSA_METHODS = ('dssp', 'shrake-rupley')
+
+#Default method used to assign secondary structure. Either 'dssp' (requires
+#the DSSP program, and only works for the first model in a structure) or
+#'kabsch-sander' (calculated within biostructmap for any model, see
+#biostructmap.secstruct). If DSSP is not available, secondary structure is
+#assigned using the built-in method instead.
+SS_METHOD = 'dssp'
+SS_METHODS = ('dssp', 'kabsch-sander')
+
+#Maximum number of Structure snapshots to keep in the cache. See
+#`Structure.save_snapshot`.
+SNAPSHOT_CACHE_SIZE = 1000
+#Bump this if the contents of Structure snapshots change.
+SNAPSHOT_VERSION = 7
+
 @contextlib.contextmanager
 def open_if_string(path_or_file, mode):
     '''Opens a file if given a string but doesn't try to re-open a file-like
@@ -86,31 +128,216 @@ def open_if_string(path_or_file, mode):
             file_to_close.close()
 
 
+def _min_contact_frequency(windows):
+    '''Get the minimum fraction of models in which residues must be in
+    contact, for a method of combining windows from multiple models.'''
+    if windows == 'union':
+        return 0
+    if windows == 'intersection':
+        return 1
+    if isinstance(windows, numbers.Real) and 0 < windows <= 1:
+        return windows
+    raise ValueError("Unknown windows option '{0}'. Valid options are "
+                     "'union', 'intersection' or a minimum contact frequency "
+                     "between 0 and 1.".format(windows))
+
+
+def _content_hash(pdbfile, mmcif):
+    '''Get a hash of the contents of a PDB or mmCIF file.
+
+    Args:
+        pdbfile (str/file-object): A filename string or a file-like object.
+        mmcif (bool): True if the file is an mmCIF file.
+    Returns:
+        str: Hex digest of file contents.
+    '''
+    if not isinstance(pdbfile, str):
+        pdbfile.seek(0)
+    with open_if_string(pdbfile, 'rb') as f:
+        contents = f.read()
+    if not isinstance(pdbfile, str):
+        pdbfile.seek(0)
+    if not isinstance(contents, bytes):
+        contents = contents.encode('utf-8')
+    digest = hashlib.sha1(contents)
+    digest.update(b'mmcif' if mmcif else b'pdb')
+    return digest.hexdigest()
+
+
+#NumPy dtype used to store DataMap contents. Values that aren't real numbers
+#are stored using an object array instead.
+DATAMAP_DTYPE = np.dtype([('index', 'i8'), ('value', 'f8'), ('present', '?')])
+
+
 class DataMap(dict):
     '''
     A class to hold a mapping of data to some PDB object. Extends the `dict`
     class, adding a few methods to allow correspondence between data and PDB
     chain object.
 
+    Data are also stored as a NumPy structured array, with one row for each
+    residue giving an integer residue index and a float64 value (NaN if there
+    is no value). Residue indices refer to the row of the residue in the
+    structure's residue table (see `Structure.residue_table`), so residue ids
+    aren't duplicated for each DataMap. The array is exported without copying
+    by `to_numpy`, and is used by the writers. Changes made through the dict
+    interface (eg. `data_map[key] = value` or `update`) are written through to
+    the array.
+
     Should be called as `DataMap(results, structure=structure, params=params)`,
     where `results` would be a dictionary of mapped data over a PDB chain for a
     particular set of parameters.
+
+    Attributes:
+        structure (Structure): Structure to which data is mapped. May be None.
+            Writers stream the structure's original file, and may need its
+            Bio.PDB objects, sequences and nearby residues, so a reference to
+            the whole structure is kept. This is shared by every DataMap from
+            the same structure, so doesn't add to the memory used by each map.
+        params (dict): Parameters used to generate data.
+        residue_ids (list): Residue ids (chain id, residue id) referred to by
+            residue indices.
+        integer (bool): True if all values are integers. Values are stored in
+            the array as float64.
+        reference_numbering (dict): Reference sequence position (chain id,
+            position) for each residue, if loaded from a file written by
+            `write_to_npz`. Otherwise None.
+        nearby_arrays (tuple): Nearby residues for each residue, in the
+            format returned by `Structure.nearby_arrays`, if loaded from a file
+            written by `write_to_npz` or mapped over a trajectory frame (see
+            biostructmap.trajectory). Otherwise None.
+        stats (instrument.MapStats): Timings and counters recorded while
+            mapping, if requested (see `Structure.map`). Otherwise None.
     '''
     def __init__(self, *args, **kw):
         '''Initialise a DataMap object, which stores data mapped to a PDB
-        structure as a dictionary, but also provides a link to original chain object
-        and parameters used to generate data.
+        structure as a dictionary, but also provides a link to original chain
+        object and parameters used to generate data.
 
         Args:
             *args: Standard dict args
             **kwargs: Standard dict kwargs. Kwargs `structure` and `params` are
                 reserved for reference to the PDB structure object and analysis
-                parameters respectively, and are required. These are removed
-                from the list of kwargs before passing to dict __init__ method.
+                parameters respectively, and are required (although
+                `structure` may be None). These are removed from the list of
+                kwargs before passing to dict __init__ method.
         '''
         self.structure = kw.pop('structure')
         self.params = kw.pop('params')
+        self.reference_numbering = None
+        self.nearby_arrays = None
+        self.stats = None
         super(DataMap, self).__init__(*args, **kw)
+        self._build_array()
+
+    def _build_array(self):
+        '''Build the structured array holding the contents of the map.'''
+        if self.structure is not None:
+            table = self.structure.residue_table()
+            residue_ids = table.residue_ids
+            row_index = table.row_index
+        else:
+            residue_ids = []
+            row_index = {}
+        if any(key not in row_index for key in self):
+            # Not all residues are in the structure. Use a separate list of
+            # residue ids for this DataMap.
+            residue_ids = list(self)
+            row_index = {key: i for i, key in enumerate(residue_ids)}
+        self.residue_ids = residue_ids
+        self._row_index = row_index
+        values = [x for x in self.values() if x is not None]
+        is_numeric = all(isinstance(x, numbers.Real) and not isinstance(x, bool)
+                         for x in values)
+        self.integer = is_numeric and bool(values) and all(
+            isinstance(x, numbers.Integral) for x in values)
+        dtype = DATAMAP_DTYPE
+        if not is_numeric:
+            dtype = np.dtype([('index', 'i8'), ('value', 'O'), ('present', '?')])
+        data = np.zeros(len(self), dtype=dtype)
+        data['index'] = [row_index[key] for key in self]
+        if is_numeric:
+            data['value'] = [np.nan if x is None else x for x in self.values()]
+        else:
+            # Assign element by element, so that sequence values aren't
+            # broadcast.
+            for i, value in enumerate(self.values()):
+                data['value'][i] = value
+        data['present'] = [x is not None for x in self.values()]
+        self._data = data
+
+    def __setitem__(self, key, value):
+        super(DataMap, self).__setitem__(key, value)
+        # Rebuild the array when next required.
+        self._data = None
+
+    def __delitem__(self, key):
+        super(DataMap, self).__delitem__(key)
+        self._data = None
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kw):
+        super(DataMap, self).update(*args, **kw)
+        self._data = None
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        value = super(DataMap, self).pop(*args)
+        self._data = None
+        return value
+
+    def popitem(self):
+        item = super(DataMap, self).popitem()
+        self._data = None
+        return item
+
+    def clear(self):
+        super(DataMap, self).clear()
+        self._data = None
+
+    def copy(self):
+        '''Get a shallow copy of the DataMap, with the same structure and
+        parameters.'''
+        data_map = type(self)(self, structure=self.structure,
+                              params=self.params)
+        data_map.reference_numbering = self.reference_numbering
+        data_map.nearby_arrays = self.nearby_arrays
+        data_map.stats = self.stats
+        return data_map
+
+    @property
+    def index(self):
+        '''np.array: Residue index for each entry (a view, not a copy).'''
+        return self.to_numpy()['index']
+
+    @property
+    def values_array(self):
+        '''np.array: Value for each entry, with NaN for missing values if
+        numeric (a view, not a copy).'''
+        return self.to_numpy()['value']
+
+    def to_numpy(self):
+        '''Get the underlying structured array, without copying.
+
+        The array has fields `index` (residue index, referring to
+        `residue_ids`), `value` (float64, or object if any values are not
+        numbers) and `present` (False if there is no value for a residue).
+        Rows are in the same order as the keys of the map. The array should be
+        treated as read-only, and is replaced if the map is changed.
+
+        Returns:
+            np.array: Structured array with one row per residue.
+        '''
+        if self._data is None:
+            self._build_array()
+        return self._data
 
 
     def write_data_to_pdb_b_factor(self, default_no_value=0, fileobj=None,
@@ -143,61 +370,145 @@ class DataMap(dict):
         Returns:
             None
         '''
-        # Make copy of structure object.
-        # We do this so that we are not overwriting B-factor values in the
-        # original PDB structure.
-        # This may fail in earlier versions of Biopython if the structure
-        # contains disordered residues - An appropriate fix for deepcopying
-        # disordered residues has been added to Biopython (>v1.70?).
-        serial_number_generator = itertools.count(start=1)
-        _structure = deepcopy(self.structure)
-        first_model = sorted(_structure.models)[0]
-        #Set all B-factor fields to zeros/default value
-        for chain in _structure[first_model].chains.values():
-            for residue in chain:
-                _data = self.get(residue.get_full_id()[2:4], default_no_value)
-                if _data is None:
-                    _data = default_no_value
-                    _scale_factor = 1
-                else:
-                    _scale_factor = scale_factor
-                for atom in residue:
-                    # Currently mmcif files don't get assigned an atom serial number
-                    # by Bio.PDB, which breaks trying to write to a PDB file.
-                    # Simple fix is just to assign a sequential serial number.
-                    # May not line up with _atom_site.id in mmcif file.
-                    if atom.get_serial_number() is None:
-                        atom.set_serial_number(next(serial_number_generator))
-                    if atom.is_disordered():
-                        for altloc in atom.disordered_get_id_list():
-                            atom.disordered_select(altloc)
-                            atom.set_bfactor(float(_data * _scale_factor))
-                    else:
-                        atom.set_bfactor(float(_data * _scale_factor))
-        pdb_io = PDBIO()
-        pdb_io.set_structure(_structure.structure)
-        # Write structure to PDB file
+        # Value to write for each residue in the structure's residue table.
+        values = self.residue_table_values(scale_factor)
         if fileobj is None:
-            fileobj = _structure.pdbname + '_' + self._parameter_string() + '.pdb'
-        pdb_io.save(file=fileobj, preserve_atom_numbering=True)
+            fileobj = self.structure.pdbname + '_' + self._parameter_string() + '.pdb'
+        if not self.structure._mmcif:
+            # Stream the original PDB records, rewriting only B-factors.
+            template = self.structure.pdb_template()
+            with open_if_string(fileobj, 'w') as f:
+                template.write(f, values, default_no_value)
+        else:
+            self._write_b_factor_with_pdbio(fileobj, values, default_no_value)
         return None
 
+    def write_data_to_mmcif(self, default_no_value=0, fileobj=None,
+                            scale_factor=1, column='B_iso_or_equiv'):
+        '''Write mapped data to a column of the mmCIF _atom_site loop, and save
+        as an mmCIF file.
+
+        Output is written by streaming the original mmCIF file, so unlike PDB
+        output there are no limits on the number of atoms or the length of
+        chain ids. Only applicable if the structure was read from an mmCIF
+        file.
+
+        Args:
+            default_no_value (int, optional): Default value to write if there
+                is no value for a residue. If None, the mmCIF placeholder for
+                an unknown value (`?`) is written.
+            fileobj (str/file-like object, optional): Output file.
+                Can be either a string representing the file path or a file-like
+                object. If not provided, this defaults to a string
+                describing the data being written, in the form of
+                "pdbid_param1-value1_param2-value2.cif".
+            scale_factor (int/float): A factor by which to scale (multiply) all
+                data values before writing.
+            column (str, optional): Name of the _atom_site column to write
+                values to. If this is not an existing column (eg.
+                `biostructmap_score`), it is added to the _atom_site loop.
+                Defaults to `B_iso_or_equiv`.
+
+        Returns:
+            None
+        '''
+        template = self.structure.mmcif_template()
+        values = self.residue_table_values(scale_factor)
+        if fileobj is None:
+            fileobj = self.structure.pdbname + '_' + self._parameter_string() + '.cif'
+        with open_if_string(fileobj, 'w') as f:
+            template.write(f, values, default_no_value, column)
+        return None
+
+    def residue_table_values(self, scale_factor=1):
+        '''Get values for each residue in the structure's residue table.
+
+        Args:
+            scale_factor (int/float): A factor by which to scale (multiply)
+                all values.
+
+        Returns:
+            np.array: Value for each row of the residue table, with NaN if
+                there is no value for a residue.
+        '''
+        table = self.structure.residue_table()
+        data = self.to_numpy()
+        if self.residue_ids is table.residue_ids:
+            rows = data['index']
+        else:
+            rows = table.index(list(self))
+        present = data['present'] & (rows >= 0)
+        values = np.full(len(table), np.nan)
+        values[rows[present]] = np.asarray(data['value'][present],
+                                           dtype='float64') * scale_factor
+        return values
+
+    def _write_b_factor_with_pdbio(self, fileobj, values, default_no_value=0):
+        '''Write values to PDB B-factor column using Bio.PDB PDBIO.
+
+        Rather than copying the structure, B-factors and atom serial numbers
+        are modified in place and restored once the file has been written.
+
+        Args:
+            fileobj (str/file-like object): Output file.
+            values (np.array): Value to write for each residue table row.
+            default_no_value (int, optional): Value to write if there is no
+                value for a residue.
+        '''
+        serial_number_generator = itertools.count(start=1)
+        row_index = self.structure.residue_table().row_index
+        first_model = sorted(self.structure.models)[0]
+        original_values = []
+        try:
+            for chain in self.structure.structure[first_model]:
+                for residue in chain:
+                    row = row_index.get((chain.get_id(), residue.get_id()))
+                    _data = default_no_value
+                    if row is not None and not np.isnan(values[row]):
+                        _data = values[row]
+                    atoms = []
+                    for atom in residue:
+                        if atom.is_disordered():
+                            atoms.extend(atom.disordered_get_list())
+                        else:
+                            atoms.append(atom)
+                    for atom in atoms:
+                        original_values.append((atom, atom.get_bfactor(),
+                                                atom.get_serial_number()))
+                        # Currently mmcif files don't get assigned an atom
+                        # serial number by Bio.PDB, which breaks trying to
+                        # write to a PDB file. Simple fix is just to assign a
+                        # sequential serial number. May not line up with
+                        # _atom_site.id in mmcif file.
+                        if atom.get_serial_number() is None:
+                            atom.set_serial_number(next(serial_number_generator))
+                        atom.set_bfactor(float(_data))
+            pdb_io = PDBIO()
+            pdb_io.set_structure(self.structure.structure)
+            pdb_io.save(file=fileobj, preserve_atom_numbering=True)
+        finally:
+            for atom, bfactor, serial_number in original_values:
+                atom.set_bfactor(bfactor)
+                atom.set_serial_number(serial_number)
+
     def write_to_atom(self, fileobj, sep=',', model=None):
         '''Write score for each atom in a structure to a file, based on
         a data dictionary mapping output score to residue number.
 
         Each line of the output file contains an entry for a single atom.
+        For mmCIF files, atoms are identified by their `_atom_site.id`.
 
         Args:
             fileobj (str/object): Output file name/path or file-like object.
             sep (str, optional): Seperator between residue and data.
                 Defaults to `,`.
+            model (int, optional): Model id. Defaults to the first model.
         Returns:
             None
         '''
-        is_mmcif = self.structure._mmcif
-        if is_mmcif:
-            raise TypeError("Can't map to atom serial with mmcif file!")
+        if self.structure._mmcif:
+            self._write_to_atom_site_id(fileobj, sep, model)
+            return
         if model is None:
             # Use the first model. Will be the only model unless it's an NMR structure.
             model_ = self.structure[sorted(self.structure.models)[0]]
@@ -217,24 +528,96 @@ class DataMap(dict):
         return
 
 
-    def write_data_to_json(self, fileobj):
+    def _write_to_atom_site_id(self, fileobj, sep=',', model=None):
+        '''Write score for each atom in an mmCIF structure to a file, with
+        atoms identified by _atom_site.id.
+
+        Args:
+            fileobj (str/object): Output file name/path or file-like object.
+            sep (str, optional): Seperator between atom id and data.
+            model (int, optional): Model id. Defaults to the first model.
+        Returns:
+            None
+        '''
+        model_index = 0
+        if model is not None:
+            model_index = sorted(self.structure.models).index(model)
+        atoms = {}
+        for atom_id, row in self.structure.mmcif_template().atom_rows(model_index):
+            atoms.setdefault(row, []).append(atom_id)
+        row_index = self.structure.residue_table().row_index
+        with open_if_string(fileobj, 'w') as f:
+            f.write(sep.join(('atom_serial', 'score\n')))
+            for res in sorted(self):
+                for atom_id in atoms.get(row_index.get(res), []):
+                    f.write(sep.join((atom_id, str(self[res]))) + '\n')
+        return
+
+    def write_data_to_json(self, fileobj, compact=False):
         '''Write data on contents of each 3D window and related output value.
 
-        Data is written in JSON format. Residues are numbered according to
-        PDB file numbering.
+        Data is written in JSON format, with records written incrementally
+        rather than building the whole document in memory. Residues are
+        numbered according to PDB file numbering. The contents of each window
+        are residues within the radius (and using the atom selector) used to
+        create this DataMap, before any residue filters are applied.
+
+        By default, a list of records is written, each of the form
+        `{"residue": "('A', (' ', 5, ' '))", "score": 1.2, "nearby": "{...}"}`.
+        If `compact` is True, residues are instead referred to by an integer
+        index into a table of residues, giving much smaller output for large
+        structures:
+
+            {"params": {"radius": 15, "selector": "all"},
+             "residues": [["A", " ", 5, " "], ...],
+             "data": [[index, score, [nearby indices]], ...]}
 
         Args:
             fileobj (str/object): Output file name/path or file-like object.
+            compact (bool, optional): If True, use the compact format
+                described above. Defaults to False.
         Returns:
             None
         '''
-        nearby = self.structure.nearby()
-        data_to_write = []
-        for res in sorted(self):
-            data_to_write.append({'residue': str(res), 'score': self[res],
-                                  'nearby': str(nearby[res])})
+        if self.structure is None:
+            raise ValueError("DataMap has no associated structure.")
+        nearby_arrays = self.nearby_arrays
+        if nearby_arrays is None:
+            nearby_arrays = self.structure.nearby_arrays(
+                radius=self.params.get('radius', 15),
+                atom=self.params.get('selector', 'all'),
+                windows=self.params.get('windows'))
+        residue_ids, indptr, indices = nearby_arrays
+        residue_index = {residue: i for i, residue in enumerate(residue_ids)}
+        # Residues without any selected atoms have an empty window.
+        extra_residues = [res for res in self if res not in residue_index]
         with open_if_string(fileobj, 'w') as f:
-            json.dump(data_to_write, f, indent=2)
+            if compact:
+                f.write('{"params": ' + json.dumps(self.params, sort_keys=True))
+                f.write(',\n "residues": [')
+                for i, (chain, res_id) in enumerate(itertools.chain(
+                        residue_ids, extra_residues)):
+                    f.write((',\n  ' if i else '\n  ') +
+                            json.dumps([chain, res_id[0], res_id[1], res_id[2]]))
+                f.write('],\n "data": [')
+            else:
+                f.write('[')
+            extra_index = {res: len(residue_ids) + i for i, res in
+                           enumerate(extra_residues)}
+            for i, res in enumerate(sorted(self)):
+                if res in residue_index:
+                    row = residue_index[res]
+                    nearby = indices[indptr[row]:indptr[row + 1]]
+                else:
+                    row = extra_index[res]
+                    nearby = []
+                if compact:
+                    record = [row, self[res], [int(x) for x in nearby]]
+                else:
+                    record = {'residue': str(res), 'score': self[res],
+                              'nearby': str({residue_ids[x] for x in nearby})}
+                f.write((',\n  ' if i else '\n  ') + json.dumps(record))
+            f.write('\n ]}\n' if compact else '\n]\n')
         return
 
     def write_residue_data_to_csv(self, fileobj, sep=',', ref=None):
@@ -277,6 +660,120 @@ class DataMap(dict):
             f.write(file_contents)
         return
 
+    def write_to_npz(self, fileobj, ref=None, include_nearby=False,
+                     compressed=True):
+        '''Write data to a NumPy .npz file, which can be loaded using
+        `DataMap.from_npz`.
+
+        Residue ids, values and parameters are stored as NumPy arrays, so
+        writing and reading is not limited by formatting or parsing of text.
+        Optionally, reference sequence numbering for each residue (as written
+        by `write_residue_data_to_csv`) and the contents of each 3D window can
+        also be stored. Only DataMaps with numeric values can be written.
+
+        Args:
+            fileobj (str/file-like object): Output file. If a file name is
+                given without a `.npz` extension, this is added.
+            ref (dict, optional): A dictionary of reference sequences (as
+                strings), accessed by chain ID. If given, the position of each
+                residue within the reference sequences is stored. If not
+                given, any reference numbering loaded with this DataMap is
+                stored.
+            include_nearby (bool, optional): If True, store the residues within
+                each 3D window, using the radius and selector used to create
+                this DataMap. Defaults to False.
+            compressed (bool, optional): If True (default), compress the
+                output file.
+        Returns:
+            None
+        '''
+        data = self.to_numpy()
+        if data.dtype != DATAMAP_DTYPE:
+            raise TypeError("Only DataMaps with numeric values can be written "
+                            "to an npz file.")
+        if self.structure is None and (ref is not None or
+                                       (include_nearby and
+                                        self.nearby_arrays is None)):
+            raise ValueError("DataMap has no associated structure.")
+        residue_ids = list(self.residue_ids)
+        arrays = {'data': data,
+                  'params': np.array(json.dumps(self.params, sort_keys=True)),
+                  'integer': np.array(self.integer)}
+        reference_numbering = self.reference_numbering
+        if ref is not None:
+            reference_numbering = self.structure._map_pdb_numbering_to_reference(ref)
+        if reference_numbering is not None:
+            numbering = [reference_numbering.get(res, ('', -1)) for res in self]
+            arrays['reference_chain'] = np.array([x[0] for x in numbering],
+                                                 dtype='U')
+            arrays['reference_position'] = np.array([x[1] for x in numbering],
+                                                    dtype='i8')
+        if include_nearby:
+            nearby_arrays = self.nearby_arrays
+            if nearby_arrays is None:
+                nearby_arrays = self.structure.nearby_arrays(
+                    radius=self.params.get('radius', 15),
+                    atom=self.params.get('selector', 'all'),
+                    windows=self.params.get('windows'))
+            nearby_ids, indptr, indices = nearby_arrays
+            # Residues within windows are stored as indices into the list of
+            # residue ids, which is extended if needed.
+            row_index = dict(self._row_index)
+            for res in nearby_ids:
+                if res not in row_index:
+                    row_index[res] = len(residue_ids)
+                    residue_ids.append(res)
+            arrays['nearby_rows'] = np.array([row_index[res] for res in
+                                              nearby_ids], dtype='i8')
+            arrays['nearby_indptr'] = indptr
+            arrays['nearby_indices'] = indices
+        arrays.update(residue_id_arrays(residue_ids))
+        if compressed:
+            np.savez_compressed(fileobj, **arrays)
+        else:
+            np.savez(fileobj, **arrays)
+        return None
+
+    @classmethod
+    def from_npz(cls, fileobj, structure=None):
+        '''Load a DataMap from a file written by `write_to_npz`.
+
+        The structure is not required to load data, and isn't parsed. If a
+        structure is given, residue indices are matched to rows of the
+        structure's residue table.
+
+        Args:
+            fileobj (str/file-like object): An .npz file.
+            structure (Structure, optional): Structure to which data was
+                mapped.
+        Returns:
+            DataMap: The loaded DataMap, with `reference_numbering` and
+                `nearby_arrays` attributes set if these were stored.
+        '''
+        with np.load(fileobj, allow_pickle=False) as npz:
+            arrays = dict(npz.items())
+        residue_ids = residue_ids_from_arrays(arrays['chain'],
+                                              arrays['hetflag'],
+                                              arrays['resseq'], arrays['icode'])
+        data = arrays['data']
+        keys = [residue_ids[i] for i in data['index']]
+        integer = bool(arrays['integer'])
+        values = [(int(value) if integer else value) if present else None
+                  for value, present in zip(data['value'].tolist(),
+                                            data['present'].tolist())]
+        data_map = cls(zip(keys, values), structure=structure,
+                       params=json.loads(str(arrays['params'])))
+        if 'reference_chain' in arrays:
+            data_map.reference_numbering = {
+                key: (chain, position) for key, chain, position in
+                zip(keys, arrays['reference_chain'].tolist(),
+                    arrays['reference_position'].tolist()) if position >= 0}
+        if 'nearby_rows' in arrays:
+            data_map.nearby_arrays = (
+                [residue_ids[i] for i in arrays['nearby_rows']],
+                arrays['nearby_indptr'], arrays['nearby_indices'])
+        return data_map
+
     def _parameter_string(self):
         '''Create descriptive string from parameter values'''
         param_string = '_'.join(["{k}-{v}".format(k=key, v=value)
@@ -288,12 +785,15 @@ class Structure(object):
     '''A class to hold a PDB structure object.
 
     Attributes:
-        structure: Underlying Bio.PDB.Structure.Structure object
+        structure: Underlying Bio.PDB.Structure.Structure object. This is
+            only parsed when first required.
         sequences (dict): A dictionary of all protein sequences within
             structure, accessed by chain id.
         models (dict): Dictionary of all models within structure, accessed by
-            model id.
+            model id. Model objects are created when first accessed.
         pdbname (str): A descriptive name for the PDB file.
+        header (dict): Header metadata (PDB id code, structure method and
+            resolution). See readers.read_pdb.
     '''
     def __init__(self, pdbfile, pdbname='pdb_file', mmcif=False):
         '''Initialise PDB Structure object.
@@ -306,25 +806,159 @@ class Structure(object):
             mmcif (bool, optional): Set to true if reading a PDBx/mmCIF file,
                 otherwise this defaults to reading a PDB file.
         '''
-        # Create PDB parser
-        if mmcif:
-            parser = FastMMCIFParser()
-        else:
-            parser = PDBParser()
         self._mmcif_dict = None
         self._mmcif = mmcif
-        #Get Bio.PDB structure
         self._pdbfile = pdbfile
-        self.structure = parser.get_structure(pdbname, self.pdb_file())
-        #Get PDB sequences
-        if mmcif:
-            self.sequences = pdbtools.get_mmcif_canonical_seq(self.mmcif_dict())
-        else:
-            self.sequences = pdbtools.get_pdb_seq(self.pdb_file())
-        self.models = {model.get_id():Model(self, model) for
-                       model in self.structure}
         self.pdbname = pdbname
+        # Atom coordinates are read directly into arrays. The Bio.PDB structure
+        # is only built when first required (eg. for DSSP, or writing output
+        # with PDBIO).
+        # Files are read in a single pass, which also gives PDB sequences,
+        # header metadata and (for mmCIF files) sequence numbering.
+        with open_if_string(self.pdb_file(), 'r') as f:
+            if mmcif:
+                self._atoms, items = readers.read_mmcif(f)
+                self.sequences = pdbtools.get_mmcif_canonical_seq(items)
+                self.header = readers.mmcif_header(items)
+            else:
+                self._atoms, self.sequences, self.header = readers.read_pdb(f)
+                #Some PDB files do not contain sequences in the header, and
+                #hence we need to use the atom records for those chains
+                for chain_id, sequence in pdbtools.get_seq_from_atoms(
+                        self._atoms).items():
+                    self.sequences.setdefault(chain_id, sequence)
+        self._structure = None
+        self._models = None
         self._nearby = {}
+        self._nearby_arrays = {}
+        self._model_coords = None
+        self._contact_frequencies = {}
+        self._reference_numbering = {}
+        self._seq_index = None
+        self._residue_table = None
+        self._pdb_template = None
+        self._mmcif_template = None
+
+    @classmethod
+    def from_snapshot(cls, pdbfile, pdbname='pdb_file', mmcif=False,
+                      snapshot=None):
+        '''Create a Structure object, restoring it from a snapshot if possible.
+
+        A snapshot (see `save_snapshot`) holds the parsed structure along with
+        all results calculated so far, such as nearby residues, alignments to
+        reference sequences and relative solvent accessibility. The snapshot
+        is only used if it was created from a file with identical contents,
+        otherwise the file is parsed as usual.
+
+        Args:
+            pdbfile (str/file-object): A filename string or a file-like object
+                that contains a PDB file.
+            pdbname (str, optional): A descriptive name for the PDB file.
+            mmcif (bool, optional): Set to true if reading a PDBx/mmCIF file.
+            snapshot (str/file-object, optional): A snapshot file written by
+                `save_snapshot`. If not given, the snapshot cache is used.
+
+        Returns:
+            Structure: The restored structure, or a newly parsed structure if
+                there is no matching snapshot.
+        '''
+        content_hash = _content_hash(pdbfile, mmcif)
+        if snapshot is None:
+            saved = DiskCache('snapshots', max_entries=SNAPSHOT_CACHE_SIZE).get(
+                content_hash)
+        else:
+            with open_if_string(snapshot, 'rb') as f:
+                saved = f.read()
+        if saved is None:
+            return cls(pdbfile, pdbname, mmcif)
+        structure = cls.__new__(cls)
+        unpickler = pickle.Unpickler(io.BytesIO(saved))
+        # References to the structure itself are restored to the new object.
+        unpickler.persistent_load = lambda _: structure
+        # The header (content hash and version) is checked before loading the
+        # state, which may refer to classes from another version. Any failure
+        # to load a snapshot means the file is parsed as usual.
+        try:
+            header = unpickler.load()
+        except Exception:
+            return cls(pdbfile, pdbname, mmcif)
+        if header != (content_hash, SNAPSHOT_VERSION):
+            return cls(pdbfile, pdbname, mmcif)
+        try:
+            state = unpickler.load()
+        except Exception:
+            return cls(pdbfile, pdbname, mmcif)
+        structure.__dict__.update(state)
+        structure._pdbfile = pdbfile
+        structure.pdbname = pdbname
+        structure._pdb_template = None
+        structure._mmcif_template = None
+        return structure
+
+    def save_snapshot(self, fileobj=None):
+        '''Save a snapshot of the structure, which can be restored using
+        `Structure.from_snapshot`.
+
+        The snapshot includes the parsed structure, sequences, residue table
+        and all results calculated so far (nearby residues, alignments to
+        reference sequences, DSSP results, relative solvent accessibility and
+        secondary structure). Snapshots are only restored for files with
+        identical contents, so there is no need to remove old snapshots when
+        a file changes.
+
+        Args:
+            fileobj (str/file-object, optional): Output file. If not given,
+                the snapshot is stored in the biostructmap cache (see
+                biostructmap.cache), keyed by the contents of the PDB file.
+        Returns:
+            None
+        '''
+        state = {key: value for key, value in self.__dict__.items() if key
+                 not in ('_pdbfile', '_pdb_template', '_mmcif_template')}
+        content_hash = _content_hash(self.pdb_file(), self._mmcif)
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        # Models and chains refer back to this structure, which is stored as
+        # a reference rather than pickled.
+        pickler.persistent_id = lambda obj: 'structure' if obj is self else None
+        pickler.dump((content_hash, SNAPSHOT_VERSION))
+        pickler.dump(state)
+        if fileobj is None:
+            DiskCache('snapshots', max_entries=SNAPSHOT_CACHE_SIZE).set(
+                content_hash, buffer.getvalue())
+        else:
+            with open_if_string(fileobj, 'wb') as f:
+                f.write(buffer.getvalue())
+        return None
+
+    @property
+    def structure(self):
+        '''Underlying Bio.PDB.Structure.Structure object, parsed from the PDB
+        file when first required.'''
+        if self._structure is None:
+            if self._mmcif:
+                parser = FastMMCIFParser()
+            else:
+                parser = PDBParser()
+            self._structure = parser.get_structure(self.pdbname,
+                                                   self.pdb_file())
+        return self._structure
+
+    @property
+    def models(self):
+        '''Dictionary of all models within structure, accessed by model id.'''
+        if self._models is None:
+            self._models = _LazyWrappers(self, self.structure, Model)
+        return self._models
+
+    def atoms(self):
+        '''Get coordinates and identities of all atoms in the first model,
+        without building Bio.PDB objects.
+
+        Returns:
+            readers.AtomTable: Atom coordinates and identities.
+        '''
+        return self._atoms
 
     def __iter__(self):
         '''Iterate over all models within structure'''
@@ -352,6 +986,113 @@ class Structure(object):
             self._pdbfile.seek(0)
         return self._pdbfile
 
+    def pdb_template(self):
+        '''Return the original PDB file records, used to write data to the
+        B-factor column. Records are read once, and shared by all DataMaps.
+
+        Only applicable if using a PDB file.
+
+        Returns:
+            writers.PDBTemplate: PDB records matched to residue table rows.
+        '''
+        if self._mmcif:
+            raise TypeError("Not a PDB file!")
+        if self._pdb_template is None:
+            row_index = self.residue_table().row_index
+            with open_if_string(self.pdb_file(), 'r') as f:
+                self._pdb_template = PDBTemplate.from_file(f, row_index)
+        return self._pdb_template
+
+    def mmcif_template(self):
+        '''Return the original mmCIF file records, used to write data to a
+        column of the _atom_site loop. Records are read once, and shared by all
+        DataMaps.
+
+        Only applicable if using an mmCIF file.
+
+        Returns:
+            writers.MMCIFTemplate: mmCIF records matched to residue table rows.
+        '''
+        if not self._mmcif:
+            raise TypeError("Not an mmCIF file!")
+        if self._mmcif_template is None:
+            row_index = self.residue_table().row_index
+            with open_if_string(self.pdb_file(), 'r') as f:
+                self._mmcif_template = MMCIFTemplate.from_file(f, row_index)
+        return self._mmcif_template
+
+    def write_data_maps(self, data_maps, fileobj=None, multi_model=False,
+                        default_no_value=0, scale_factor=1,
+                        column='B_iso_or_equiv'):
+        '''Write many DataMaps to the B-factor column of PDB files, or a
+        column of the _atom_site loop of mmCIF files.
+
+        Original file records are read once and shared between all data maps,
+        so that only the B-factor column is formatted for each map. Output can
+        either be a separate file for each map, or a single multi-model file
+        with one model for each map (in the order given). The latter is
+        convenient for viewing many maps in Pymol. Output files are in the
+        same format as the structure file.
+
+        Args:
+            data_maps (list): A list of DataMap objects, all of which must
+                have been mapped to this structure.
+            fileobj (str/file-like object/list, optional): Output file(s).
+                If `multi_model` is True, this is a single output file, and
+                defaults to "pdbid_maps.pdb" (or "pdbid_maps.cif"). Otherwise,
+                this is a list of output files (one for each map), and defaults
+                to the file name used by DataMap.write_data_to_pdb_b_factor or
+                DataMap.write_data_to_mmcif for each map.
+            multi_model (bool, optional): If True, write all maps to a single
+                multi-model file.
+            default_no_value (int, optional): Default value to write to
+                B-factor column if there is no value for a residue.
+            scale_factor (int/float/list, optional): A factor by which to
+                scale (multiply) all data values, or a list giving a scale
+                factor for each data map.
+            column (str, optional): For mmCIF files, the _atom_site column to
+                write values to. Defaults to `B_iso_or_equiv`.
+
+        Returns:
+            None
+        '''
+        data_maps = list(data_maps)
+        for data_map in data_maps:
+            if data_map.structure is not self:
+                raise ValueError("All data maps must be mapped to this "
+                                 "structure.")
+        if isinstance(scale_factor, numbers.Number):
+            scale_factor = [scale_factor] * len(data_maps)
+        elif len(scale_factor) != len(data_maps):
+            raise ValueError("A scale factor must be given for each data map.")
+        values_list = [data_map.residue_table_values(scale) for data_map, scale
+                       in zip(data_maps, scale_factor)]
+        suffix = '.cif' if self._mmcif else '.pdb'
+        if multi_model:
+            if fileobj is None:
+                fileobj = self.pdbname + '_maps' + suffix
+            with open_if_string(fileobj, 'w') as f:
+                if self._mmcif:
+                    self.mmcif_template().write_models(
+                        f, values_list, default_no_value, column)
+                else:
+                    self.pdb_template().write_models(f, values_list,
+                                                     default_no_value)
+            return None
+        if fileobj is None:
+            fileobj = [self.pdbname + '_' + data_map._parameter_string() +
+                       suffix for data_map in data_maps]
+        elif len(fileobj) != len(data_maps):
+            raise ValueError("An output file must be given for each data map.")
+        for values, output in zip(values_list, fileobj):
+            with open_if_string(output, 'w') as f:
+                if self._mmcif:
+                    self.mmcif_template().write(f, values, default_no_value,
+                                                column)
+                else:
+                    self.pdb_template().write(f, values, default_no_value)
+        return None
+
     def mmcif_dict(self):
         '''Return the mmcif dictionary.
 
@@ -366,12 +1107,12 @@ class Structure(object):
             raise TypeError("Not an mmCIF file!")
         return self._mmcif_dict
 
-    def nearby(self, radius=15, atom='all'):
+    def nearby(self, radius=15, atom='all', windows=None):
         '''Take a Bio.PDB Structure object, and find all residues within a
         radius of a given residue.
 
         Note that this method uses the first model within the structure for
-        all distance calculations.
+        all distance calculations, unless `windows` is given.
 
         Args:
             radius (int/float): Radius within which to find nearby residues for
@@ -381,22 +1122,234 @@ class Structure(object):
                 potential options include 'CA', 'CB' etc. If an atom is not
                 found within a residue object, then method reverts to using
                 'CA'.
+            windows (str/float, optional): For structures with multiple
+                models (eg. NMR ensembles), how to combine nearby residues
+                from all models. See `nearby_arrays`.
 
         Returns:
             dict: A dictionary containing a list of nearby residues for each
                 residue in the structure.
         '''
-        parameter_key = (radius, atom)
-        # Run on first model in structure
-        first_model = sorted(self.models)[0]
+        parameter_key = (radius, atom, windows)
         #Calculate distance matrix and store it for retrieval in future queries.
-        if parameter_key not in self._nearby:
-            dist_map = pdbtools.nearby(self.structure[first_model], radius, atom)
+        if parameter_key in self._nearby:
+            instrument.count('cache.nearby.hit')
+        else:
+            instrument.count('cache.nearby.miss')
+            if pdbtools.SCIPY_PRESENT:
+                dist_map = pdbtools.nearby_arrays_to_dict(
+                    *self.nearby_arrays(radius, atom, windows))
+            elif windows is None:
+                dist_map = pdbtools.nearby(self._atoms, radius, atom)
+            else:
+                raise ImportError("Scipy is required to combine nearby "
+                                  "residues from multiple models.")
             self._nearby[parameter_key] = dist_map
         return self._nearby[parameter_key]
 
+    def nearby_arrays(self, radius=15, atom='all', windows=None):
+        '''Find all residues within a radius of each residue in the structure,
+        returning results as arrays in compressed sparse row format.
+
+        By default, this method uses the first model within the structure for
+        all distance calculations. For structures with multiple models (eg.
+        NMR ensembles), nearby residues can instead be combined from all
+        models, by setting `windows` to one of:
+            'union': Residues that are nearby in any model.
+            'intersection': Residues that are nearby in every model.
+            float: Residues that are nearby in at least this fraction of
+                models (eg. 0.5).
+
+        Args:
+            radius (int/float): Radius within which to find nearby residues for
+                each residue in the structure.
+            atom (str): The atom with which to compute distances. See
+                `nearby` for details.
+            windows (str/float, optional): How to combine nearby residues from
+                all models. Defaults to using the first model only.
+
+        Returns:
+            list: Residue ids (chain id, residue id) for all residues.
+            np.array: Index into `indices` of the first nearby residue for each
+                residue.
+            np.array: Indices (into the list of residue ids) of nearby
+                residues.
+        '''
+        parameter_key = (radius, atom, windows)
+        if parameter_key in self._nearby_arrays:
+            instrument.count('cache.nearby_arrays.hit')
+        else:
+            instrument.count('cache.nearby_arrays.miss')
+            if windows is None and pdbtools.SCIPY_PRESENT:
+                self._nearby_arrays[parameter_key] = pdbtools.nearby_arrays(
+                    self._atoms, radius, atom)
+            elif windows is None:
+                # Without scipy, nearby residues are found from a distance
+                # matrix, and converted to arrays.
+                residue_ids = self._atoms.select(atom)[2]
+                self._nearby_arrays[parameter_key] = (
+                    pdbtools.nearby_dict_to_arrays(
+                        self.nearby(radius, atom), residue_ids))
+            elif not pdbtools.SCIPY_PRESENT:
+                raise ImportError("Scipy is required to combine nearby "
+                                  "residues from multiple models.")
+            else:
+                min_frequency = _min_contact_frequency(windows)
+                residue_ids, indptr, indices, frequency = (
+                    self.contact_frequencies(radius, atom))
+                indptr, indices = pdbtools.filter_nearby_arrays(
+                    indptr, indices, frequency >= min_frequency)
+                self._nearby_arrays[parameter_key] = (residue_ids, indptr,
+                                                      indices)
+        return self._nearby_arrays[parameter_key]
+
+    def model_coords(self):
+        '''Get atom coordinates for every model in the structure, matched to
+        the atoms of the first model (see `atoms`). Coordinates are read
+        when first required, and reused thereafter.
+
+        Returns:
+            np.array: An (n_models, n_atoms, 3) array of atom coordinates,
+                with NaN for atoms missing from a model.
+        '''
+        if self._model_coords is None:
+            if self._atoms.n_models == 1:
+                self._model_coords = self._atoms.coords[np.newaxis]
+            else:
+                with open_if_string(self.pdb_file(), 'r') as f:
+                    self._model_coords = readers.read_model_coords(
+                        f, self._atoms, self._mmcif)
+        return self._model_coords
+
+    def contact_frequencies(self, radius=15, atom='all'):
+        '''Find nearby residues for every model in the structure, along with
+        the fraction of models in which each pair of residues is in contact.
+        This can be used to weight residues within each window.
+
+        Args:
+            radius (int/float): Radius within which to find nearby residues for
+                each residue in the structure.
+            atom (str): The atom with which to compute distances. See
+                `nearby` for details.
+
+        Returns:
+            list: Residue ids (chain id, residue id) for all residues.
+            np.array: Index into `indices` of the first nearby residue for each
+                residue.
+            np.array: Indices (into the list of residue ids) of residues that
+                are nearby in any model.
+            np.array: Fraction of models in which each residue in `indices`
+                is nearby.
+        '''
+        parameter_key = (radius, atom)
+        if parameter_key not in self._contact_frequencies:
+            self._contact_frequencies[parameter_key] = (
+                pdbtools.contact_frequencies(self._atoms, self.model_coords(),
+                                             radius, atom))
+        return self._contact_frequencies[parameter_key]
+
+    def residue_table(self):
+        '''Get a table of per-residue properties for the first model in the
+        structure. The table is built when first required, and reused
+        thereafter.
+
+        Returns:
+            ResidueTable: Table of per-residue properties, with residues
+                identified by an integer row index.
+        '''
+        if self._residue_table is None:
+            self._residue_table = ResidueTable.from_atoms(self._atoms)
+        return self._residue_table
+
+    def residue_table_column(self, column, method=None, rows=None):
+        '''Get a column from the residue table, calculating values if needed.
+
+        The `rsa`, `ss` and `seq_position` columns are calculated the first
+        time they are requested (or if a different method is requested).
+
+        Args:
+            column (str): Column name. See
+                residue_table.RESIDUE_TABLE_DTYPE for available columns.
+            method (str, optional): For the `rsa` and `ss` columns, the
+                method used to calculate values. Defaults to RSA_METHOD and
+                SS_METHOD respectively.
+            rows (np.array, optional): Row indices to select, with -1
+                indicating a missing row. Defaults to all rows.
+
+        Returns:
+            np.array: Column values.
+        '''
+        table = self.residue_table()
+        if column == 'rsa':
+            method = RSA_METHOD if method is None else method
+            if table.methods.get(column) != method:
+                model = self[sorted(self.models)[0]]
+                table.set_column(column, {
+                    (chain.get_id(), res_id): value for chain in model for
+                    res_id, value in chain.rel_solvent_access(method).items()},
+                                 method)
+        elif column == 'ss':
+            method = SS_METHOD if method is None else method
+            if table.methods.get(column) != method:
+                model = self[sorted(self.models)[0]]
+                table.set_column(column, {
+                    (chain.get_id(), res_id): value for chain in model for
+                    res_id, value in
+                    chain.secondary_structure(method=method).items()}, method)
+        elif column == 'seq_position' and column not in table.methods:
+            table.set_column(column, {value: key[1] for key, value in
+                                      self._seq_index_to_residue_id().items()})
+        if rows is None:
+            return table[column]
+        return table.column(column, rows)
+
+    def residue_mask(self, residue_ids, rsa_range=None, rsa_method=None,
+                     bfactor_range=None, secondary_structure=None,
+                     ss_method=None):
+        '''Create a boolean mask indicating which residues satisfy a set of
+        per-residue property filters. Properties are taken from the first
+        model in the structure.
+
+        Residues for which a property can't be calculated are excluded by any
+        filter on that property.
+
+        Args:
+            residue_ids (list): Residue ids (chain id, residue id) to test.
+            rsa_range (tuple, optional): A tuple giving (minimum, maximum)
+                values of relative solvent accessibility (inclusive).
+            rsa_method (str, optional): Method used to calculate relative
+                solvent accessibility. Defaults to RSA_METHOD.
+            bfactor_range (tuple, optional): A tuple giving (minimum, maximum)
+                values of the mean B-factor for all atoms in each residue
+                (inclusive). For predicted structures, the B-factor column
+                will often contain a confidence score such as pLDDT.
+            secondary_structure (str/list, optional): Secondary structure
+                codes to keep (eg. 'HGI' or ['E']). See
+                `Chain.secondary_structure` for a list of codes.
+            ss_method (str, optional): Method used to assign secondary
+                structure. Defaults to SS_METHOD.
+
+        Returns:
+            np.array: A boolean array, positionally matched to `residue_ids`.
+        '''
+        rows = self.residue_table().index(residue_ids)
+        mask = rows >= 0
+        # Comparisons with NaN (missing values) are always False.
+        if rsa_range:
+            values = self.residue_table_column('rsa', rsa_method, rows)
+            mask &= (values >= rsa_range[0]) & (values <= rsa_range[1])
+        if bfactor_range:
+            values = self.residue_table_column('bfactor', rows=rows)
+            mask &= (values >= bfactor_range[0]) & (values <= bfactor_range[1])
+        if secondary_structure:
+            values = self.residue_table_column('ss', ss_method, rows)
+            mask &= np.isin(values, list(secondary_structure))
+        return mask
+
     def map(self, data, method='default', ref=None, radius=15, selector='all',
-            rsa_range=None, map_to_dna=False, method_params=None):
+            rsa_range=None, map_to_dna=False, method_params=None,
+            rsa_method=None, bfactor_range=None, secondary_structure=None,
+            ss_method=None, windows=None, stats=None):
         '''Perform a mapping of some parameter or function to a pdb structure,
         with the ability to apply the function over a '3D sliding window'.
 
@@ -448,13 +1401,38 @@ class Structure(object):
             method_params (dict): Additional parameters to pass to a data
                 aggregation method. Dictionary keys/values are function keyword
                 arguments and associated values.
+            rsa_method (str, optional): Method used to calculate relative
+                solvent accessibility when filtering with `rsa_range`. Either
+                'dssp' or 'shrake-rupley'. Defaults to RSA_METHOD.
+            bfactor_range (tuple, optional): A tuple giving (minimum, maximum)
+                values of mean residue B-factor with which to filter all
+                residues on, in the same manner as `rsa_range`. For predicted
+                structures this can be used to filter on pLDDT.
+            secondary_structure (str/list, optional): Secondary structure
+                codes (eg. 'HGI') with which to filter all residues on, in the
+                same manner as `rsa_range`.
+            ss_method (str, optional): Method used to assign secondary
+                structure when filtering with `secondary_structure`. Either
+                'dssp' or 'kabsch-sander'. Defaults to SS_METHOD.
+            windows (str/float, optional): For structures with multiple
+                models (eg. NMR ensembles), how to combine 3D windows from all
+                models. Either 'union' (residues nearby in any model),
+                'intersection' (residues nearby in every model), or a minimum
+                fraction of models in which residues must be nearby (eg. 0.5).
+                By default, only the first model is used.
+            stats (bool/instrument.MapStats, optional): Set True (or pass a
+                MapStats object) to record the time taken for each stage of
+                the mapping, external processes run, cache hits and misses,
+                and the size and time taken for each 3D window. Statistics
+                are attached to the returned DataMap as `stats`. See
+                biostructmap.instrument for details. Disabled by default.
 
         Returns:
             biostructmap.DataMap: A dictionary-like object which contains mapped
-                values for each residue (key). This object extends the standard
-                dict type, adding methods to allow writing of data to PDB
-                B-factor columns for easy viewing using Pymol or other similar
-                programs.
+                values for each residue (key). This object provides a
+                read-only dict interface, as well as methods to allow writing
+                of data to PDB B-factor columns for easy viewing using Pymol or
+                other similar programs, and export of values as a NumPy array.
         '''
         #Note: This method attempts to deal with 3 different ways of identifying
         #residue position: i) Within a PDB file, residues are labelled with a
@@ -466,41 +1444,99 @@ class Structure(object):
         #residue in the sequence is numbering '1', and incrementing from there.
         #iii) Residue numbering according to a reference sequence provided, or
         #according to a dna sequence (which could include introns).
-        if method in mapping_methods:
-            method = mapping_methods[method]
+        if stats is True:
+            stats = instrument.MapStats()
+        elif not stats:
+            stats = None
+        with instrument.collecting(stats), instrument.stage('map'):
+            if method in mapping_methods:
+                method = mapping_methods[method]
+
+            if method_params is None:
+                method_params = {}
+
+            if map_to_dna and ref is None:
+                raise ValueError("Must provide a reference DNA sequence if "\
+                                 "you are mapping to DNA.")
+            elif ref is None:
+                ref = self.sequences
+
+            # Generate a map of nearby residues for each residue in pdb file.
+            # Numbering is according to pdb residue numbering from file
+            if rsa_range or bfactor_range or secondary_structure:
+                # Residues excluded by a filter are removed from all windows,
+                # and have no value (None) themselves.
+                with instrument.stage('nearby'):
+                    residue_ids, indptr, indices = self.nearby_arrays(
+                        radius, selector, windows)
+                with instrument.stage('filters'):
+                    mask = self.residue_mask(residue_ids, rsa_range,
+                                             rsa_method, bfactor_range,
+                                             secondary_structure, ss_method)
+                    residue_map = pdbtools.nearby_arrays_to_dict(
+                        residue_ids, indptr, indices, mask)
+            else:
+                with instrument.stage('nearby'):
+                    residue_map = self.nearby(radius=radius, atom=selector,
+                                              windows=windows)
+
+            results = self._map_windows(residue_map, data, method, ref,
+                                        map_to_dna, method_params)
+            params = {'radius':radius, 'selector': selector}
+            if windows is not None:
+                params['windows'] = windows
+            with instrument.stage('datamap'):
+                datamap = DataMap(results, structure=self, params=params)
+        datamap.stats = stats
+        return datamap
+
+    def _map_windows(self, residue_map, data, method, ref, map_to_dna=False,
+                     method_params=None):
+        '''Apply a mapping function to the 3D window around each residue. See
+        `map` for details.
 
+        Args:
+            residue_map (dict): A set of nearby residues (or None, if the
+                residue has been filtered) for each residue.
+            data (dict/object): Data to be mapped over structure.
+            method (function): Mapping function.
+            ref (dict): A reference sequence for each chain.
+            map_to_dna (bool, optional): Set True if reference sequences are
+                DNA sequences.
+            method_params (dict, optional): Additional keyword arguments for
+                the mapping function.
+        Returns:
+            dict: Mapped value for each residue.
+        '''
         if method_params is None:
             method_params = {}
-
-        if map_to_dna and ref is None:
-            raise ValueError("Must provide a reference DNA sequence if you "\
-                             "are mapping to DNA.")
-        elif ref is None:
-            ref = self.sequences
-
-        # Generate a map of nearby residues for each residue in pdb file.
-        # Numbering is according to pdb residue numbering from file
-        residue_map = self.nearby(radius=radius, atom=selector)
-
         # Map pdb numbering by file to the reference sequence
         # (dna or protein) provided, as long as the residues exists within the PDB
         # structure (ie has coordinates)
-        pdbnum_to_ref = self._map_pdb_numbering_to_reference(ref, map_to_dna)
-       
+        with instrument.stage('reference_numbering'):
+            pdbnum_to_ref = self._map_pdb_numbering_to_reference(ref,
+                                                                 map_to_dna)
+
         results = {}
+        # Individual windows are only timed if instrumentation is enabled.
+        stats = instrument.active()
 
         #For each residue within the sequence, apply a function and return result.
-        for residue in residue_map:
-            if rsa_range:
-                residues = self._filter_rsa(residue_map[residue], rsa_range)
-                if residue not in residues:
+        with instrument.stage('windows'):
+            for residue, residues in residue_map.items():
+                if residues is None:
                     results[residue] = None
                     continue
-            else:
-                residues = residue_map[residue]
-            results[residue] = method(self, data, residues, pdbnum_to_ref, **method_params)
-        params = {'radius':radius, 'selector': selector}
-        return DataMap(results, structure=self, params=params)
+                if stats is None:
+                    results[residue] = method(self, data, residues,
+                                              pdbnum_to_ref, **method_params)
+                else:
+                    start = time.perf_counter()
+                    results[residue] = method(self, data, residues,
+                                              pdbnum_to_ref, **method_params)
+                    stats.add_window(residue, len(residues),
+                                     time.perf_counter() - start)
+        return results
 
     def _map_pdb_numbering_to_reference(self, ref, map_to_dna=False):
         '''Create a lookup dictionary mapping PDB numbering as given by Biopython to
@@ -515,17 +1551,32 @@ class Structure(object):
         Returns:
             dict: A map of PDB numbering (key) to reference sequence index (value)
         '''
-        # Use the first model. Will be the only model unless it's an NMR structure.
-        model = self[sorted(self.models)[0]]
+        # Alignments are memoised, as they may require running BLAST.
+        ref_key = (tuple(sorted((chain_id, str(getattr(seq, 'seq', seq))) for
+                                chain_id, seq in ref.items())), map_to_dna)
+        if ref_key in self._reference_numbering:
+            instrument.count('cache.reference_numbering.hit')
+        else:
+            instrument.count('cache.reference_numbering.miss')
+            self._reference_numbering[ref_key] = self._align_to_reference(
+                ref, map_to_dna)
+        return self._reference_numbering[ref_key]
+
+    def _align_to_reference(self, ref, map_to_dna=False):
+        '''Align PDB sequences to reference sequences, and map PDB numbering
+        to the indices of each reference sequence. See
+        `_map_pdb_numbering_to_reference`.
+
+        Args:
+            ref (dict): A dictionary of reference sequences accessed by chain ID.
+            map_to_dna (bool, optional): Set to true if reference sequences are
+                DNA sequences.
+        Returns:
+            dict: A map of PDB numbering (key) to reference sequence index (value)
+        '''
         # Create a map of pdb sequence index (1-indexed) to pdb residue
         # numbering from file
-        is_mmcif = self._mmcif
-        if is_mmcif:
-            mmcif_dict = self.mmcif_dict()
-            _, seq_index_to_pdb_numb = mmcif_sequence_to_res_id(mmcif_dict)
-        else:
-            seq_index_to_pdb_numb = match_pdb_residue_num_to_seq(model,
-                                                                 self.sequences)
+        seq_index_to_pdb_numb = self._seq_index_to_residue_id()
 
         pdb_index_to_ref = {}
         # For each protein chain, map provided reference sequence to PDB residue identifier.
@@ -548,34 +1599,68 @@ class Structure(object):
                          pdb_index_to_ref if x in seq_index_to_pdb_numb}
         return pdbnum_to_ref
 
-    def _filter_rsa(self, residues, rsa_range):
+    def _seq_index_to_residue_id(self):
+        '''Map the index of each residue within PDB sequences (1-indexed) to
+        the residue id, for residues in the first model. The index is built
+        once, and shared by everything that requires sequence numbering.
+
+        Returns:
+            dict: Residue id (chain id, residue id), accessed by (chain id,
+                sequence index).
         '''
-        Function to remove residues with relative solvent accessibility
-        values outside the requested range.
+        if self._seq_index is None:
+            if self._mmcif:
+                # The mmCIF sequence index (label_seq_id) is read with the
+                # atoms.
+                self._seq_index = {
+                    (residue_id[0], seq_id): residue_id for residue_id, seq_id
+                    in zip(self._atoms.residue_ids,
+                           self._atoms.seq_ids.tolist()) if seq_id >= 0}
+            else:
+                # Uses the first model. Will be the only model unless it's an
+                # NMR structure.
+                self._seq_index = pdbtools.residue_ids_by_seq_index(
+                    self._atoms, self.sequences)
+        return self._seq_index
 
-        If a residue solvent accessibility cannot be calculated by DSSP,
-        then that residue is ignored.
 
-        Args:
-            residues (list): List of residues to filter.
-            rsa_range (list/tuple): A tuple/list of the form (min, max),
-                that gives the minimum and maximum relative solvent
-                accessibility values with which to filter residues. Note that
-                these values should be between 0 and 1.
+class _LazyWrappers(Mapping):
+    '''A read-only dictionary of Model or Chain objects, accessed by id.
 
-        Returns:
-            list: A list of residues (int) that have a relative solvent
-                accessibility within the required range (inclusive).
+    Each object wraps a child of a Bio.PDB entity, and is only created when
+    first accessed. This avoids creating objects for models and chains that
+    are never used (eg. in large NMR ensembles).
+    '''
+    def __init__(self, parent, entity, wrapper):
+        '''Initialise a _LazyWrappers object.
+
+        Args:
+            parent (Structure/Model): Parent of the wrapper objects.
+            entity (Bio.PDB.Entity.Entity): Bio.PDB Structure or Model object,
+                whose children are wrapped.
+            wrapper (type): Class used to wrap each child (Model or Chain).
         '''
-        first_model = sorted(self.models)[0]
-        filtered_residues = []
-        for residue in residues:
-            chain_id = residue[0]
-            rsa = self[first_model][chain_id].rel_solvent_access()
-            if (residue[1] in rsa and rsa[residue[1]] is not None and
-                    rsa_range[0] <= rsa[residue[1]] <= rsa_range[1]):
-                filtered_residues.append(residue)
-        return filtered_residues
+        self._parent = parent
+        self._entity = entity
+        self._wrapper = wrapper
+        self._wrapped = {}
+
+    def __getitem__(self, key):
+        if key not in self._wrapped:
+            if key not in self._entity:
+                raise KeyError(key)
+            self._wrapped[key] = self._wrapper(self._parent, self._entity[key])
+        return self._wrapped[key]
+
+    def __iter__(self):
+        for child in self._entity:
+            yield child.get_id()
+
+    def __len__(self):
+        return len(self._entity)
+
+    def __contains__(self, key):
+        return key in self._entity
 
 
 class Model(object):
@@ -587,7 +1672,7 @@ class Model(object):
             PDB file. Otherwise set to an empty dict. This is because the DSSP
             program will only read the first model in a PDB file.
         chains (dict): Dictionary of all chains within model, accessed by chain
-            id.
+            id. Chain objects are created when first accessed.
     '''
     def __init__(self, structure, model):
         '''Initialise A PDB Model object.
@@ -599,9 +1684,11 @@ class Model(object):
         self._id = model.get_id()
         self.model = model
         self._parent = structure
-        self.chains = {chain.get_id():Chain(self, chain) for
-                       chain in self.model}
+        self.chains = _LazyWrappers(self, model, Chain)
         self._dssp = None # May not need this, so don't compute unless needed.
+        self._dssp_data = None
+        self._shrake_rupley = None
+        self._kabsch_sander = None
 
     def __iter__(self):
         '''Iterate over all chains in model'''
@@ -613,32 +1700,102 @@ class Model(object):
         return self.chains[key]
 
     def dssp(self):
-        '''Get DSSP object'''
-        if self._dssp is not None:
-            return self._dssp
-        #DSSP only works on the first model in the PDB file
-        if isinstance(self._parent.pdb_file(), str) and self._id == 0:
-            try:
-                self._dssp = DSSP(self.model, self._parent.pdb_file())
-            except OSError:
-                self._dssp = DSSP(self.model, self._parent.pdb_file(),
-                                  dssp="mkdssp")
-        elif self._id == 0:
-            if self._parent._mmcif:
-                suffix = '.cif'
+        '''Get DSSP object. DSSP is run when first required.
+
+        Returns:
+            Bio.PDB.DSSP: DSSP object for the model, or an empty dict if not
+                the first model.
+        '''
+        if self._dssp is None:
+            #DSSP only works on the first model in the PDB file
+            if self._id == 0:
+                self._dssp = self._run_dssp()
             else:
-                suffix = '.pdb'
-            with NamedTemporaryFile(mode='w', suffix=suffix) as temp_pdb_file:
-                temp_pdb_file.write(self._parent.pdb_file().read())
-                temp_pdb_file.flush()
+                self._dssp = {}
+        return self._dssp
+
+    def _dssp_results(self):
+        '''Get DSSP results for the model.
+
+        Results are cached on disk if USE_DSSP_CACHE is True, keyed by a hash
+        of the model coordinates. A cache hit avoids both writing the
+        structure to a temporary file and running DSSP.
+
+        Returns:
+            dict: DSSP results (tuple) for each residue, accessed by
+                (chain id, residue id). Empty if not the first model.
+        '''
+        if self._dssp_data is not None:
+            return self._dssp_data
+        dssp_cache = None
+        if USE_DSSP_CACHE and self._id == 0:
+            dssp_cache = DiskCache('dssp', max_entries=DSSP_CACHE_SIZE)
+            cache_key = pdbtools.model_coordinate_hash(self.model)
+            self._dssp_data = dssp_cache.get(cache_key)
+        if self._dssp_data is None:
+            dssp = self.dssp()
+            self._dssp_data = {key: tuple(dssp[key]) for key in dssp.keys()}
+            if dssp_cache is not None:
+                dssp_cache.set(cache_key, self._dssp_data)
+        return self._dssp_data
+
+    def _run_dssp(self):
+        '''Run DSSP on the model.
+
+        Returns:
+            Bio.PDB.DSSP: DSSP object for the model.
+        '''
+        instrument.count('process.dssp')
+        with instrument.stage('dssp'):
+            if isinstance(self._parent.pdb_file(), str):
                 try:
-                    self._dssp = DSSP(self.model, temp_pdb_file.name)
+                    dssp = DSSP(self.model, self._parent.pdb_file())
                 except OSError:
-                    self._dssp = DSSP(self.model, temp_pdb_file.name,
-                                      dssp="mkdssp")
-        else:
-            self._dssp = {}
-        return self._dssp
+                    dssp = DSSP(self.model, self._parent.pdb_file(),
+                                dssp="mkdssp")
+            else:
+                if self._parent._mmcif:
+                    suffix = '.cif'
+                else:
+                    suffix = '.pdb'
+                # DSSP requires a file name, so the file is copied (in chunks)
+                # only when DSSP is run.
+                with NamedTemporaryFile(mode='w', suffix=suffix) as temp_pdb_file:
+                    shutil.copyfileobj(self._parent.pdb_file(), temp_pdb_file)
+                    temp_pdb_file.flush()
+                    try:
+                        dssp = DSSP(self.model, temp_pdb_file.name)
+                    except OSError:
+                        dssp = DSSP(self.model, temp_pdb_file.name,
+                                    dssp="mkdssp")
+        return dssp
+
+    def shrake_rupley(self):
+        '''Calculate relative solvent accessibility for the model using the
+        Shrake-Rupley algorithm. Unlike DSSP, this does not require an
+        external program, and can be used with any model.
+
+        Returns:
+            dict: Relative solvent accessibility (float) for each standard
+                amino acid residue, accessed by (chain id, residue id).
+        '''
+        if self._shrake_rupley is None:
+            self._shrake_rupley = sasa.relative_solvent_accessibility(self.model)
+        return self._shrake_rupley
+
+    def kabsch_sander(self):
+        '''Assign secondary structure for the model using a built-in
+        implementation of the Kabsch & Sander algorithm used by DSSP. Unlike
+        DSSP, this does not require an external program, and can be used with
+        any model.
+
+        Returns:
+            dict: Secondary structure code (str) for each residue with a
+                complete backbone, accessed by (chain id, residue id).
+        '''
+        if self._kabsch_sander is None:
+            self._kabsch_sander = secstruct.assign_secondary_structure(self.model)
+        return self._kabsch_sander
 
     def parent(self):
         '''Get parent Structure object'''
@@ -684,6 +1841,7 @@ class Chain(object):
             self.sequence = pdbtools.get_pdb_seq_from_atom(chain)
             self._parent.parent().sequences[self.get_id()] = self.sequence
         self._rsa = {}
+        self._secondary_structure = {}
 
     def __iter__(self):
         '''Iterate over all residues in the chain'''
@@ -702,26 +1860,54 @@ class Chain(object):
         '''Get chain ID'''
         return self._id
 
-    def rel_solvent_access(self):
-        '''Use Bio.PDB DSSP tools to calculate relative solvent accessibility.
+    def rel_solvent_access(self, method=None):
+        '''Calculate relative solvent accessibility for each residue.
+
+        If DSSP is requested but cannot be run, then a warning is given and
+        values are calculated using the Shrake-Rupley method instead.
+
+        Args:
+            method (str, optional): Either 'dssp', which uses Bio.PDB DSSP
+                tools, or 'shrake-rupley', which calculates solvent
+                accessibility directly from atom coordinates. Defaults to
+                RSA_METHOD.
 
         Returns:
             dict: A dictionary with RSA values for each residue (key).
         '''
-        if not self._rsa:
+        if method is None:
+            method = RSA_METHOD
+        if method not in RSA_METHODS:
+            raise ValueError("Unknown RSA method '{method}'. Valid options "
+                             "are: {options}".format(
+                                 method=method, options=', '.join(RSA_METHODS)))
+        if method not in self._rsa:
+            if method == 'dssp':
+                try:
+                    model_rsa = {key: value[3] for key, value in
+                                 self._parent._dssp_results().items()}
+                except OSError as error:
+                    warnings.warn("Unable to run DSSP ({error}). Calculating "
+                                  "relative solvent accessibility using the "
+                                  "Shrake-Rupley method instead.".format(
+                                      error=error))
+                    model_rsa = self._parent.shrake_rupley()
+            else:
+                model_rsa = self._parent.shrake_rupley()
             rsa = {}
             for residue in self.chain:
                 key = (self.get_id(), residue.get_id())
-                if key in self.dssp():
+                if key in model_rsa:
                     try:
-                        rsa[key[1]] = float(self.dssp()[key][3])
+                        rsa[key[1]] = float(model_rsa[key])
                     except ValueError:
                         rsa[key[1]] = None
-            self._rsa = rsa
-        return self._rsa
+            self._rsa[method] = rsa
+        return self._rsa[method]
 
-    def secondary_structure(self, numeric_ss_code=False):
-        '''Use DSSP to calculate secondary structure elements.
+    def secondary_structure(self, numeric_ss_code=False, method=None):
+        '''Calculate secondary structure elements using DSSP or the built-in
+        Kabsch & Sander method.
 
         Notes:
             Secondary structure assignment notation follows that of the DSSP
@@ -756,16 +1942,42 @@ class Chain(object):
             These are provided in pdbtools.SS_LOOKUP_DICT, as well as the
             reverse lookups (i.e. {0: 'H', ...}).
 
+            If DSSP is requested but cannot be run, then a warning is given
+            and the built-in method is used instead.
+
         Args:
             numeric_ss_code (bool): Return secondary structure elements as a
                 numeric lookup code if True. Set to False by default.
+            method (str, optional): Either 'dssp' or 'kabsch-sander'.
+                Defaults to SS_METHOD.
 
         Returns:
             dict: A dictionary with secondary structure assignment (value)
                 for each residue (key) within the chain.
         '''
-        keys = [x for x in self.dssp().keys() if x[0] == self._id]
-        ss_dict = {x[1]: self.dssp().property_dict[x][2] for x in keys}
+        if method is None:
+            method = SS_METHOD
+        if method not in SS_METHODS:
+            raise ValueError("Unknown secondary structure method '{method}'. "
+                             "Valid options are: {options}".format(
+                                 method=method, options=', '.join(SS_METHODS)))
+        if method not in self._secondary_structure:
+            if method == 'dssp':
+                try:
+                    model_ss = {key: value[2] for key, value in
+                                self._parent._dssp_results().items()}
+                except OSError as error:
+                    warnings.warn("Unable to run DSSP ({error}). Assigning "
+                                  "secondary structure using the built-in "
+                                  "Kabsch & Sander method instead.".format(
+                                      error=error))
+                    model_ss = self._parent.kabsch_sander()
+            else:
+                model_ss = self._parent.kabsch_sander()
+            self._secondary_structure[method] = {
+                key[1]: value for key, value in model_ss.items()
+                if key[0] == self._id}
+        ss_dict = self._secondary_structure[method]
         if numeric_ss_code:
             return {key:SS_LOOKUP_DICT[item] for key, item in ss_dict.items()}
         else:
@@ -787,30 +1999,6 @@ class Chain(object):
             raise TypeError("Can't map to atom serial with mmcif file!")
         return mapping
 
-    def _filter_rsa(self, residues, rsa_range):
-        '''
-        Function to remove residues with relative solvent accessibility
-        values outside the requested range.
-
-        If a residue solvent accessibility cannot be calculated by DSSP,
-        then that residue is ignored.
-
-        Args:
-            residues (list): List of residues to filter.
-            rsa_range (list/tuple): A tuple/list of the form (min, max),
-                that gives the minimum and maximum relative solvent
-                accessibility values with which to filter residues. Note that
-                these values should be between 0 and 1.
-
-        Returns:
-            list: A list of residues (int) that have a relative solvent
-                accessibility within the required range (inclusive).
-        '''
-        rsa = self.rel_solvent_access()
-        filtered_residues = [x for x in residues if rsa.get(x, None) and
-                             rsa_range[0] <= rsa[x] <= rsa_range[1]]
-        return filtered_residues
-
 
 class SequenceAlignment(object):
     '''A class to hold a multiple sequence alignment object.
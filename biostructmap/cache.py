@@ -0,0 +1,160 @@
+"""A simple persistent cache for results of expensive calculations.
+
+Part of the biostructmap package.
+
+Entries are stored as individual pickle files under `CACHE_DIR`, grouped by
+namespace. The cache directory can be set using the BIOSTRUCTMAP_CACHE_DIR
+environment variable, or by setting `biostructmap.cache.CACHE_DIR` directly.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import pickle
+import tempfile
+import warnings
+from . import instrument
+
+# Bump this if the format of cached values changes.
+CACHE_VERSION = 1
+
+def _default_cache_dir():
+    '''Get the default cache directory, following the XDG convention.'''
+    if 'BIOSTRUCTMAP_CACHE_DIR' in os.environ:
+        return os.environ['BIOSTRUCTMAP_CACHE_DIR']
+    base_dir = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base_dir, 'biostructmap')
+
+CACHE_DIR = _default_cache_dir()
+
+
+class DiskCache(object):
+    '''A persistent key-value store, with one pickle file per entry.
+
+    Once the number of entries exceeds `max_entries`, the least recently used
+    entries are removed. Failure to read or write the cache is never fatal -
+    a missing or unreadable entry is treated as a cache miss.
+
+    Attributes:
+        namespace (str): Name of the subdirectory used for these entries.
+        path (str): Directory holding cache entries for this namespace.
+        max_entries (int): Maximum number of entries to keep.
+    '''
+    def __init__(self, namespace, max_entries=256, cache_dir=None):
+        '''Initialise a DiskCache object.
+
+        Args:
+            namespace (str): Name of the subdirectory used for these entries.
+            max_entries (int, optional): Maximum number of entries to keep.
+            cache_dir (str, optional): Base cache directory. Defaults to
+                CACHE_DIR.
+        '''
+        if cache_dir is None:
+            cache_dir = CACHE_DIR
+        self.namespace = namespace
+        self.path = os.path.join(cache_dir, namespace)
+        self.max_entries = max_entries
+
+    def _entry_path(self, key):
+        '''Get the file path for a given key.'''
+        key_string = '{version}:{key}'.format(version=CACHE_VERSION, key=key)
+        digest = hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key, default=None):
+        '''Retrieve a cached value.
+
+        Args:
+            key (str): Cache key.
+            default (optional): Value to return if key is not in the cache.
+
+        Returns:
+            Cached value, or `default` if not found.
+        '''
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError):
+            instrument.count('cache.{0}.miss'.format(self.namespace))
+            return default
+        except Exception:
+            # A corrupt entry, or one pickled by an incompatible version of
+            # biostructmap (unpickling can raise almost anything). Remove it
+            # so that it is replaced on the next `set`.
+            instrument.count('cache.{0}.miss'.format(self.namespace))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+        instrument.count('cache.{0}.hit'.format(self.namespace))
+        # Mark as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        '''Store a value in the cache, evicting old entries if required.
+
+        Args:
+            key (str): Cache key.
+            value: Any picklable object.
+        '''
+        path = self._entry_path(key)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partially written entry.
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.path,
+                                                          suffix='.tmp')
+            with os.fdopen(file_descriptor, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except (IOError, OSError) as error:
+            warnings.warn("Unable to write to biostructmap cache at {path}: "
+                          "{error}".format(path=self.path, error=error))
+            return
+        self._evict()
+
+    def clear(self):
+        '''Remove all entries from the cache.'''
+        for entry_path in self._entry_paths():
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+    def _entry_paths(self):
+        '''List the file paths of all entries in the cache.'''
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return [os.path.join(self.path, name) for name in names
+                if name.endswith('.pkl')]
+
+    def _evict(self):
+        '''Remove least recently used entries beyond `max_entries`.'''
+        entry_paths = self._entry_paths()
+        if len(entry_paths) <= self.max_entries:
+            return
+        last_used = {}
+        for entry_path in entry_paths:
+            try:
+                last_used[entry_path] = os.path.getmtime(entry_path)
+            except OSError:
+                pass
+        oldest_first = sorted(last_used, key=last_used.get)
+        for entry_path in oldest_first[:len(oldest_first) - self.max_entries]:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
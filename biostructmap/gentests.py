@@ -10,7 +10,6 @@ from math import log
 from Bio import AlignIO
 from Bio.Data import IUPACData
 from numpy import mean
-import dendropy
 
 from .seqtools import _sliding_window_var_sites, check_for_uncertain_bases
 from .population_stats import calculate_tajimas_d, calculate_nucleotide_diversity
@@ -156,6 +155,8 @@ def _tajimas_d_old(alignment):
         data = alignment
     if is_empty_alignment(alignment):
         return None
+    # DendroPy is slow to import, so is only imported for this fallback.
+    import dendropy
     try:
         seq = dendropy.DnaCharacterMatrix.get(data=data,
                                               schema='fasta')
@@ -251,6 +252,7 @@ def nucleotide_diversity_old(alignment):
         data = alignment.format('fasta')
     else:
         data = alignment
+    import dendropy
     seq = dendropy.DnaCharacterMatrix.get(data=data, schema='fasta')
     diversity = dendropy.calculate.popgenstat.nucleotide_diversity(seq)
     return diversity
@@ -329,6 +331,7 @@ def wattersons_theta_old(alignment):
         data = alignment
     if is_empty_alignment(alignment):
         return None
+    import dendropy
     seq = dendropy.DnaCharacterMatrix.get(data=data, schema='fasta')
     theta = dendropy.calculate.popgenstat.wattersons_theta(seq)
     return theta
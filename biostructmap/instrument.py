@@ -0,0 +1,281 @@
+"""Optional instrumentation of data mapping, recording where time is spent.
+
+Part of the biostructmap package. Instrumentation is enabled for a single call
+to `Structure.map` by passing `stats=True` (or a MapStats object), and results
+are attached to the returned DataMap:
+
+    data_map = structure.map(data, method='tajimasd', ref=ref, stats=True)
+    print(data_map.stats.report())
+
+While a MapStats object is collecting (see `collecting`), other parts of the
+package record events using the module-level `stage` and `count` functions.
+These do nothing when no MapStats object is collecting, so instrumentation is
+nearly free when disabled.
+
+Stages recorded by `Structure.map` are:
+    map: The whole call.
+    nearby: Finding nearby residues for each residue.
+    filters: Filtering residues by RSA, B-factor or secondary structure.
+    dssp: Running DSSP (within `filters`).
+    reference_numbering: Aligning structure sequences to reference sequences
+        (may run BLAST or Exonerate).
+    windows: Applying the mapping method to every 3D window.
+    sub_alignment: Building sub-alignments for windows (within `windows`).
+    statistic: Calculating a statistic from sub-alignments (within
+        `windows`).
+    datamap: Building the DataMap.
+Nested stages are included in the time of the enclosing stage.
+
+Counters include external processes (`process.blastp`, `process.exonerate`,
+`process.dssp`), and hits and misses of in-memory and on-disk caches (eg.
+`cache.nearby.hit`, `cache.dssp.miss`).
+"""
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import heapq
+import threading
+import time
+import numpy as np
+
+# Default number of slowest windows to keep.
+DEFAULT_N_SLOWEST = 10
+
+_state = threading.local()
+
+
+class MapStats(object):
+    '''Timings and counters recorded while mapping data over a structure.
+
+    Attributes:
+        timings (dict): Total wall time (seconds) for each stage.
+        calls (dict): Number of times each stage was entered.
+        counters (dict): Value of each counter (eg. number of external
+            processes run, cache hits and misses).
+        window_sizes (list): Number of residues in each 3D window.
+        n_slowest (int): Number of slowest windows to keep.
+        callback (function): Called for every event recorded, as
+            `callback(kind, name, value)`, where `kind` is 'stage' (with the
+            stage name and time taken), 'count' (with the counter name and
+            increment) or 'window' (with the residue id and time taken).
+            May be None.
+    '''
+    def __init__(self, n_slowest=DEFAULT_N_SLOWEST, callback=None):
+        '''Initialise a MapStats object.
+
+        Args:
+            n_slowest (int, optional): Number of slowest windows to keep.
+            callback (function, optional): A function to call for every
+                event recorded. See class attributes.
+        '''
+        self.timings = {}
+        self.calls = {}
+        self.counters = {}
+        self.window_sizes = []
+        self.n_slowest = n_slowest
+        self.callback = callback
+        self._slowest = []
+
+    def stage(self, name):
+        '''Time a stage, for use as a context manager:
+
+            with stats.stage('nearby'):
+                ...
+
+        Args:
+            name (str): Stage name. Times for repeated stages are summed.
+        Returns:
+            A context manager.
+        '''
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        '''Add to the total time for a stage.
+
+        Args:
+            name (str): Stage name.
+            seconds (float): Time taken.
+        '''
+        self.timings[name] = self.timings.get(name, 0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.callback is not None:
+            self.callback('stage', name, seconds)
+
+    def count(self, name, n=1):
+        '''Increment a counter.
+
+        Args:
+            name (str): Counter name.
+            n (int, optional): Increment.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.callback is not None:
+            self.callback('count', name, n)
+
+    def add_window(self, residue, size, seconds):
+        '''Record the size of, and time taken for, a 3D window.
+
+        Args:
+            residue (tuple): Residue id (chain id, residue id) of the central
+                residue.
+            size (int): Number of residues in the window.
+            seconds (float): Time taken to apply the mapping method.
+        '''
+        self.window_sizes.append(size)
+        item = (seconds, len(self.window_sizes), residue, size)
+        if len(self._slowest) < self.n_slowest:
+            heapq.heappush(self._slowest, item)
+        elif self._slowest and seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+        if self.callback is not None:
+            self.callback('window', residue, seconds)
+
+    @property
+    def slowest_windows(self):
+        '''list: Residue id, window size and time taken (seconds) for the
+        slowest windows, slowest first.'''
+        return [(residue, size, seconds) for seconds, _, residue, size in
+                sorted(self._slowest, reverse=True)]
+
+    def window_size_summary(self):
+        '''Summarise the distribution of 3D window sizes.
+
+        Returns:
+            dict: Number of windows (`count`), along with `min`, `median`,
+                `mean` and `max` window size (None if there are no windows).
+        '''
+        sizes = np.array(self.window_sizes)
+        if not len(sizes):
+            return {'count': 0, 'min': None, 'median': None, 'mean': None,
+                    'max': None}
+        return {'count': len(sizes), 'min': int(sizes.min()),
+                'median': float(np.median(sizes)),
+                'mean': float(sizes.mean()), 'max': int(sizes.max())}
+
+    def summary(self):
+        '''Get all recorded statistics.
+
+        Returns:
+            dict: Stage timings (`timings`) and entry counts (`calls`),
+                `counters`, a summary of window sizes (`window_sizes`, see
+                `window_size_summary`) and the slowest windows
+                (`slowest_windows`).
+        '''
+        return {'timings': dict(self.timings), 'calls': dict(self.calls),
+                'counters': dict(self.counters),
+                'window_sizes': self.window_size_summary(),
+                'slowest_windows': self.slowest_windows}
+
+    def report(self):
+        '''Format recorded statistics as text.
+
+        Returns:
+            str: A human-readable report.
+        '''
+        lines = ['Stage                  Seconds    Calls']
+        for name, seconds in sorted(self.timings.items(),
+                                    key=lambda item: -item[1]):
+            lines.append('{0:<20s} {1:9.3f} {2:8d}'.format(
+                name, seconds, self.calls[name]))
+        if self.counters:
+            lines.append('')
+            lines.append('Counter                            Value')
+            for name, value in sorted(self.counters.items()):
+                lines.append('{0:<32s} {1:7d}'.format(name, value))
+        sizes = self.window_size_summary()
+        if sizes['count']:
+            lines.append('')
+            lines.append('Window sizes: {count} windows, min {min}, median '
+                         '{median:g}, mean {mean:.1f}, max {max}'.format(
+                             **sizes))
+            lines.append('Slowest windows:')
+            for residue, size, seconds in self.slowest_windows:
+                lines.append('    {0} ({1} residues): {2:.4f} s'.format(
+                    residue, size, seconds))
+        return '\n'.join(lines)
+
+
+class _Stage(object):
+    '''Context manager that adds elapsed time to a stage of a MapStats
+    object.'''
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage(object):
+    '''Context manager that does nothing, used when instrumentation is
+    disabled.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+@contextlib.contextmanager
+def collecting(stats):
+    '''Make a MapStats object collect events recorded by `stage` and `count`
+    within the current thread, for use as a context manager. Does nothing if
+    `stats` is None.
+
+    Args:
+        stats (MapStats): Object with which to record events. May be None.
+    Yields:
+        MapStats: `stats`.
+    '''
+    if stats is None:
+        yield stats
+        return
+    previous = active()
+    _state.stats = stats
+    try:
+        yield stats
+    finally:
+        _state.stats = previous
+
+
+def active():
+    '''Get the MapStats object collecting events in the current thread.
+
+    Returns:
+        MapStats: The collecting MapStats object, or None.
+    '''
+    return getattr(_state, 'stats', None)
+
+
+def stage(name):
+    '''Time a stage, if a MapStats object is collecting.
+
+    Args:
+        name (str): Stage name.
+    Returns:
+        A context manager.
+    '''
+    stats = getattr(_state, 'stats', None)
+    if stats is None:
+        return _NULL_STAGE
+    return _Stage(stats, name)
+
+
+def count(name, n=1):
+    '''Increment a counter, if a MapStats object is collecting.
+
+    Args:
+        name (str): Counter name.
+        n (int, optional): Increment.
+    '''
+    stats = getattr(_state, 'stats', None)
+    if stats is not None:
+        stats.count(name, n)
@@ -32,7 +32,7 @@ from Bio.SeqUtils import ProtParamData
 from Bio.Data import IUPACData
 import numpy as np
 from .seqtools import _construct_sub_align_from_chains, _construct_protein_sub_align_from_chains
-from . import gentests, protein_tests
+from . import gentests, instrument, protein_tests
 
 IUPAC_3TO1_UPPER = {key.upper(): value for key, value in
                     IUPACData.protein_letters_3to1.items()}
@@ -320,11 +320,11 @@ def _map_amino_acid_scale(structure, data, residues, _ref):
     Returns:
         float: Average propensity scale score over residues within a radius.
     '''
-    first_model = sorted(structure.models)[0]
     #Get a list of all amino acids within window, converted to one letter code
-    aminoacids = [IUPAC_3TO1_UPPER.get(
-        structure[first_model][res[0]][res[1]].resname, 'X')
-                  for res in residues]
+    table = structure.residue_table()
+    #Residues missing from the structure are treated as unknown ('X').
+    aminoacids = [IUPAC_3TO1_UPPER.get(resname, 'X') for resname in
+                  table.column('resname', table.index(residues))]
     scales = {'kd': ProtParamData.kd, # Kyte & Doolittle index of hydrophobicity
               # Flexibility
               # Normalized flexibility parameters (B-values),
@@ -377,9 +377,12 @@ def _genetic_test_wrapper(_structure, alignments, residues, ref, genetic_test,
     codons = set([(chain, x[1]) for chain in chains
                   for x in ref_residues if x[0] in chain])
     #Get alignment bp from selected codons
-    sub_align = _construct_sub_align_from_chains(alignments, codons, fasta=True)
+    with instrument.stage('sub_alignment'):
+        sub_align = _construct_sub_align_from_chains(alignments, codons,
+                                                     fasta=True)
     #Compute Tajima's D using selected codons.
-    score = genetic_test(sub_align, **kwargs)
+    with instrument.stage('statistic'):
+        score = genetic_test(sub_align, **kwargs)
     return score
 
 def _protein_msa_wrapper(_structure, alignments, residues, ref, msa_function,
@@ -411,7 +414,10 @@ def _protein_msa_wrapper(_structure, alignments, residues, ref, msa_function,
     residues = set([(chain, x[1]) for chain in chains
                   for x in ref_residues if x[0] in chain])
     #Get alignment bp from selected codons
-    sub_align = _construct_protein_sub_align_from_chains(alignments, residues, fasta=True)
+    with instrument.stage('sub_alignment'):
+        sub_align = _construct_protein_sub_align_from_chains(
+            alignments, residues, fasta=True)
     #Compute something using selected alignment.
-    score = msa_function(sub_align, **kwargs)
+    with instrument.stage('statistic'):
+        score = msa_function(sub_align, **kwargs)
     return score
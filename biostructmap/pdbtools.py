@@ -4,18 +4,19 @@ Helper module for the biostructmap package.
 """
 from __future__ import absolute_import, division, print_function
 
-from collections import defaultdict
+import hashlib
+import importlib.util
+import itertools
 from Bio.SeqIO import PdbIO
 from Bio.SeqUtils import seq1
 from Bio.Data.SCOPData import protein_letters_3to1
-from Bio.PDB.Polypeptide import PPBuilder
+from Bio.PDB.Polypeptide import PPBuilder, d3_to_index
 import numpy as np
 from .seqtools import align_protein_sequences
-try:
-    from scipy.spatial import distance, cKDTree
-    SCIPY_PRESENT = True
-except ImportError:
-    SCIPY_PRESENT = False
+from .readers import AtomTable
+# Scipy is optional. It is slow to import, so is imported within the
+# functions that use it, including those in other biostructmap modules.
+SCIPY_PRESENT = importlib.util.find_spec('scipy') is not None
 
 SS_LOOKUP_DICT = {
     'H': 0,
@@ -36,21 +37,24 @@ SS_LOOKUP_DICT = {
     7: '-'
     }
 
-def _euclidean_distance_matrix(model, selector='all'):
-    """Compute the Euclidean distance matrix for all atoms in a pdb model.
+def _selected_atom_coords(model, selector='all'):
+    """Get coordinates of selected atoms from all non-HET residues in a model.
 
     Args:
-        model (Model): Bio.PDB Model object.
+        model (Model/AtomTable): Bio.PDB Model object, or an AtomTable (see
+            biostructmap.readers).
         selector (str): The atom in each residue with which to compute
             distances. The default setting is 'all', which gets all
             non-heterologous atoms. Other potential options include 'CA', 'CB'
             etc. If an atom is not found within a residue object, then method
             reverts to using 'CA'.
     Returns:
-        np.array: A euclidean distance matrix.
-        np.array: A reference list of all atoms in the model (positionally
-            matched to the euclidean matrix).
+        np.array: An array of atom coordinates.
+        list: The residue id (chain id, residue id) for each atom.
     """
+    if isinstance(model, AtomTable):
+        coords, atom_residue, residue_ids = model.select(selector)
+        return coords, [residue_ids[x] for x in atom_residue]
     reference = []
     coords = []
     # Get all non-HET residues from all chains
@@ -75,8 +79,24 @@ def _euclidean_distance_matrix(model, selector='all'):
                 continue
             coords.append(residue[select_atom].get_coord())
             reference.append(residue[select_atom].get_full_id()[2:4])
-    #Convert to a np array, and compute Euclidean distance.
-    coord_array = np.array(coords)
+    return np.array(coords), reference
+
+def _euclidean_distance_matrix(model, selector='all'):
+    """Compute the Euclidean distance matrix for all atoms in a pdb model.
+
+    Args:
+        model (Model): Bio.PDB Model object.
+        selector (str): The atom in each residue with which to compute
+            distances. The default setting is 'all', which gets all
+            non-heterologous atoms. Other potential options include 'CA', 'CB'
+            etc. If an atom is not found within a residue object, then method
+            reverts to using 'CA'.
+    Returns:
+        np.array: A euclidean distance matrix.
+        np.array: A reference list of all atoms in the model (positionally
+            matched to the euclidean matrix).
+    """
+    coord_array, reference = _selected_atom_coords(model, selector)
     euclid_mat = _pairwise_euclidean_distance(coord_array)
     ref_array = reference
     return euclid_mat, ref_array
@@ -84,6 +104,7 @@ def _euclidean_distance_matrix(model, selector='all'):
 def _pairwise_euclidean_distance(coord_array):
     '''Compute the pairwise euclidean distance matrix for a numpy array'''
     if SCIPY_PRESENT:
+        from scipy.spatial import distance
         euclid_mat = distance.pdist(coord_array, 'euclidean')
         #Convert to squareform matrix
         euclid_mat = distance.squareform(euclid_mat)
@@ -108,32 +129,9 @@ def _get_nearby_matrix(model, selector, radius):
         np.array: A reference list of all atoms in the model (positionally
             matched to the nearby matrix).
     """
-    reference = []
-    coords = []
-    # Get all non-HET residues from all chains
-    residues = [res for chain in model for res in chain if
-                res.get_id()[0] == ' ']
-    #Filter on non-HET atoms
-    for residue in residues:
-        #If selecting based on all atoms within residue
-        if selector == 'all':
-            for atom in residue:
-                coords.append(atom.get_coord())
-                reference.append(atom.get_full_id()[2:4])
-        #If measuring distance on particular atoms
-        else:
-            if selector in residue:
-                select_atom = selector
-            #Revert to carbon alpha if atom is not found
-            elif 'CA' in residue:
-                select_atom = 'CA'
-            #if CA is not found, do not include residue in distance matrix
-            else:
-                continue
-            coords.append(residue[select_atom].get_coord())
-            reference.append(residue[select_atom].get_full_id()[2:4])
-    #Convert to a np array, and use a KDTree to identify points within a certain distance.
-    coord_array = np.array(coords)
+    from scipy.spatial import cKDTree
+    coord_array, reference = _selected_atom_coords(model, selector)
+    #Use a KDTree to identify points within a certain distance.
     point_tree = cKDTree(coord_array)
     ball_tree = point_tree.query_ball_tree(point_tree, radius)
     ref_array = reference
@@ -145,7 +143,8 @@ def nearby(model, radius=15, selector='all'):
     given residue.
 
     Args:
-        model (Model): Bio.PDB Model object.
+        model (Model/AtomTable): Bio.PDB Model object, or an AtomTable (see
+            biostructmap.readers).
         radius (float/int): The radius (Angstrom) over which to select nearby
             residues
         selector (str): The atom in each residue with which to compute
@@ -161,10 +160,8 @@ def nearby(model, radius=15, selector='all'):
     ref_dict = {}
     #if SCIPY_PRESENT:
     if SCIPY_PRESENT:
-        near_map, ref = _get_nearby_matrix(model, selector, radius)
-        _ref_dict = defaultdict(set)
-        for i, x in enumerate(near_map):
-            _ref_dict[ref[i]].update({ref[y] for y in x})
+        _ref_dict = nearby_arrays_to_dict(*nearby_arrays(model, radius,
+                                                          selector))
     else:
         euclidean_distance, ref = _euclidean_distance_matrix(model, selector)
         within_radius = euclidean_distance <= radius
@@ -186,6 +183,216 @@ def nearby(model, radius=15, selector='all'):
     return _ref_dict
 
 
+def nearby_arrays(model, radius=15, selector='all'):
+    """
+    Takes a Bio.PDB model object, and find all residues within a radius of
+    each residue. Results are returned in compressed sparse row format, so
+    that nearby residues can be filtered using NumPy operations.
+
+    Args:
+        model (Model/AtomTable): Bio.PDB Model object, or an AtomTable (see
+            biostructmap.readers).
+        radius (float/int): The radius (Angstrom) over which to select nearby
+            residues
+        selector (str): The atom in each residue with which to compute
+            distances. See `nearby` for details.
+    Returns:
+        list: Residue ids (chain id, residue id) for all residues.
+        np.array: Index into `indices` of the first nearby residue for each
+            residue. Nearby residues for residue `i` are given by
+            `indices[indptr[i]:indptr[i+1]]`.
+        np.array: Indices (into the list of residue ids) of nearby residues,
+            sorted for each residue.
+    """
+    if isinstance(model, AtomTable):
+        coord_array, atom_residue, residue_ids = model.select(selector)
+    else:
+        coord_array, reference = _selected_atom_coords(model, selector)
+        residue_ids = []
+        residue_index = {}
+        atom_residue = np.empty(len(reference), dtype='int64')
+        for i, residue_id in enumerate(reference):
+            if residue_id not in residue_index:
+                residue_index[residue_id] = len(residue_ids)
+                residue_ids.append(residue_id)
+            atom_residue[i] = residue_index[residue_id]
+    n_residues = len(residue_ids)
+    if not n_residues:
+        return residue_ids, np.zeros(1, dtype='int64'), np.zeros(0, dtype='int64')
+    from scipy.spatial import cKDTree
+    pairs = cKDTree(coord_array).query_pairs(radius, output_type='ndarray')
+    first = atom_residue[pairs[:, 0]]
+    second = atom_residue[pairs[:, 1]]
+    # Every residue is within range of itself.
+    self_pairs = np.arange(n_residues)
+    first, second = (np.concatenate((first, second, self_pairs)),
+                     np.concatenate((second, first, self_pairs)))
+    encoded = np.unique(first * n_residues + second)
+    centre = encoded // n_residues
+    indices = encoded % n_residues
+    indptr = np.searchsorted(centre, np.arange(n_residues + 1))
+    return residue_ids, indptr, indices
+
+
+def contact_frequencies(atoms, model_coords, radius=15, selector='all'):
+    """
+    Find all residues within a radius of each residue, for every model in an
+    ensemble (eg. an NMR structure), and count the fraction of models in
+    which each pair of residues is in contact.
+
+    Atoms are selected once (from the first model), and coordinates for all
+    models are taken from a stacked array. Atom pairs from each model are
+    reduced to residue pairs immediately, so that memory use is that of a
+    single model.
+
+    Args:
+        atoms (AtomTable): Atoms from the first model (see
+            biostructmap.readers).
+        model_coords (np.array): An (n_models, n_atoms, 3) array of atom
+            coordinates for every model, matched to `atoms` (see
+            readers.read_model_coords). Missing atoms have NaN coordinates.
+        radius (float/int): The radius (Angstrom) over which to select nearby
+            residues.
+        selector (str): The atom in each residue with which to compute
+            distances. See `nearby` for details.
+    Returns:
+        list: Residue ids (chain id, residue id) for all residues.
+        np.array: Index into `indices` of the first nearby residue for each
+            residue.
+        np.array: Indices (into the list of residue ids) of residues that are
+            nearby in any model, sorted for each residue.
+        np.array: Fraction of models in which each residue in `indices` is
+            nearby.
+    """
+    atom_indices, atom_residue, residue_ids = atoms.select_indices(selector)
+    n_residues = len(residue_ids)
+    n_models = len(model_coords)
+    if not n_residues:
+        return (residue_ids, np.zeros(1, dtype='int64'),
+                np.zeros(0, dtype='int64'), np.zeros(0))
+    from scipy.spatial import cKDTree
+    encoded = []
+    for coords in model_coords[:, atom_indices]:
+        present = np.isfinite(coords).all(axis=1)
+        pairs = cKDTree(coords[present]).query_pairs(radius,
+                                                     output_type='ndarray')
+        present_residue = atom_residue[present]
+        first = present_residue[pairs[:, 0]]
+        second = present_residue[pairs[:, 1]]
+        # Count each residue pair once per model.
+        encoded.append(np.unique(np.concatenate((first * n_residues + second,
+                                                 second * n_residues + first))))
+    # Every residue is within range of itself, in every model.
+    self_pairs = np.arange(n_residues) * (n_residues + 1)
+    encoded.extend([self_pairs] * n_models)
+    pair_codes, counts = np.unique(np.concatenate(encoded),
+                                   return_counts=True)
+    centre = pair_codes // n_residues
+    indices = pair_codes % n_residues
+    # Self pairs are counted twice for models in which the residue is present.
+    frequency = np.minimum(counts, n_models) / n_models
+    indptr = np.searchsorted(centre, np.arange(n_residues + 1))
+    return residue_ids, indptr, indices, frequency
+
+
+def filter_nearby_arrays(indptr, indices, keep):
+    """Remove entries from nearby residue arrays (see `nearby_arrays`).
+
+    Args:
+        indptr (np.array): Index into `indices` of the first nearby residue
+            for each residue.
+        indices (np.array): Indices of nearby residues.
+        keep (np.array): Boolean array indicating entries in `indices` to
+            keep.
+    Returns:
+        np.array: Index into the filtered `indices` of the first nearby
+            residue for each residue.
+        np.array: Filtered indices of nearby residues.
+    """
+    indptr = np.concatenate(([0], np.cumsum(keep)))[indptr]
+    return indptr, indices[keep]
+
+
+def nearby_dict_to_arrays(ref_dict, residue_ids):
+    """Convert a dictionary of nearby residues (see `nearby`) to arrays in
+    the format returned by `nearby_arrays`.
+
+    Args:
+        ref_dict (dict): A set of nearby residues for each residue.
+        residue_ids (list): Residue ids (chain id, residue id) for all
+            residues.
+    Returns:
+        list: Residue ids (chain id, residue id) for all residues.
+        np.array: Index into `indices` of the first nearby residue for each
+            residue.
+        np.array: Indices (into the list of residue ids) of nearby residues,
+            sorted for each residue.
+    """
+    residue_index = {residue_id: i for i, residue_id in enumerate(residue_ids)}
+    neighbours = [sorted(residue_index[x] for x in ref_dict.get(residue_id, ()))
+                  for residue_id in residue_ids]
+    indptr = np.concatenate(([0], np.cumsum([len(x) for x in neighbours],
+                                            dtype='int64')))
+    indices = np.fromiter(itertools.chain.from_iterable(neighbours),
+                          dtype='int64', count=indptr[-1])
+    return residue_ids, indptr, indices
+
+
+def nearby_arrays_to_dict(residue_ids, indptr, indices, mask=None):
+    """Convert nearby residue arrays (see `nearby_arrays`) to a dictionary.
+
+    Args:
+        residue_ids (list): Residue ids (chain id, residue id) for all
+            residues.
+        indptr (np.array): Index into `indices` of the first nearby residue
+            for each residue.
+        indices (np.array): Indices of nearby residues.
+        mask (np.array, optional): Boolean array indicating residues to keep.
+            Masked residues are removed from all sets of nearby residues, and
+            their own value is set to None.
+    Returns:
+        dict: A dictionary containing a set of nearby residues for each
+            residue.
+    """
+    if mask is not None:
+        # Filter all neighbour lists in a single step.
+        indptr, indices = filter_nearby_arrays(indptr, indices, mask[indices])
+    ref_dict = {}
+    for i, residue_id in enumerate(residue_ids):
+        if mask is not None and not mask[i]:
+            ref_dict[residue_id] = None
+        else:
+            ref_dict[residue_id] = {residue_ids[x] for x in
+                                    indices[indptr[i]:indptr[i+1]]}
+    return ref_dict
+
+
+def model_coordinate_hash(model):
+    """Compute a hash of the atom identities and coordinates within a model.
+
+    Used as a cache key for calculations that only depend on the model
+    coordinates (such as DSSP), so that the same structure is recognised
+    regardless of file name or header content.
+
+    Args:
+        model (Model): Bio.PDB Model object.
+    Returns:
+        str: A hexadecimal SHA-1 digest.
+    """
+    identifiers = []
+    coords = []
+    for atom in model.get_atoms():
+        residue = atom.get_parent()
+        identifiers.append('{chain}|{res_id}|{resname}|{atom}'.format(
+            chain=residue.get_parent().get_id(), res_id=residue.get_id(),
+            resname=residue.get_resname(), atom=atom.get_id()))
+        coords.append(atom.get_coord())
+    digest = hashlib.sha1('\n'.join(identifiers).encode('utf-8'))
+    # Round coordinates to the precision of a PDB file.
+    digest.update(np.round(np.array(coords, dtype='float64'), 3).tobytes())
+    return digest.hexdigest()
+
+
 def mmcif_sequence_to_res_id(mmcif_dict):
     """Create a lookup from mmcif sequence id to a pdb residue ID and vice versa.
 
@@ -236,6 +443,79 @@ def mmcif_sequence_to_res_id(mmcif_dict):
     return full_id_to_poly_seq_index, poly_seq_index_to_full_id
 
 
+def _atom_coords_by_residue(atoms, name):
+    """Get coordinates of the first atom with a given name in each residue,
+    or NaN if a residue has no such atom."""
+    coords = np.full((len(atoms.residue_ids), 3), np.nan)
+    # Assign in reverse so that the first matching atom is kept.
+    matching = np.flatnonzero(atoms.names == name)[::-1]
+    coords[atoms.residue_index[matching]] = atoms.coords[matching]
+    return coords
+
+
+def build_peptides(atoms, radius=1.8):
+    """Find polypeptides (runs of standard amino acids joined by peptide
+    bonds) in an AtomTable.
+
+    Peptides are found as for Bio.PDB.Polypeptide.PPBuilder, by testing the
+    C--N distance between consecutive residues in each chain. Only the
+    alternate location with highest occupancy is tested for each atom.
+
+    Args:
+        atoms (AtomTable): Atom coordinates and identities (see
+            biostructmap.readers).
+        radius (float, optional): Maximum C--N distance for a peptide bond.
+    Returns:
+        list: Residue indices (np.array) for each polypeptide, in chain order.
+    """
+    n_residues = len(atoms.residue_ids)
+    if n_residues < 2:
+        return []
+    standard = np.isin(np.array(atoms.resnames, dtype='U'), list(d3_to_index))
+    chains = np.array([x[0] for x in atoms.residue_ids], dtype='U')
+    c_coords = _atom_coords_by_residue(atoms, 'C')
+    n_coords = _atom_coords_by_residue(atoms, 'N')
+    with np.errstate(invalid='ignore'):
+        bond_length = np.linalg.norm(c_coords[:-1] - n_coords[1:], axis=1)
+    # Residues with missing C or N atoms have a NaN bond length.
+    bonded = (standard[:-1] & standard[1:] & (chains[:-1] == chains[1:]) &
+              (bond_length < radius))
+    # Each run of bonded residue pairs is a peptide.
+    edges = np.diff(np.concatenate(([0], bonded.astype('int8'), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return [np.arange(start, end + 1) for start, end in zip(starts, ends)]
+
+
+def residue_ids_by_seq_index(atoms, ref):
+    """Match residues in an AtomTable to reference sequences, numbered by
+    index.
+
+    This gives the same result as `match_pdb_residue_num_to_seq` for the first
+    model in a structure, without requiring Bio.PDB objects.
+
+    Args:
+        atoms (AtomTable): Atom coordinates and identities (see
+            biostructmap.readers).
+        ref (dict): A dictionary containing reference protein sequences for
+            each chain in the protein structure.
+    Returns:
+        dict: A dictionary mapping reference sequence index (key) to
+            residue id (value). For example, we might have a key of ('A', 17)
+            for the 17th residue in the reference sequence for chain 'A',
+            with a value of ('A', (' ', 273, ' ')).
+    """
+    output = {}
+    for peptide in build_peptides(atoms):
+        peptide_sequence = ''.join(protein_letters_3to1.get(
+            atoms.resnames[i], 'X') for i in peptide)
+        chain_id = atoms.residue_ids[peptide[0]][0]
+        _, ref_to_pdb = align_protein_sequences(peptide_sequence, ref[chain_id])
+        for ref_pos, pdb_pos in ref_to_pdb.items():
+            output[(chain_id, ref_pos)] = atoms.residue_ids[peptide[pdb_pos - 1]]
+    return output
+
+
 def get_pdb_seq(filename):
     """
     Get a protein sequence from a PDB file.
@@ -335,6 +615,26 @@ def get_pdb_seq_from_atom(chain):
     pdb_sequence = [seq_dict[x] for x in sorted(seq_dict)]
     return ''.join([x for x in pdb_sequence])
 
+def get_seq_from_atoms(atoms):
+    """
+    Get protein sequences for each chain from atom records, as for
+    `get_pdb_seq_from_atom`, without requiring Bio.PDB objects.
+
+    Args:
+        atoms (AtomTable): Atom coordinates and identities (see
+            biostructmap.readers).
+    Returns:
+        dict: Protein sequences (str) accessed by chain id.
+    """
+    seq_dicts = {}
+    for (chain_id, residue_id), resname in zip(atoms.residue_ids,
+                                               atoms.resnames):
+        seq_dicts.setdefault(chain_id, {})[int(residue_id[1])] = seq1(
+            resname, custom_map=protein_letters_3to1)
+    return {chain_id: ''.join(seq_dict[x] for x in sorted(seq_dict)) for
+            chain_id, seq_dict in seq_dicts.items()}
+
+
 def match_pdb_residue_num_to_seq(model, ref=None):
     """Match PDB residue numbering (as given in PDB file) to
     a reference sequence (can be pdb sequence) numbered by index.
@@ -14,12 +14,21 @@ def n_choose_k(n,k):
     f = math.factorial
     return f(n) // f(k) // f(n-k)
 
-# Scipy may not be installed. If not, use our own combinatorial function.
-# Scipy implementation is slightly faster.
-try:
-    from scipy.special import comb
-except ImportError:
-    comb = n_choose_k
+# Combinatorial function, set on first use. Scipy may not be installed. If
+# not, use our own combinatorial function. Scipy implementation is slightly
+# faster, but is slow to import.
+_COMB = None
+
+def comb(n, k):
+    "Binomial Coefficient, using scipy if available."
+    global _COMB
+    if _COMB is None:
+        try:
+            from scipy.special import comb as scipy_comb
+            _COMB = scipy_comb
+        except ImportError:
+            _COMB = n_choose_k
+    return _COMB(n, k)
 
 
 def count_differences(seqs):
@@ -10,7 +10,6 @@ from math import log
 from Bio import AlignIO
 from Bio.Data import IUPACData
 from numpy import mean
-import dendropy
 
 from .seqtools import _sliding_window_var_sites
 from .gentests import _calculate_shannon_entropy
@@ -0,0 +1,708 @@
+"""Fast readers for atom coordinates in PDB and mmCIF files.
+
+Helper module for the biostructmap package. Atom records are read directly
+into NumPy arrays, without building a Bio.PDB object tree. This is sufficient
+for calculations that only require coordinates and residue identities (such as
+finding nearby residues), and is much faster than using Bio.PDB for large
+structures.
+
+Residue ids, residue order and atom selection match those given by the
+Bio.PDB parsers, so that results are interchangeable. Atoms are read from the
+first model in a file, and coordinates from other models are matched to these
+atoms (see `read_model_coords`).
+"""
+from __future__ import absolute_import, division, print_function
+
+import re
+import numpy as np
+from Bio.Data.IUPACData import protein_letters_3to1_extended
+from Bio.Data.SCOPData import protein_letters_3to1
+
+# Placeholders for unknown or inapplicable mmCIF values.
+_MMCIF_UNASSIGNED = ('.', '?')
+
+# Categories read along with the mmCIF _atom_site loop by default: polymer
+# sequences and header metadata.
+MMCIF_CATEGORIES = ('_entity_poly', '_entry', '_exptl', '_refine')
+
+# One letter codes for SEQRES residue names (as used by Bio.SeqIO.PdbIO).
+_AA3TO1 = dict(protein_letters_3to1_extended)
+_AA3TO1.update(protein_letters_3to1)
+
+# An mmCIF token: a quoted string, a comment or an unquoted value. Quotes only
+# end a string if followed by whitespace.
+_MMCIF_TOKEN = re.compile(r"'(.*?)'(?=\s|$)|\"(.*?)\"(?=\s|$)|(#.*)|(\S+)")
+
+
+class AtomTable(object):
+    '''Coordinates and identities of all atoms in the first model of a
+    structure.
+
+    Atoms are ordered as they would be when iterating over a Bio.PDB model
+    (ie. grouped by chain, then by residue). For atoms with alternate
+    locations, only the location with highest occupancy is kept, as for the
+    atom selected by Bio.PDB.
+
+    Attributes:
+        coords (np.array): An (n_atoms, 3) array of atom coordinates.
+        names (np.array): Atom names.
+        elements (np.array): Element symbols.
+        bfactors (np.array): Atom B-factors.
+        occupancies (np.array): Atom occupancies.
+        residue_index (np.array): Index (into `residue_ids`) of the residue
+            containing each atom.
+        residue_ids (list): Residue id (chain id, residue id) for each residue,
+            matching those assigned by Bio.PDB.
+        resnames (list): Residue name for each residue.
+        n_models (int): Number of models in the file.
+        seq_ids (np.array): For mmCIF files, the sequence index
+            (label_seq_id) of each residue, or -1 for residues that are not
+            part of a polymer. None for PDB files.
+    '''
+    def __init__(self, coords, names, elements, bfactors, occupancies,
+                 residue_index, residue_ids, resnames, n_models=1,
+                 seq_ids=None):
+        '''Initialise an AtomTable object.
+
+        Args:
+            coords (np.array): An (n_atoms, 3) array of atom coordinates.
+            names (np.array): Atom names.
+            elements (np.array): Element symbols.
+            bfactors (np.array): Atom B-factors.
+            occupancies (np.array): Atom occupancies.
+            residue_index (np.array): Index of the residue containing each
+                atom.
+            residue_ids (list): Residue id (chain id, residue id) for each
+                residue.
+            resnames (list): Residue name for each residue.
+            n_models (int, optional): Number of models in the file.
+            seq_ids (np.array, optional): Sequence index (label_seq_id) of
+                each residue, for mmCIF files.
+        '''
+        self.coords = coords
+        self.names = names
+        self.elements = elements
+        self.bfactors = bfactors
+        self.occupancies = occupancies
+        self.residue_index = residue_index
+        self.residue_ids = residue_ids
+        self.resnames = resnames
+        self.n_models = n_models
+        self.seq_ids = seq_ids
+
+    @classmethod
+    def from_columns(cls, columns, n_models=1):
+        '''Build an AtomTable from per-atom columns in file order.
+
+        Residues and alternate atom locations are resolved with array
+        operations, so that no per-atom Python objects are created.
+
+        Args:
+            columns (dict): Per-atom NumPy arrays, in file order. Required
+                keys are `chain`, `hetflag`, `resseq`, `icode`, `resname`,
+                `name`, `element`, `coords` (an (n_atoms, 3) array),
+                `occupancy` and `bfactor`. An optional `seq_id` array gives the
+                mmCIF sequence index (label_seq_id) of each atom.
+            n_models (int, optional): Number of models in the file.
+        Returns:
+            AtomTable: Atom table with atoms in Bio.PDB order.
+        '''
+        chain = columns['chain']
+        hetflag = columns['hetflag']
+        resseq = columns['resseq']
+        icode = columns['icode']
+        n_atoms = len(chain)
+        # Split atoms into runs of consecutive records from the same residue.
+        new_run = np.ones(n_atoms, dtype=bool)
+        new_run[1:] = ((chain[1:] != chain[:-1]) |
+                       (hetflag[1:] != hetflag[:-1]) |
+                       (resseq[1:] != resseq[:-1]) |
+                       (icode[1:] != icode[:-1]))
+        run_start = np.flatnonzero(new_run)
+        atom_run = np.cumsum(new_run) - 1
+        # Runs from the same residue are merged, as residues may be
+        # discontinuous within a file.
+        residue_rows = {}
+        run_residue = np.array(
+            [residue_rows.setdefault(key, len(residue_rows)) for key in
+             zip(chain[run_start].tolist(),
+                 zip(hetflag[run_start].tolist(), resseq[run_start].tolist(),
+                     icode[run_start].tolist()))], dtype='int64')
+        residue_ids = list(residue_rows)
+        n_residues = len(residue_ids)
+        first_run = np.empty(n_residues, dtype='int64')
+        # Assign in reverse so that the first run for each residue is kept.
+        first_run[run_residue[::-1]] = np.arange(len(run_start))[::-1]
+        first_atom = run_start[first_run]
+        atom_rows = run_residue[atom_run]
+        # Point mutations are given as alternate locations of residues with
+        # the same id but different names. As for a Bio.PDB DisorderedResidue,
+        # the residue named by the last record is used.
+        last_atom = np.empty(n_residues, dtype='int64')
+        last_atom[atom_rows] = np.arange(n_atoms)
+        resnames = columns['resname'][last_atom]
+        candidates = np.flatnonzero(columns['resname'] == resnames[atom_rows])
+        # Keep the first record for each atom, unless an alternate location
+        # has higher occupancy (lexsort is stable, so ties keep file order).
+        name_codes = np.unique(columns['name'], return_inverse=True)[1]
+        name_codes = name_codes.reshape(-1)
+        order = candidates[np.lexsort((-columns['occupancy'][candidates],
+                                       name_codes[candidates],
+                                       atom_rows[candidates]))]
+        new_atom = np.ones(len(order), dtype=bool)
+        new_atom[1:] = ((atom_rows[order][1:] != atom_rows[order][:-1]) |
+                        (name_codes[order][1:] != name_codes[order][:-1]))
+        atom_start = np.flatnonzero(new_atom)
+        kept = order[atom_start]
+        # Atoms are listed in order of their first record.
+        first_record = (np.minimum.reduceat(order, atom_start) if len(order)
+                        else atom_start)
+        # Group residues by chain, in order of first appearance.
+        _, chain_first, residue_chain = np.unique(chain[first_atom],
+                                                  return_index=True,
+                                                  return_inverse=True)
+        chain_rank = np.argsort(np.argsort(chain_first))
+        residue_order = np.argsort(chain_rank[residue_chain.reshape(-1)],
+                                   kind='stable')
+        new_rows = np.empty(n_residues, dtype='int64')
+        new_rows[residue_order] = np.arange(n_residues)
+        atom_order = np.lexsort((first_record, new_rows[atom_rows[kept]]))
+        kept = kept[atom_order]
+        first_atom = first_atom[residue_order]
+        if 'seq_id' in columns:
+            seq_ids = columns['seq_id'][first_atom]
+        else:
+            seq_ids = None
+        return cls(coords=columns['coords'][kept],
+                   names=columns['name'][kept],
+                   elements=columns['element'][kept],
+                   bfactors=columns['bfactor'][kept],
+                   occupancies=columns['occupancy'][kept],
+                   residue_index=new_rows[atom_rows[kept]],
+                   residue_ids=[residue_ids[i] for i in residue_order],
+                   resnames=resnames[residue_order].tolist(),
+                   n_models=n_models, seq_ids=seq_ids)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def select(self, selector='all'):
+        '''Select atoms from all non-HET residues, for distance calculations.
+
+        Args:
+            selector (str): The atom in each residue with which to compute
+                distances. See `select_indices`.
+        Returns:
+            np.array: An array of atom coordinates.
+            np.array: Index (into the list of residue ids) of the residue
+                containing each atom.
+            list: Residue ids (chain id, residue id) of residues with selected
+                atoms.
+        '''
+        atoms, atom_residue, residue_ids = self.select_indices(selector)
+        return self.coords[atoms], atom_residue, residue_ids
+
+    def select_indices(self, selector='all'):
+        '''Get the indices of atoms selected for distance calculations, so
+        that coordinates from other models can be used (see `select`).
+
+        Args:
+            selector (str): The atom in each residue with which to compute
+                distances. The default setting is 'all', which gets all
+                non-heterologous atoms. Other potential options include 'CA',
+                'CB' etc. If an atom is not found within a residue object, then
+                method reverts to using 'CA'.
+        Returns:
+            np.array: Indices of selected atoms.
+            np.array: Index (into the list of residue ids) of the residue
+                containing each atom.
+            list: Residue ids (chain id, residue id) of residues with selected
+                atoms.
+        '''
+        n_residues = len(self.residue_ids)
+        standard = np.array([x[1][0] == ' ' for x in self.residue_ids],
+                            dtype=bool)
+        if selector == 'all':
+            atoms = np.flatnonzero(standard[self.residue_index])
+        else:
+            selected = np.full(n_residues, -1, dtype='int64')
+            for atom_name in ('CA', selector):
+                # Assign in reverse so that the first matching atom is kept.
+                matching = np.flatnonzero(self.names == atom_name)[::-1]
+                selected[self.residue_index[matching]] = matching
+            atoms = selected[standard & (selected >= 0)]
+        residues, atom_residue = np.unique(self.residue_index[atoms],
+                                           return_inverse=True)
+        return (atoms, atom_residue.reshape(-1),
+                [self.residue_ids[x] for x in residues])
+
+
+def _float_array(values, default):
+    '''Convert strings to a float array, using `default` for invalid values.'''
+    try:
+        return np.array(values, dtype='float64')
+    except ValueError:
+        result = np.empty(len(values))
+        for i, value in enumerate(values):
+            try:
+                result[i] = float(value)
+            except ValueError:
+                result[i] = default
+        return result
+
+
+def _int_array(values, default):
+    '''Convert strings to an integer array, using `default` for invalid
+    values.'''
+    try:
+        return np.array(values, dtype='int64')
+    except ValueError:
+        result = np.empty(len(values), dtype='int64')
+        for i, value in enumerate(values):
+            try:
+                result[i] = int(value)
+            except ValueError:
+                result[i] = default
+        return result
+
+
+def _fixed_width(chars, start, end):
+    '''Get a fixed-width column from an array of characters (one row per
+    line) as a string array.'''
+    return np.ascontiguousarray(chars[:, start:end]).view(
+        'U{0}'.format(end - start)).reshape(-1)
+
+
+def _pdb_atom_columns(lines):
+    '''Extract per-atom columns from PDB ATOM/HETATM records.
+
+    Fixed-width fields are sliced from a character array, rather than parsed
+    line by line.
+
+    Args:
+        lines (list): ATOM/HETATM records (str).
+    Returns:
+        dict: Per-atom columns, as required by `AtomTable.from_columns`.
+    '''
+    chars = np.array([line.rstrip('\r\n').ljust(80)[:80] for line in lines],
+                     dtype='U80').view('U1').reshape(-1, 80)
+    fullname = _fixed_width(chars, 12, 16)
+    name = np.char.strip(fullname)
+    # Atom names with internal spaces are not stripped (as Bio.PDB).
+    name = np.where(np.char.find(name, ' ') >= 0, fullname, name)
+    resname = np.char.strip(_fixed_width(chars, 17, 20))
+    hetatm = _fixed_width(chars, 0, 6) == 'HETATM'
+    water = hetatm & np.isin(resname, ('HOH', 'WAT'))
+    hetflag = np.where(hetatm, np.char.add('H_', resname), ' ')
+    hetflag = np.where(water, 'W', hetflag)
+    # Guess missing element symbols from the atom name.
+    element = np.char.upper(np.char.strip(_fixed_width(chars, 76, 78)))
+    guessed = np.char.upper(np.char.lstrip(name, '0123456789').astype('U1'))
+    element = np.where(element == '', guessed, element)
+    # Coordinates are stored with single precision, as in Bio.PDB.
+    coords = np.stack([_fixed_width(chars, i, i + 8).astype('float64') for
+                       i in (30, 38, 46)], axis=-1)
+    return {'chain': _fixed_width(chars, 21, 22),
+            'hetflag': hetflag,
+            'resseq': _fixed_width(chars, 22, 26).astype('int64'),
+            'icode': _fixed_width(chars, 26, 27),
+            'resname': resname,
+            'name': name,
+            'element': element,
+            'coords': coords.astype('float32').astype('float64'),
+            'occupancy': _float_array(_fixed_width(chars, 54, 60), np.nan),
+            'bfactor': _float_array(_fixed_width(chars, 60, 66), 0.0)}
+
+
+def read_pdb(fileobj):
+    '''Read atom records from the first model of a PDB file, along with
+    SEQRES sequences and header metadata, in a single pass.
+
+    Args:
+        fileobj (file-like object): An open PDB file.
+    Returns:
+        AtomTable: Coordinates and identities of all atoms.
+        dict: Protein sequences (str) from SEQRES records, accessed by chain
+            id (as for pdbtools.get_pdb_seq).
+        dict: Header metadata, with keys `idcode`, `structure_method` and
+            `resolution` (None if not given).
+    '''
+    seqres = {}
+    header = {'idcode': '', 'structure_method': '', 'resolution': None}
+    atom_lines = []
+    n_models = 0
+    in_first_model = True
+    for line in fileobj:
+        record_type = line.rstrip('\r\n')[0:6]
+        if record_type in ('ATOM  ', 'HETATM'):
+            if in_first_model:
+                atom_lines.append(line)
+        elif record_type == 'SEQRES':
+            seqres.setdefault(line[11], []).extend(
+                _AA3TO1.get(res, 'X') for res in line[19:].split())
+        elif record_type == 'HEADER':
+            header['idcode'] = line[62:66].strip()
+        elif record_type == 'EXPDTA':
+            header['structure_method'] = line[10:].strip().lower()
+        elif line.startswith('REMARK   2 RESOLUTION.'):
+            try:
+                header['resolution'] = float(line[22:].split()[0])
+            except (ValueError, IndexError):
+                pass
+        elif record_type == 'MODEL ':
+            n_models += 1
+            in_first_model = n_models == 1
+        elif record_type == 'ENDMDL':
+            in_first_model = False
+        elif record_type in ('END   ', 'CONECT'):
+            break
+    atoms = AtomTable.from_columns(_pdb_atom_columns(atom_lines),
+                                   n_models=max(n_models, 1))
+    sequences = {chain: ''.join(residues) for chain, residues in
+                 seqres.items()}
+    return atoms, sequences, header
+
+
+def read_pdb_atoms(fileobj):
+    '''Read atom records from the first model of a PDB file.
+
+    Args:
+        fileobj (file-like object): An open PDB file.
+    Returns:
+        AtomTable: Coordinates and identities of all atoms.
+    '''
+    return read_pdb(fileobj)[0]
+
+
+def _mmcif_tokens(lines):
+    '''Split lines of an mmCIF file into tokens.
+
+    Yields:
+        tuple: Token value, and whether the token was quoted (or a
+            semicolon-delimited text field). Quoted tokens are never tags or
+            keywords.
+    '''
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(';'):
+            text = [line[1:].rstrip()]
+            for line in lines:
+                if line.startswith(';'):
+                    break
+                text.append(line.rstrip())
+            yield '\n'.join(text), True
+            continue
+        for match in _MMCIF_TOKEN.finditer(line):
+            if match.group(3) is not None:
+                break
+            if match.group(4) is not None:
+                yield match.group(4), False
+            elif match.group(1) is not None:
+                yield match.group(1), True
+            else:
+                yield match.group(2), True
+
+
+def _mmcif_items(lines):
+    '''Get the values of all data items in lines of an mmCIF file.
+
+    Args:
+        lines (list): Lines of an mmCIF file.
+    Returns:
+        dict: A list of values for each data item, accessed by tag (as for
+            Bio.PDB.MMCIF2Dict).
+    '''
+    def is_keyword(token):
+        '''Check if a token is a tag or a keyword, rather than a value.'''
+        value, quoted = token
+        return not quoted and (value.startswith('_') or value == 'loop_' or
+                               value.startswith('data_'))
+
+    items = {}
+    tokens = list(_mmcif_tokens(lines))
+    i = 0
+    while i < len(tokens):
+        value, quoted = tokens[i]
+        i += 1
+        if quoted:
+            continue
+        if value == 'loop_':
+            tags = []
+            while i < len(tokens) and is_keyword(tokens[i]):
+                tags.append(tokens[i][0])
+                i += 1
+            values = []
+            while i < len(tokens) and not is_keyword(tokens[i]):
+                values.append(tokens[i][0])
+                i += 1
+            for j, tag in enumerate(tags):
+                items[tag] = values[j::len(tags)]
+        elif value.startswith('_') and i < len(tokens):
+            items[value] = [tokens[i][0]]
+            i += 1
+    return items
+
+
+def read_mmcif(fileobj, categories=MMCIF_CATEGORIES):
+    '''Read the _atom_site loop, along with other requested categories, from
+    an mmCIF file in a single pass.
+
+    The _atom_site loop is read column-wise. As with Bio.PDB.FastMMCIFParser,
+    _atom_site values are expected to be free of whitespace, and each row to
+    be on a single line. Other categories are small, and are tokenised in
+    full (including quoted strings and multi-line text fields).
+
+    Args:
+        fileobj (file-like object): An open mmCIF file.
+        categories (tuple, optional): Names of other categories to read.
+    Returns:
+        AtomTable: Coordinates and identities of all atoms in the first model.
+        dict: A list of values for each data item in the requested categories,
+            accessed by tag (as for Bio.PDB.MMCIF2Dict).
+    '''
+    fields, rows, blocks = _read_mmcif_lines(fileobj, categories)
+    return atom_table_from_mmcif_rows(fields, rows), _mmcif_items(blocks)
+
+
+def _read_mmcif_lines(fileobj, categories):
+    '''Split an mmCIF file into _atom_site rows (for all models) and lines
+    from other requested categories.
+
+    Returns:
+        dict: Index of each _atom_site field, accessed by name.
+        list: Values (list of str) for each _atom_site row.
+        list: Lines from the requested categories.
+    '''
+    prefixes = tuple(category + '.' for category in categories)
+    fields = {}
+    rows = []
+    blocks = []
+    lines = iter(fileobj)
+    line = next(lines, None)
+    while line is not None:
+        if line.startswith('_atom_site.'):
+            while line is not None and line.startswith('_atom_site.'):
+                fields[line.split()[0][len('_atom_site.'):]] = len(fields)
+                line = next(lines, None)
+            while line is not None and not line.startswith(
+                    ('#', 'loop_', '_', 'data_')):
+                tokens = line.split()
+                if tokens:
+                    rows.append(tokens)
+                line = next(lines, None)
+            continue
+        is_loop = line.startswith('loop_')
+        if is_loop:
+            block = [line]
+            line = next(lines, None)
+        else:
+            block = []
+        if line is not None and line.startswith(prefixes):
+            # Read lines until the start of the next category.
+            category = line.split('.')[0]
+            in_text = False
+            while line is not None:
+                if line.startswith(';'):
+                    in_text = not in_text
+                elif not in_text and (
+                        line.startswith(('loop_', 'data_')) or
+                        (line.startswith('_') and
+                         not line.startswith(category + '.'))):
+                    break
+                block.append(line)
+                line = next(lines, None)
+            blocks.extend(block)
+        elif not is_loop and line is not None:
+            line = next(lines, None)
+    return fields, rows, blocks
+
+
+def _match_coords(atoms, table):
+    '''Get coordinates from an AtomTable for each atom in another AtomTable,
+    matched by residue id and atom name (NaN for missing atoms).'''
+    if (table.residue_ids == atoms.residue_ids and
+            np.array_equal(table.residue_index, atoms.residue_index) and
+            np.array_equal(table.names, atoms.names)):
+        return table.coords
+    atom_index = {key: i for i, key in enumerate(zip(
+        atoms.residue_index.tolist(), atoms.names.tolist()))}
+    residue_rows = {residue_id: i for i, residue_id in
+                    enumerate(atoms.residue_ids)}
+    coords = np.full(atoms.coords.shape, np.nan)
+    for row, name, coord in zip(table.residue_index.tolist(),
+                                table.names.tolist(), table.coords):
+        i = atom_index.get((residue_rows.get(table.residue_ids[row]), name))
+        if i is not None:
+            coords[i] = coord
+    return coords
+
+
+def iter_model_coords(fileobj, atoms, mmcif=False):
+    '''Read atom coordinates for each model in a file in turn.
+
+    Atoms in each model are matched (by residue id and atom name) to the atoms
+    of the first model. PDB files are read one model at a time, so that memory
+    use does not depend on the number of models (eg. for long trajectories).
+    The _atom_site loop of an mmCIF file is read in full before the first
+    model is returned.
+
+    Args:
+        fileobj (file-like object): An open PDB or mmCIF file.
+        atoms (AtomTable): Atoms from the first model in the file (as given
+            by `read_pdb` or `read_mmcif`).
+        mmcif (bool, optional): Set to True if reading an mmCIF file.
+    Yields:
+        np.array: An (n_atoms, 3) array of atom coordinates for each model,
+            with NaN for atoms missing from that model.
+    '''
+    if mmcif:
+        fields, rows, _ = _read_mmcif_lines(fileobj, ())
+        model = fields.get('pdbx_PDB_model_num')
+        model_rows = {}
+        for row in rows:
+            model_rows.setdefault(row[model] if model is not None else None,
+                                  []).append(row)
+        for rows in model_rows.values():
+            yield _match_coords(atoms, atom_table_from_mmcif_rows(fields, rows))
+        return
+    lines = []
+    for line in fileobj:
+        record_type = line.rstrip('\r\n')[0:6]
+        if record_type in ('ATOM  ', 'HETATM'):
+            lines.append(line)
+        elif record_type in ('ENDMDL', 'END   ', 'CONECT'):
+            if lines:
+                yield _match_coords(atoms, AtomTable.from_columns(
+                    _pdb_atom_columns(lines)))
+                lines = []
+            if record_type != 'ENDMDL':
+                break
+    if lines:
+        yield _match_coords(atoms, AtomTable.from_columns(
+            _pdb_atom_columns(lines)))
+
+
+def read_model_coords(fileobj, atoms, mmcif=False):
+    '''Read atom coordinates for every model in a file.
+
+    Atoms in each model are matched (by residue id and atom name) to the atoms
+    of the first model, so that coordinates from all models can be stacked
+    into a single array.
+
+    Args:
+        fileobj (file-like object): An open PDB or mmCIF file.
+        atoms (AtomTable): Atoms from the first model in the file (as given
+            by `read_pdb` or `read_mmcif`).
+        mmcif (bool, optional): Set to True if reading an mmCIF file.
+    Returns:
+        np.array: An (n_models, n_atoms, 3) array of atom coordinates, with
+            NaN for atoms missing from a model.
+    '''
+    coords = list(iter_model_coords(fileobj, atoms, mmcif))
+    if not coords:
+        return atoms.coords[np.newaxis]
+    return np.stack(coords)
+
+
+def mmcif_header(items):
+    '''Get header metadata from mmCIF data items, in the same form as given
+    by `read_pdb`.
+
+    Args:
+        items (dict): A list of values for each data item, accessed by tag (as
+            given by `read_mmcif`, or Bio.PDB.MMCIF2Dict).
+    Returns:
+        dict: Header metadata, with keys `idcode`, `structure_method` and
+            `resolution` (None if not given).
+    '''
+    def first_value(tag):
+        '''Get the first value for a data item, if present.'''
+        values = items.get(tag)
+        if values and values[0] not in _MMCIF_UNASSIGNED:
+            return values[0]
+        return None
+
+    resolution = first_value('_refine.ls_d_res_high')
+    try:
+        resolution = float(resolution)
+    except (TypeError, ValueError):
+        resolution = None
+    return {'idcode': first_value('_entry.id') or '',
+            'structure_method': (first_value('_exptl.method') or '').lower(),
+            'resolution': resolution}
+
+
+def read_mmcif_atoms(fileobj):
+    '''Read the _atom_site loop from the first model of an mmCIF file.
+
+    Args:
+        fileobj (file-like object): An open mmCIF file.
+    Returns:
+        AtomTable: Coordinates and identities of all atoms.
+    '''
+    return read_mmcif(fileobj, categories=())[0]
+
+
+def atom_table_from_mmcif_rows(fields, rows):
+    '''Build an AtomTable from rows of the mmCIF _atom_site loop.
+
+    Args:
+        fields (dict): Index of each _atom_site field, accessed by name.
+        rows (list): Values (list of str) for each _atom_site row.
+    Returns:
+        AtomTable: Coordinates and identities of all atoms in the first model.
+    '''
+    for row in rows:
+        if len(row) != len(fields):
+            raise ValueError("Malformed _atom_site record: {0}".format(
+                ' '.join(row)))
+    # Transpose rows to columns, without creating per-atom objects.
+    values = list(zip(*rows)) if rows else [()] * len(fields)
+
+    def column(*names):
+        '''Get values for the first field present, as a string array.'''
+        for name in names:
+            if name in fields:
+                return np.array(values[fields[name]], dtype='U')
+        return None
+
+    n_models = 1
+    model = column('pdbx_PDB_model_num')
+    if model is not None and len(model):
+        first_model = model == model[0]
+        n_models = len(np.unique(model))
+        values = [np.array(x, dtype='U')[first_model] for x in values]
+    resname = column('label_comp_id')
+    name = np.char.strip(column('label_atom_id'), '"')
+    # Bio.PDB.FastMMCIFParser gives all HETATM residues (including water) a
+    # hetero flag of 'H_' + residue name.
+    hetflag = np.where(column('group_PDB') == 'HETATM',
+                       np.char.add('H_', resname), ' ')
+    icode = column('pdbx_PDB_ins_code')
+    if icode is None:
+        icode = np.full(len(name), ' ')
+    else:
+        icode = np.where(np.isin(icode, _MMCIF_UNASSIGNED), ' ', icode)
+    element = column('type_symbol')
+    if element is None:
+        element = name.astype('U1')
+    else:
+        element = np.char.upper(element)
+    # Coordinates are stored with single precision, as in Bio.PDB.
+    coords = np.array([values[fields['Cartn_x']], values[fields['Cartn_y']],
+                       values[fields['Cartn_z']]],
+                      dtype='float64').T.astype('float32').astype('float64')
+    columns = {'chain': column('auth_asym_id'),
+               'hetflag': hetflag,
+               'resseq': _int_array(column('auth_seq_id', 'label_seq_id'), 0),
+               'icode': icode,
+               'resname': resname,
+               'name': name,
+               'element': element,
+               'coords': coords.reshape(-1, 3),
+               'occupancy': _float_array(column('occupancy'), np.nan),
+               'bfactor': _float_array(column('B_iso_or_equiv'), 0.0)}
+    seq_id = column('label_seq_id')
+    if seq_id is not None:
+        columns['seq_id'] = _int_array(seq_id, -1)
+    return AtomTable.from_columns(columns, n_models=n_models)
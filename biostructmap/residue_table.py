@@ -0,0 +1,261 @@
+"""A columnar table of per-residue properties for a PDB model.
+
+Helper module for the biostructmap package. Properties for each residue are
+held in a single NumPy structured array, with residues identified by their
+row index. This avoids repeated walks over the Bio.PDB object tree when the
+same properties are needed for many residues.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+RESIDUE_TABLE_DTYPE = np.dtype([
+    ('chain', 'U4'),
+    ('hetflag', 'U10'),
+    ('resseq', 'i8'),
+    ('icode', 'U1'),
+    ('resname', 'U4'),
+    ('ca', 'f8', (3,)),
+    ('centroid', 'f8', (3,)),
+    ('bfactor', 'f8'),
+    ('rsa', 'f8'),
+    ('ss', 'U1'),
+    ('seq_position', 'i8'),
+    ])
+
+# Values used for properties that have not been calculated, or can't be
+# calculated for a residue.
+MISSING_VALUES = {'ca': np.nan, 'centroid': np.nan, 'bfactor': np.nan,
+                  'rsa': np.nan, 'ss': '', 'seq_position': -1}
+
+
+class ResidueTable(object):
+    '''A table of per-residue properties, stored as a NumPy structured array.
+
+    Each residue is identified by an integer index (row number). Columns
+    describing the residue identity and coordinates are filled on creation.
+    Columns that are expensive to calculate (`rsa`, `ss` and `seq_position`)
+    are filled by the parent Structure object when first required, and
+    `methods` records the method used to fill each of these.
+
+    Attributes:
+        data (np.array): Structured array with one row per residue.
+        residue_ids (list): Residue id (chain id, residue id) for each row.
+        row_index (dict): Row index for each residue id.
+        methods (dict): The method used to calculate each lazily filled
+            column, accessed by column name.
+    '''
+    def __init__(self, data, residue_ids):
+        '''Initialise a ResidueTable object.
+
+        Args:
+            data (np.array): Structured array with the columns of
+                RESIDUE_TABLE_DTYPE.
+            residue_ids (list): Residue id (chain id, residue id) for each row.
+        '''
+        self.data = data
+        self.residue_ids = residue_ids
+        self.row_index = {residue_id: i for i, residue_id in
+                       enumerate(residue_ids)}
+        self.methods = {}
+
+    @classmethod
+    def from_model(cls, model):
+        '''Build a ResidueTable from all residues in a model.
+
+        Args:
+            model (Model): Bio.PDB Model object.
+        Returns:
+            ResidueTable: Table with identity, coordinate and B-factor
+                columns filled.
+        '''
+        residue_ids = []
+        resnames = []
+        ca_coords = []
+        atom_coords = []
+        atom_bfactors = []
+        atom_rows = []
+        for chain in model:
+            for residue in chain:
+                row = len(residue_ids)
+                residue_ids.append((chain.get_id(), residue.get_id()))
+                resnames.append(residue.get_resname())
+                if 'CA' in residue:
+                    ca_coords.append(residue['CA'].get_coord())
+                else:
+                    ca_coords.append((np.nan, np.nan, np.nan))
+                for atom in residue:
+                    atom_coords.append(atom.get_coord())
+                    atom_bfactors.append(atom.get_bfactor())
+                    atom_rows.append(row)
+        return cls._from_arrays(residue_ids, resnames,
+                                np.array(ca_coords, dtype='float64'),
+                                np.array(atom_rows, dtype='int64'),
+                                np.array(atom_coords, dtype='float64'),
+                                np.array(atom_bfactors, dtype='float64'))
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        '''Build a ResidueTable from an AtomTable, without requiring a
+        Bio.PDB model.
+
+        Args:
+            atoms (AtomTable): Atom coordinates and identities (see
+                biostructmap.readers).
+        Returns:
+            ResidueTable: Table with identity, coordinate and B-factor
+                columns filled.
+        '''
+        n_residues = len(atoms.residue_ids)
+        ca_coords = np.full((n_residues, 3), np.nan)
+        ca_atoms = np.flatnonzero(atoms.names == 'CA')[::-1]
+        # Assign in reverse so that the first CA atom in a residue is kept.
+        ca_coords[atoms.residue_index[ca_atoms]] = atoms.coords[ca_atoms]
+        return cls._from_arrays(atoms.residue_ids, atoms.resnames, ca_coords,
+                                atoms.residue_index, atoms.coords,
+                                atoms.bfactors)
+
+    @classmethod
+    def _from_arrays(cls, residue_ids, resnames, ca_coords, atom_rows,
+                     atom_coords, atom_bfactors):
+        '''Build a ResidueTable from residue and atom arrays.'''
+        n_residues = len(residue_ids)
+        data = np.zeros(n_residues, dtype=_table_dtype(residue_ids, resnames))
+        for column, value in MISSING_VALUES.items():
+            data[column] = value
+        if not n_residues:
+            return cls(data, list(residue_ids))
+        data['chain'] = [x[0] for x in residue_ids]
+        data['hetflag'] = [x[1][0] for x in residue_ids]
+        data['resseq'] = [x[1][1] for x in residue_ids]
+        data['icode'] = [x[1][2] for x in residue_ids]
+        data['resname'] = resnames
+        data['ca'] = ca_coords.reshape(-1, 3)
+        if len(atom_rows):
+            n_atoms = np.bincount(atom_rows, minlength=n_residues)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for dim in range(3):
+                    data['centroid'][:, dim] = np.bincount(
+                        atom_rows, weights=atom_coords[:, dim],
+                        minlength=n_residues) / n_atoms
+                data['bfactor'] = np.bincount(atom_rows, weights=atom_bfactors,
+                                              minlength=n_residues) / n_atoms
+        return cls(data, list(residue_ids))
+
+    def __len__(self):
+        return len(self.residue_ids)
+
+    def __getitem__(self, column):
+        '''Get a column of the table (a view, not a copy).'''
+        return self.data[column]
+
+    def __contains__(self, residue_id):
+        return residue_id in self.row_index
+
+    def index(self, residue_ids):
+        '''Get the row index for each residue.
+
+        Args:
+            residue_ids (list): Residue ids (chain id, residue id).
+        Returns:
+            np.array: Row index for each residue. Residues not found in the
+                table are given an index of -1.
+        '''
+        return np.array([self.row_index.get(residue_id, -1) for residue_id in
+                         residue_ids], dtype='int64')
+
+    def column(self, column, rows, missing=None):
+        '''Get values from a column for a selection of rows.
+
+        Args:
+            column (str): Column name.
+            rows (np.array): Row indices, with -1 indicating a missing row.
+            missing (optional): Value to use for missing rows. Defaults to
+                the missing value for that column.
+        Returns:
+            np.array: Column values for each row.
+        '''
+        if missing is None:
+            missing = MISSING_VALUES.get(column, '')
+        values = self.data[column][rows]
+        values[rows < 0] = missing
+        return values
+
+    def set_column(self, column, values, method=None):
+        '''Fill a column using a dictionary of values.
+
+        Args:
+            column (str): Column name.
+            values (dict): Values accessed by residue id (chain id, residue id).
+                Residues not in the dictionary, or with a value of None, are
+                given the missing value for that column.
+            method (str, optional): Method used to calculate values.
+        '''
+        self.data[column] = MISSING_VALUES[column]
+        for residue_id, value in values.items():
+            row = self.row_index.get(residue_id)
+            if row is not None and value is not None:
+                self.data[column][row] = value
+        self.methods[column] = method
+
+    def to_numpy(self):
+        '''Get the underlying structured array, without copying.
+
+        Returns:
+            np.array: Structured array with one row per residue.
+        '''
+        return self.data
+
+
+def _table_dtype(residue_ids, resnames):
+    '''Get the dtype for a table. String columns filled from residue ids and
+    names are widened to fit the longest value (eg. long mmCIF chain ids), with
+    the widths in RESIDUE_TABLE_DTYPE as the minimum.'''
+    values = {'chain': [x[0] for x in residue_ids],
+              'hetflag': [x[1][0] for x in residue_ids],
+              'resname': resnames}
+    descr = []
+    for name in RESIDUE_TABLE_DTYPE.names:
+        column_dtype, _ = RESIDUE_TABLE_DTYPE.fields[name]
+        if name in values:
+            width = max([column_dtype.itemsize // 4] +
+                        [len(x) for x in values[name]])
+            descr.append((name, 'U{0}'.format(width)))
+        elif column_dtype.subdtype is not None:
+            descr.append((name,) + column_dtype.subdtype)
+        else:
+            descr.append((name, column_dtype))
+    return np.dtype(descr)
+
+
+def residue_id_arrays(residue_ids):
+    '''Convert a list of residue ids to NumPy arrays, for storage on disk.
+
+    Args:
+        residue_ids (list): Residue ids (chain id, residue id).
+    Returns:
+        dict: Arrays of chain ids (`chain`), hetero flags (`hetflag`),
+            residue numbers (`resseq`) and insertion codes (`icode`).
+    '''
+    return {
+        'chain': np.array([x[0] for x in residue_ids], dtype='U'),
+        'hetflag': np.array([x[1][0] for x in residue_ids], dtype='U'),
+        'resseq': np.array([x[1][1] for x in residue_ids], dtype='i8'),
+        'icode': np.array([x[1][2] for x in residue_ids], dtype='U'),
+        }
+
+
+def residue_ids_from_arrays(chain, hetflag, resseq, icode):
+    '''Convert arrays created by `residue_id_arrays` back to residue ids.
+
+    Args:
+        chain (np.array): Chain ids.
+        hetflag (np.array): Hetero flags.
+        resseq (np.array): Residue numbers.
+        icode (np.array): Insertion codes.
+    Returns:
+        list: Residue ids (chain id, residue id).
+    '''
+    return [(c, (h, r, i)) for c, h, r, i in
+            zip(chain.tolist(), hetflag.tolist(), resseq.tolist(),
+                icode.tolist())]
@@ -0,0 +1,160 @@
+"""Calculation of solvent accessible surface area without external programs.
+
+Helper module for the biostructmap package. Implements the Shrake-Rupley
+algorithm, with atomic radii and maximum residue accessibilities chosen to
+give values comparable to those from DSSP.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from . import pdbtools
+
+# Maximum accessible surface area for each residue (Sander & Rost, 1994).
+# These are the default values used by Bio.PDB.DSSP.
+MAX_ASA = {
+    'ALA': 106.0, 'ARG': 248.0, 'ASN': 157.0, 'ASP': 163.0, 'CYS': 135.0,
+    'GLN': 198.0, 'GLU': 194.0, 'GLY': 84.0, 'HIS': 184.0, 'ILE': 169.0,
+    'LEU': 164.0, 'LYS': 205.0, 'MET': 188.0, 'PHE': 197.0, 'PRO': 136.0,
+    'SER': 130.0, 'THR': 142.0, 'TRP': 227.0, 'TYR': 222.0, 'VAL': 142.0
+    }
+
+# Atomic radii as used by DSSP. All side chain atoms use the same radius.
+BACKBONE_RADII = {'N': 1.65, 'CA': 1.87, 'C': 1.76, 'O': 1.4}
+SIDE_CHAIN_RADIUS = 1.8
+
+PROBE_RADIUS = 1.4
+N_SPHERE_POINTS = 200
+
+# Number of atoms to process in a single vectorised step.
+_ATOM_CHUNK_SIZE = 256
+
+
+def _sphere_points(n_points):
+    '''Generate approximately evenly distributed points on a unit sphere
+    using a golden section spiral.
+
+    Args:
+        n_points (int): Number of points.
+    Returns:
+        np.array: An (n_points, 3) array of coordinates.
+    '''
+    index = np.arange(n_points) + 0.5
+    z_coord = 1 - 2 * index / n_points
+    radius = np.sqrt(1 - z_coord ** 2)
+    theta = np.pi * (3 - np.sqrt(5)) * index
+    return np.column_stack((radius * np.cos(theta), radius * np.sin(theta),
+                            z_coord))
+
+def atom_sasa(coords, radii, probe=PROBE_RADIUS, n_points=N_SPHERE_POINTS):
+    '''Calculate the solvent accessible surface area of each atom using the
+    Shrake-Rupley algorithm.
+
+    Neighbouring atoms are identified using a KD-tree, and sphere points for
+    a block of atoms are tested against all neighbours in a single
+    vectorised step.
+
+    Args:
+        coords (np.array): An (n, 3) array of atom coordinates.
+        radii (np.array): Van der Waals radius for each atom.
+        probe (float, optional): Solvent probe radius. Defaults to 1.4.
+        n_points (int, optional): Number of points on each atom sphere.
+    Returns:
+        np.array: Solvent accessible surface area for each atom.
+    '''
+    if not pdbtools.SCIPY_PRESENT:
+        raise ImportError("Scipy is required to calculate solvent accessibility "
+                          "without DSSP.")
+    from scipy.spatial import cKDTree
+    coords = np.asarray(coords, dtype='float64')
+    n_atoms = len(coords)
+    if not n_atoms:
+        return np.zeros(0)
+    expanded = np.asarray(radii, dtype='float64') + probe
+    sphere = _sphere_points(n_points)
+    # Find all pairs of atoms with overlapping expanded spheres.
+    tree = cKDTree(coords)
+    pairs = tree.query_pairs(2 * expanded.max(), output_type='ndarray')
+    first = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    second = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    distance = np.linalg.norm(coords[first] - coords[second], axis=1)
+    overlapping = distance < expanded[first] + expanded[second]
+    first = first[overlapping]
+    second = second[overlapping]
+    order = np.argsort(first, kind='stable')
+    first = first[order]
+    second = second[order]
+    # Start of neighbour list for each atom.
+    indptr = np.searchsorted(first, np.arange(n_atoms + 1))
+    accessible = np.ones((n_atoms, n_points), dtype=bool)
+    for start in range(0, n_atoms, _ATOM_CHUNK_SIZE):
+        end = min(start + _ATOM_CHUNK_SIZE, n_atoms)
+        pair_slice = slice(indptr[start], indptr[end])
+        atom = first[pair_slice]
+        neighbour = second[pair_slice]
+        if not len(atom):
+            continue
+        # A surface point p = c_i + R_i * u is buried by neighbour j if
+        # |p - c_j|^2 < R_j^2. Expanding the square gives a test that only
+        # needs a single matrix product over all sphere points.
+        offset = coords[atom] - coords[neighbour]
+        threshold = (expanded[neighbour] ** 2 - expanded[atom] ** 2 -
+                     (offset ** 2).sum(axis=1)) / (2 * expanded[atom])
+        buried = offset.dot(sphere.T) < threshold[:, None]
+        has_neighbours = indptr[start + 1:end + 1] > indptr[start:end]
+        segment_starts = indptr[start:end][has_neighbours] - indptr[start]
+        buried_by_any = np.logical_or.reduceat(buried, segment_starts, axis=0)
+        accessible[start:end][has_neighbours] = ~buried_by_any
+    return 4 * np.pi * expanded ** 2 * accessible.mean(axis=1)
+
+def relative_solvent_accessibility(model, probe=PROBE_RADIUS,
+                                   n_points=N_SPHERE_POINTS):
+    '''Calculate relative solvent accessibility for all residues in a model.
+
+    Values are only calculated for standard amino acid residues, although
+    non-water HETATM residues (such as modified amino acids) are included
+    when determining which surface points are buried. Hydrogen atoms are
+    ignored. The accessible surface area of each residue is normalised by the
+    maximum values given in MAX_ASA. Terminal residues can be more exposed
+    than the reference values, so relative values are capped at 1.
+
+    Args:
+        model (Model): Bio.PDB Model object.
+        probe (float, optional): Solvent probe radius. Defaults to 1.4.
+        n_points (int, optional): Number of points on each atom sphere.
+    Returns:
+        dict: Relative solvent accessibility (float) for each residue,
+            accessed by (chain id, residue id).
+    '''
+    residue_keys = []
+    residue_max_asa = []
+    coords = []
+    radii = []
+    atom_residue_index = []
+    for chain in model:
+        for residue in chain:
+            hetero_flag = residue.get_id()[0]
+            resname = residue.get_resname()
+            if hetero_flag == 'W':
+                continue
+            if hetero_flag == ' ' and resname in MAX_ASA:
+                residue_index = len(residue_keys)
+                residue_keys.append((chain.get_id(), residue.get_id()))
+                residue_max_asa.append(MAX_ASA[resname])
+            else:
+                residue_index = -1
+            for atom in residue:
+                if atom.element in ('H', 'D'):
+                    continue
+                coords.append(atom.get_coord())
+                radii.append(BACKBONE_RADII.get(atom.get_id(), SIDE_CHAIN_RADIUS))
+                atom_residue_index.append(residue_index)
+    if not residue_keys:
+        return {}
+    atom_area = atom_sasa(np.array(coords), np.array(radii), probe, n_points)
+    atom_residue_index = np.array(atom_residue_index)
+    reported = atom_residue_index >= 0
+    residue_area = np.bincount(atom_residue_index[reported],
+                               weights=atom_area[reported],
+                               minlength=len(residue_keys))
+    rsa = np.minimum(residue_area / np.array(residue_max_asa), 1.0)
+    return {key: float(value) for key, value in zip(residue_keys, rsa)}
@@ -0,0 +1,307 @@
+"""Assignment of protein secondary structure without external programs.
+
+Helper module for the biostructmap package. Implements the Kabsch & Sander
+algorithm used by the DSSP program, with backbone hydrogen bond energies
+calculated on NumPy arrays of backbone atom coordinates. Secondary structure
+codes are the same as those given by DSSP (see pdbtools.SS_LOOKUP_DICT).
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from . import pdbtools
+
+# Electrostatic hydrogen bond energy constant (0.42e * 0.20e * 332),
+# in kcal/mol.
+_HBOND_ENERGY_CONSTANT = 0.084 * 332
+# Maximum energy for a hydrogen bond, in kcal/mol.
+MAX_HBOND_ENERGY = -0.5
+# Only residues with CA atoms within this distance are tested for hydrogen
+# bonds.
+_MAX_CA_DISTANCE = 9.0
+# Maximum C-N distance for consecutive residues to be considered bonded.
+_MAX_PEPTIDE_BOND_LENGTH = 2.5
+# Minimum CA(i-2), CA(i), CA(i+2) bend angle (degrees) to assign a bend.
+_MIN_BEND_ANGLE = 70.0
+
+_BACKBONE_ATOMS = ('N', 'CA', 'C', 'O')
+
+
+def _backbone_arrays(model):
+    '''Extract backbone atom coordinates for all residues in a model that
+    have a complete set of backbone atoms.
+
+    Args:
+        model (Model): Bio.PDB Model object.
+    Returns:
+        tuple: A list of (chain id, residue id) keys, with an empty HET flag
+            in each residue id, a boolean array
+            indicating proline residues, and a dictionary of (n, 3)
+            coordinate arrays accessed by atom name.
+    '''
+    keys = []
+    is_proline = []
+    coords = {atom_name: [] for atom_name in _BACKBONE_ATOMS}
+    for chain in model:
+        for residue in chain:
+            if residue.get_id()[0] == 'W':
+                continue
+            if not all(atom_name in residue for atom_name in _BACKBONE_ATOMS):
+                continue
+            # Residues are keyed as for Bio.PDB DSSP, which ignores the HET
+            # flag (eg. ('H_HYP', 2, ' ') is keyed as (' ', 2, ' ')).
+            keys.append((chain.get_id(), (' ',) + residue.get_id()[1:]))
+            is_proline.append(residue.get_resname() == 'PRO')
+            for atom_name in _BACKBONE_ATOMS:
+                coords[atom_name].append(residue[atom_name].get_coord())
+    coords = {atom_name: np.array(value, dtype='float64').reshape(-1, 3)
+              for atom_name, value in coords.items()}
+    return keys, np.array(is_proline, dtype=bool), coords
+
+
+def hbond_energy(acceptor, donor, coords, hydrogen):
+    '''Calculate the electrostatic energy of hydrogen bonds between backbone
+    C=O and N-H groups, as defined by Kabsch & Sander.
+
+    Args:
+        acceptor (np.array): Index of the residue providing the C=O group.
+        donor (np.array): Index of the residue providing the N-H group.
+        coords (dict): Backbone coordinate arrays accessed by atom name.
+        hydrogen (np.array): Amide hydrogen coordinates for each residue.
+    Returns:
+        np.array: Hydrogen bond energy (kcal/mol) for each pair.
+    '''
+    carbon = coords['C'][acceptor]
+    oxygen = coords['O'][acceptor]
+    nitrogen = coords['N'][donor]
+    hydrogen = hydrogen[donor]
+    def distance(first, second):
+        return np.linalg.norm(first - second, axis=1)
+    return _HBOND_ENERGY_CONSTANT * (1 / distance(oxygen, nitrogen) +
+                                     1 / distance(carbon, hydrogen) -
+                                     1 / distance(oxygen, hydrogen) -
+                                     1 / distance(carbon, nitrogen))
+
+
+def _hbond_keys(coords, is_proline, segment):
+    '''Find all backbone hydrogen bonds.
+
+    As with DSSP, only the two lowest energy bonds to each N-H group are
+    retained.
+
+    Args:
+        coords (dict): Backbone coordinate arrays accessed by atom name.
+        is_proline (np.array): Boolean array indicating proline residues.
+        segment (np.array): Identifier of the continuous backbone segment
+            containing each residue.
+    Returns:
+        np.array: Sorted array of hydrogen bonds, each encoded as
+            `acceptor * n_residues + donor`.
+    '''
+    from scipy.spatial import cKDTree
+    n_residues = len(segment)
+    # Place amide hydrogens opposite the carbonyl oxygen of the previous
+    # residue. Residues without a previous residue, and prolines, have no
+    # amide hydrogen.
+    has_hydrogen = np.zeros(n_residues, dtype=bool)
+    has_hydrogen[1:] = segment[1:] == segment[:-1]
+    has_hydrogen &= ~is_proline
+    carbonyl = coords['C'][:-1] - coords['O'][:-1]
+    carbonyl /= np.linalg.norm(carbonyl, axis=1)[:, None]
+    hydrogen = coords['N'].copy()
+    hydrogen[1:] += carbonyl
+    tree = cKDTree(coords['CA'])
+    pairs = tree.query_pairs(_MAX_CA_DISTANCE, output_type='ndarray')
+    acceptor = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    donor = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    # The N-H of a residue can't bond to the C=O of the preceding residue.
+    valid = has_hydrogen[donor] & (donor != acceptor + 1)
+    acceptor = acceptor[valid]
+    donor = donor[valid]
+    energy = hbond_energy(acceptor, donor, coords, hydrogen)
+    # Rank bonds for each donor by energy, and keep the best two.
+    order = np.lexsort((energy, donor))
+    acceptor = acceptor[order]
+    donor = donor[order]
+    energy = energy[order]
+    first_of_donor = np.searchsorted(donor, donor)
+    rank = np.arange(len(donor)) - first_of_donor
+    bonded = (rank < 2) & (energy < MAX_HBOND_ENERGY)
+    return np.sort(acceptor[bonded] * n_residues + donor[bonded])
+
+
+def _ladders(bridges, segment):
+    '''Group bridges into ladders, joining ladders separated by beta-bulges.
+
+    Args:
+        bridges (list): List of (i, j, parallel) tuples, where i < j, sorted
+            by i then j.
+        segment (np.array): Identifier of the continuous backbone segment
+            containing each residue.
+    Returns:
+        list: A list of ladders, each a dictionary containing lists of
+            residue indices `i` and `j` for each side of the ladder, and
+            a `parallel` flag.
+    '''
+    ladders = []
+    for i, j, parallel in bridges:
+        for ladder in ladders:
+            if ladder['parallel'] != parallel or ladder['i'][-1] != i - 1:
+                continue
+            if segment[i] != segment[i - 1]:
+                continue
+            if (parallel and ladder['j'][-1] == j - 1 and
+                    segment[j] == segment[j - 1]):
+                break
+            if (not parallel and ladder['j'][0] == j + 1 and
+                    segment[j] == segment[j + 1]):
+                break
+        else:
+            ladders.append({'i': [i], 'j': [j], 'parallel': parallel})
+            continue
+        ladder['i'].append(i)
+        if parallel:
+            ladder['j'].append(j)
+        else:
+            ladder['j'].insert(0, j)
+    # Join ladders separated by a beta-bulge. Differences between residue
+    # indices must be non-negative, as in DSSP.
+    def within(difference, limit):
+        return 0 <= difference < limit
+    first_index = 0
+    while first_index < len(ladders):
+        first = ladders[first_index]
+        second_index = first_index + 1
+        while second_index < len(ladders):
+            second = ladders[second_index]
+            second_index += 1
+            ibi, iei = first['i'][0], first['i'][-1]
+            jbi, jei = first['j'][0], first['j'][-1]
+            ibj, iej = second['i'][0], second['i'][-1]
+            jbj, jej = second['j'][0], second['j'][-1]
+            if (first['parallel'] != second['parallel'] or
+                    segment[min(ibi, ibj)] != segment[max(iei, iej)] or
+                    segment[min(jbi, jbj)] != segment[max(jei, jej)] or
+                    not within(ibj - iei, 6) or
+                    (iei >= ibj and ibi <= iej)):
+                continue
+            if first['parallel']:
+                bulge = ((within(jbj - jei, 6) and within(ibj - iei, 3)) or
+                         within(jbj - jei, 3))
+            else:
+                bulge = ((within(jbi - jej, 6) and within(ibj - iei, 3)) or
+                         within(jbi - jej, 3))
+            if bulge:
+                first['i'] = sorted(first['i'] + second['i'])
+                first['j'] = sorted(first['j'] + second['j'])
+                second_index -= 1
+                del ladders[second_index]
+        first_index += 1
+    return ladders
+
+
+def assign_secondary_structure(model):
+    '''Assign secondary structure to all residues in a model.
+
+    Residues without a complete set of backbone atoms (N, CA, C, O) are not
+    assigned. Assignments follow the DSSP priority order: H, B, E, G, I, T, S.
+
+    Args:
+        model (Model): Bio.PDB Model object.
+    Returns:
+        dict: Secondary structure code (str) for each residue, accessed by
+            (chain id, residue id).
+    '''
+    if not pdbtools.SCIPY_PRESENT:
+        raise ImportError("Scipy is required to assign secondary structure "
+                          "without DSSP.")
+    from scipy.spatial import cKDTree
+    keys, is_proline, coords = _backbone_arrays(model)
+    n_residues = len(keys)
+    if n_residues < 2:
+        return {key: '-' for key in keys}
+    # Split residues into continuous backbone segments at chain breaks.
+    chain_ids = np.array([key[0] for key in keys])
+    peptide_bond = np.linalg.norm(coords['C'][:-1] - coords['N'][1:], axis=1)
+    breaks = ((peptide_bond > _MAX_PEPTIDE_BOND_LENGTH) |
+              (chain_ids[:-1] != chain_ids[1:]))
+    segment = np.concatenate(([0], np.cumsum(breaks)))
+    hbonds = _hbond_keys(coords, is_proline, segment)
+
+    def is_bonded(acceptor, donor):
+        '''Check for hydrogen bonds from C=O(acceptor) to N-H(donor).'''
+        valid = ((acceptor >= 0) & (acceptor < n_residues) &
+                 (donor >= 0) & (donor < n_residues))
+        encoded = np.where(valid, acceptor * n_residues + donor, -1)
+        return valid & np.isin(encoded, hbonds)
+
+    index = np.arange(n_residues)
+    ss = np.full(n_residues, '-', dtype='<U1')
+
+    # Beta bridges between residues i and j.
+    tree = cKDTree(coords['CA'])
+    pairs = tree.query_pairs(_MAX_CA_DISTANCE, output_type='ndarray')
+    pairs = pairs[np.abs(pairs[:, 1] - pairs[:, 0]) > 2]
+    i = pairs.min(axis=1)
+    j = pairs.max(axis=1)
+    candidate = ((i > 0) & (j < n_residues - 1))
+    i = i[candidate]
+    j = j[candidate]
+    continuous = ((segment[i - 1] == segment[i + 1]) &
+                  (segment[j - 1] == segment[j + 1]))
+    i = i[continuous]
+    j = j[continuous]
+    parallel = ((is_bonded(i - 1, j) & is_bonded(j, i + 1)) |
+                (is_bonded(j - 1, i) & is_bonded(i, j + 1)))
+    antiparallel = ((is_bonded(i, j) & is_bonded(j, i)) |
+                    (is_bonded(i - 1, j + 1) & is_bonded(j - 1, i + 1)))
+    bridge = parallel | antiparallel
+    bridges = sorted(zip(i[bridge].tolist(), j[bridge].tolist(),
+                         parallel[bridge].tolist()))
+    for ladder in _ladders(bridges, segment):
+        if len(ladder['i']) > 1:
+            ss[ladder['i'][0]:ladder['i'][-1] + 1] = 'E'
+            ss[ladder['j'][0]:ladder['j'][-1] + 1] = 'E'
+        else:
+            for residue in ladder['i'] + ladder['j']:
+                if ss[residue] != 'E':
+                    ss[residue] = 'B'
+
+    # n-turns at residue i, with a hydrogen bond from C=O(i) to N-H(i+n).
+    turns = {}
+    for n in (3, 4, 5):
+        turn = np.zeros(n_residues, dtype=bool)
+        start = index[:-n]
+        turn[:-n] = (is_bonded(start, start + n) &
+                     (segment[start] == segment[start + n]))
+        turns[n] = turn
+    # Helices start at residue i if there are n-turns at both i-1 and i.
+    for n, code in ((4, 'H'), (3, 'G'), (5, 'I')):
+        helix_start = np.zeros(n_residues, dtype=bool)
+        helix_start[1:] = turns[n][1:] & turns[n][:-1]
+        for start in index[helix_start]:
+            residues = slice(start, start + n)
+            if code == 'H' or np.all((ss[residues] == '-') |
+                                     (ss[residues] == code)):
+                ss[residues] = code
+    # Remaining residues within turns.
+    in_turn = np.zeros(n_residues, dtype=bool)
+    for n, turn in turns.items():
+        for offset in range(1, n):
+            in_turn[offset:] |= turn[:-offset]
+    ss[in_turn & (ss == '-')] = 'T'
+
+    # Bends, where the chain direction changes by more than 70 degrees.
+    bend = np.zeros(n_residues, dtype=bool)
+    if n_residues > 4:
+        middle = index[2:-2]
+        ca_coords = coords['CA']
+        first = ca_coords[middle] - ca_coords[middle - 2]
+        second = ca_coords[middle + 2] - ca_coords[middle]
+        cosine = ((first * second).sum(axis=1) /
+                  (np.linalg.norm(first, axis=1) *
+                   np.linalg.norm(second, axis=1)))
+        angle = np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+        bend[middle] = ((angle > _MIN_BEND_ANGLE) &
+                        (segment[middle - 2] == segment[middle + 2]))
+    ss[bend & (ss == '-')] = 'S'
+    return {key: str(code) for key, code in zip(keys, ss)}
@@ -10,18 +10,30 @@ import subprocess
 import tempfile
 import warnings
 from Bio import AlignIO
-from Bio.Blast.Applications import NcbiblastpCommandline
-from Bio.Blast import NCBIXML
-from Bio.pairwise2 import align
-from Bio.SubsMat import MatrixInfo as matlist
 from Bio.Seq import Seq
+from Bio.Data.CodonTable import TranslationError
+import numpy as np
+from . import instrument
 
-#Use local BLAST+ installation. Falls back to pairwise2 if False.
+#Use local BLAST+ installation. Falls back to the built-in pairwise aligner
+#if False.
 LOCAL_BLAST = True
 #Use local exonerate installation to align dna to protein sequences.
-#Falls back to a basic method using either BLAST+ or pairwise2 if False,
+#Falls back to a basic method using either BLAST+ or the built-in pairwise
+#aligner if False,
 #but won't take into consideration introns or frameshift mutations.
 LOCAL_EXONERATE = True
+#Default band width for the built-in pairwise aligner. None computes the full
+#dynamic programming matrix.
+PAIRWISE_BAND = None
+
+#Gap penalties for the built-in pairwise aligner (same as default blastp).
+_GAP_OPEN = -11
+_GAP_EXTEND = -1
+#Score used to mark unreachable cells in the dynamic programming matrices.
+_NEG_INF = -10**8
+#BLOSUM62 lookup table indexed by ASCII code. Loaded on first use.
+_BLOSUM62 = None
 
 def _sliding_window(seq_align, window, step=3, fasta_out=False):
     '''
@@ -149,7 +161,9 @@ def align_protein_sequences(comp_seq, ref_seq):
     '''
     Perform a pairwise alignment of two sequences.
 
-    Uses BLAST+ if LOCAL_BLAST is set to True, otherwise uses Bio.pairwise2.
+    If the sequences are identical, or one is found exactly once within the
+    other, the alignment is constructed directly. Otherwise uses BLAST+ if
+    LOCAL_BLAST is set to True, or the built-in pairwise aligner if not.
 
     Args:
         comp_seq (str): A comparison protein sequence.
@@ -161,6 +175,9 @@ def align_protein_sequences(comp_seq, ref_seq):
         dict: A dictionary mapping reference sequence numbering (key) to
             comparison sequence numbering (value)
     '''
+    exact_match = _exact_protein_alignment(str(comp_seq), str(ref_seq))
+    if exact_match is not None:
+        return exact_match
     if LOCAL_BLAST:
         return blast_sequences(comp_seq, ref_seq)
     else:
@@ -171,7 +188,10 @@ def align_protein_to_dna(prot_seq, dna_seq):
     '''
     Aligns a protein sequence to a genomic sequence.
 
-    If LOCAL_EXONERATE flag is set to True, takes into consideration
+    If the protein sequence is found exactly once within a forward-frame
+    translation of the DNA sequence, codons are assigned directly.
+
+    Otherwise, if LOCAL_EXONERATE flag is set to True, takes into consideration
     introns, frameshifts and reverse-sense translation if using Exonerate.
 
     If LOCAL_EXONERATE flag is set to False, then a simple translation and
@@ -191,6 +211,9 @@ def align_protein_to_dna(prot_seq, dna_seq):
         dict: A dictionary mapping protein residue numbers to codon positions:
             e.g. {3:(6,7,8), 4:(9,10,11), ...}
     '''
+    exact_match = _exact_cds_alignment(str(prot_seq), str(dna_seq))
+    if exact_match is not None:
+        return exact_match
     if LOCAL_EXONERATE:
         return _align_prot_to_dna_exonerate(prot_seq, dna_seq)
     else:
@@ -198,6 +221,87 @@ def align_protein_to_dna(prot_seq, dna_seq):
 
 
 
+def _unique_find(sequence, subsequence):
+    '''Return the index of the only occurrence of subsequence within
+    sequence, or None if it occurs zero or multiple times.'''
+    index = sequence.find(subsequence)
+    if index == -1 or sequence.find(subsequence, index + 1) != -1:
+        return None
+    return index
+
+def _exact_protein_alignment(comp_seq, ref_seq):
+    '''
+    Construct an alignment without an external process if the two protein
+    sequences are identical, or if one occurs exactly once within the other.
+
+    Args:
+        comp_seq (str): A comparison protein sequence.
+        ref_seq (str): A reference protein sequence.
+
+    Returns:
+        tuple: Same output as `align_protein_sequences`, or None if the
+            sequences aren't an exact match.
+    '''
+    if not comp_seq or not ref_seq:
+        return None
+    comp_upper = comp_seq.upper()
+    ref_upper = ref_seq.upper()
+    if len(comp_upper) <= len(ref_upper):
+        offset = _unique_find(ref_upper, comp_upper)
+        length = len(comp_upper)
+    else:
+        offset = _unique_find(comp_upper, ref_upper)
+        if offset is not None:
+            offset = -offset
+        length = len(ref_upper)
+    if offset is None:
+        return None
+    start = max(1, 1 - offset)
+    pdb_to_ref = {key: key + offset for key in range(start, start + length)}
+    ref_to_pdb = {value: key for key, value in pdb_to_ref.items()}
+    return pdb_to_ref, ref_to_pdb
+
+def _exact_cds_alignment(prot_seq, dna_seq):
+    '''
+    Assign codons to a protein sequence without an external process if the
+    protein occurs exactly once within a forward-frame translation of the
+    DNA sequence.
+
+    Args:
+        prot_seq (str): A protein sequence.
+        dna_seq (str): A genomic or coding DNA sequence
+
+    Returns:
+        dict: Same output as `align_protein_to_dna`, or None if no unique
+            exact match is found.
+    '''
+    if not prot_seq:
+        return None
+    prot_upper = prot_seq.upper()
+    dna_upper = dna_seq.upper()
+    match = None
+    for frame in range(3):
+        length = (len(dna_upper) - frame) // 3 * 3
+        try:
+            translated = str(Seq(dna_upper[frame:frame + length]).translate())
+        except TranslationError:
+            # Gaps or unexpected characters, so leave this to the aligners.
+            return None
+        index = _unique_find(translated, prot_upper)
+        if index is None:
+            if prot_upper in translated:
+                return None
+            continue
+        if match is not None:
+            return None
+        match = (frame, index)
+    if match is None:
+        return None
+    frame, index = match
+    first_base = frame + index * 3
+    return {i + 1: (first_base + i*3 + 1, first_base + i*3 + 2, first_base + i*3 + 3)
+            for i in range(len(prot_upper))}
+
 def _align_prot_to_dna_no_exonerate(prot_seq, dna_seq):
     '''
     Aligns a protein sequence to a genomic sequence. Does not take consider
@@ -221,11 +325,11 @@ def _align_prot_to_dna_no_exonerate(prot_seq, dna_seq):
                          key, value in prot_dna_dict.items()}
     return protein_to_codons
 
-def pairwise_align(comp_seq, ref_seq):
+def pairwise_align(comp_seq, ref_seq, band=None, end_gaps_free=True):
     '''
     Perform a pairwise alignment of two sequences.
 
-    Uses the BioPython pairwise2 module with the BLOSUM62 matrix for scoring
+    Uses a built-in affine gap aligner with the BLOSUM62 matrix for scoring
     similarity. Gap opening penalty is -11 and gap extend penalty is -1,
     which is the same as the default blastp parameters.
 
@@ -235,6 +339,12 @@ def pairwise_align(comp_seq, ref_seq):
     Args:
         comp_seq (str): A comparison protein sequence.
         ref_seq (str): A reference protein sequence.
+        band (int, optional): Only consider alignments that stay within this
+            many diagonals of the region spanned by the two sequence ends.
+            Defaults to PAIRWISE_BAND, which computes the full matrix.
+        end_gaps_free (bool, optional): Do not penalize leading and trailing
+            gaps (semi-global alignment). If False, a global alignment is
+            performed. Defaults to True.
 
     Returns:
         dict: A dictionary mapping comparison sequence numbering (key) to
@@ -242,27 +352,137 @@ def pairwise_align(comp_seq, ref_seq):
         dict: A dictionary mapping reference sequence numbering (key) to
             comparison sequence numbering (value)
     '''
-    alignment = align.globalds(comp_seq, ref_seq, matlist.blosum62, -11, -1,
-                               penalize_end_gaps=False, one_alignment_only=True)[0]
-    query_string = alignment[0]
-    sbjct_string = alignment[1]
+    if band is None:
+        band = PAIRWISE_BAND
+    pairs = _affine_align(str(comp_seq), str(ref_seq), band=band,
+                          end_gaps_free=end_gaps_free)
     #Create dictionary mapping position in PDB chain to position in ref sequence
     pdb_to_ref = {}
     ref_to_pdb = {}
-    key = 1
-    ref = 1
-    for i, res in enumerate(query_string):
-        if res.isalpha() and sbjct_string[i].isalpha():
-            pdb_to_ref[key] = ref
-            ref_to_pdb[ref] = key
-            key += 1
-            ref += 1
-        elif res.isalpha():
-            key += 1
-        elif sbjct_string[i].isalpha():
-            ref += 1
+    for key, ref in pairs:
+        pdb_to_ref[key] = ref
+        ref_to_pdb[ref] = key
     return pdb_to_ref, ref_to_pdb
 
+def _blosum62_lookup():
+    '''Return the BLOSUM62 matrix as a 256x256 array indexed by ASCII code.
+
+    Letters that aren't in the BLOSUM62 alphabet are scored as 'X'.
+    '''
+    global _BLOSUM62
+    if _BLOSUM62 is None:
+        from Bio.Align import substitution_matrices
+        matrix = substitution_matrices.load('BLOSUM62')
+        alphabet = matrix.alphabet
+        lookup = np.full((256, 256), int(matrix['X', 'X']), dtype=np.int32)
+        for letter in alphabet:
+            lookup[ord(letter), :] = int(matrix[letter, 'X'])
+            lookup[:, ord(letter)] = int(matrix['X', letter])
+        for letter1 in alphabet:
+            for letter2 in alphabet:
+                lookup[ord(letter1), ord(letter2)] = int(matrix[letter1, letter2])
+        _BLOSUM62 = lookup
+    return _BLOSUM62
+
+def _affine_align(seq1, seq2, band=None, end_gaps_free=True):
+    '''
+    Align two protein sequences with affine gap penalties (Gotoh algorithm).
+
+    Cells along each anti-diagonal of the dynamic programming matrices only
+    depend on the previous two anti-diagonals, so each anti-diagonal is
+    computed in a single vectorised step.
+
+    Args:
+        seq1 (str): First protein sequence.
+        seq2 (str): Second protein sequence.
+        band (int, optional): Band width, or None for the full matrix.
+        end_gaps_free (bool, optional): Do not penalize end gaps.
+
+    Returns:
+        list: Aligned (seq1 position, seq2 position) pairs, 1-indexed and in
+            increasing order.
+    '''
+    len1 = len(seq1)
+    len2 = len(seq2)
+    if not len1 or not len2:
+        return []
+    lookup = _blosum62_lookup()
+    codes1 = np.frombuffer(seq1.upper().encode('ascii', 'replace'), dtype=np.uint8)
+    codes2 = np.frombuffer(seq2.upper().encode('ascii', 'replace'), dtype=np.uint8)
+    shape = (len1 + 1, len2 + 1)
+    # Match/mismatch, gap in seq2 (consumes seq1) and gap in seq1 (consumes seq2)
+    match = np.full(shape, _NEG_INF, dtype=np.int32)
+    gap1 = np.full(shape, _NEG_INF, dtype=np.int32)
+    gap2 = np.full(shape, _NEG_INF, dtype=np.int32)
+    match_ptr = np.zeros(shape, dtype=np.int8)
+    gap1_ptr = np.zeros(shape, dtype=np.int8)
+    gap2_ptr = np.zeros(shape, dtype=np.int8)
+    if end_gaps_free:
+        match[:, 0] = 0
+        match[0, :] = 0
+    else:
+        match[0, 0] = 0
+        gap1[1:, 0] = _GAP_OPEN + _GAP_EXTEND * np.arange(len1)
+        gap2[0, 1:] = _GAP_OPEN + _GAP_EXTEND * np.arange(len2)
+        gap1_ptr[2:, 0] = 1
+        gap2_ptr[0, 2:] = 1
+    # Allowed range of diagonals (j - i) if banded.
+    if band is not None:
+        low_diag = min(0, len2 - len1) - band
+        high_diag = max(0, len2 - len1) + band
+    for diag in range(2, len1 + len2 + 1):
+        i_start = max(1, diag - len2)
+        i_end = min(len1, diag - 1)
+        if band is not None:
+            i_start = max(i_start, -((high_diag - diag) // 2))
+            i_end = min(i_end, (diag - low_diag) // 2)
+        if i_start > i_end:
+            continue
+        i = np.arange(i_start, i_end + 1)
+        j = diag - i
+        prev = np.stack((match[i-1, j-1], gap1[i-1, j-1], gap2[i-1, j-1]))
+        best_prev = prev.argmax(axis=0)
+        match[i, j] = (prev[best_prev, np.arange(len(i))] +
+                       lookup[codes1[i-1], codes2[j-1]])
+        match_ptr[i, j] = best_prev
+        open_gap = match[i-1, j] + _GAP_OPEN
+        extend_gap = gap1[i-1, j] + _GAP_EXTEND
+        gap1[i, j] = np.maximum(open_gap, extend_gap)
+        gap1_ptr[i, j] = extend_gap > open_gap
+        open_gap = match[i, j-1] + _GAP_OPEN
+        extend_gap = gap2[i, j-1] + _GAP_EXTEND
+        gap2[i, j] = np.maximum(open_gap, extend_gap)
+        gap2_ptr[i, j] = extend_gap > open_gap
+    # Find the end point of the highest scoring alignment
+    if end_gaps_free:
+        last_row = np.maximum(np.maximum(match[len1, :], gap1[len1, :]),
+                              gap2[len1, :])
+        last_col = np.maximum(np.maximum(match[:, len2], gap1[:, len2]),
+                              gap2[:, len2])
+        if last_row.max() >= last_col.max():
+            i, j = len1, int(last_row.argmax())
+        else:
+            i, j = int(last_col.argmax()), len2
+    else:
+        i, j = len1, len2
+    state = int(np.argmax((match[i, j], gap1[i, j], gap2[i, j])))
+    # Traceback
+    pairs = []
+    while i > 0 and j > 0:
+        if state == 0:
+            pairs.append((i, j))
+            state = int(match_ptr[i, j])
+            i -= 1
+            j -= 1
+        elif state == 1:
+            state = 1 if gap1_ptr[i, j] else 0
+            i -= 1
+        else:
+            state = 2 if gap2_ptr[i, j] else 0
+            j -= 1
+    pairs.reverse()
+    return pairs
+
 def blast_sequences(comp_seq, ref_seq):
     '''
     Perform BLAST of two protein sequences using NCBI BLAST+ package.
@@ -283,6 +503,9 @@ def blast_sequences(comp_seq, ref_seq):
         dict: A dictionary mapping reference sequence numbering (key) to
             comparison sequence numbering (value)
     '''
+    # Bio.Blast is only imported when BLAST is run, as it is slow to import.
+    from Bio.Blast.Applications import NcbiblastpCommandline
+    from Bio.Blast import NCBIXML
     with tempfile.NamedTemporaryFile(mode='w') as comp_seq_file, \
          tempfile.NamedTemporaryFile(mode='w') as ref_seq_file:
         comp_seq_file.write(">\n" + str(comp_seq) + "\n")
@@ -292,6 +515,7 @@ def blast_sequences(comp_seq, ref_seq):
         blastp_cline = NcbiblastpCommandline(query=comp_seq_file.name,
                                              subject=ref_seq_file.name,
                                              evalue=0.001, outfmt=5)
+        instrument.count('process.blastp')
         alignment, _stderror = blastp_cline()
     blast_xml = StringIO(alignment)
     blast_record = NCBIXML.read(blast_xml)
@@ -504,6 +728,7 @@ def _align_prot_to_dna_exonerate(prot_seq, dna_seq):
             threshold = str(len(prot_seq) * 3)
             exonerate_call.append("--score")
             exonerate_call.append(threshold)
+        instrument.count('process.exonerate')
         alignment = subprocess.check_output(exonerate_call)
     vulgar_re = re.search(r"(?<=vulgar:).*(?=\n)",
                           alignment.decode("utf-8"))
@@ -0,0 +1,269 @@
+"""Mapping of data over trajectories, such as those from molecular dynamics
+simulations, stored as multi-model PDB files.
+
+Helper module for the biostructmap package. Frames are read one at a time, so
+that memory use does not depend on the length of the trajectory. Nearby
+residues are found using a Verlet list: candidate atom pairs are found using a
+KD-tree with a radius extended by a skin distance, and only need to be found
+again once atoms have moved more than half the skin distance. For other frames,
+nearby residues are found by checking distances between candidate pairs.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from . import pdbtools, readers
+from .biostructmap import Structure, DataMap, mapping_methods, open_if_string
+
+# Default skin distance (Angstrom) added to the radius when finding candidate
+# atom pairs.
+DEFAULT_SKIN = 2.0
+
+
+class VerletList(object):
+    '''A list of nearby residues for each residue, updated as atoms move.
+
+    Candidate atom pairs within `radius + skin` are found using a KD-tree,
+    and these are only found again once an atom has moved more than half the
+    skin distance since they were last found. Until then, no atom pair outside
+    of the candidate list can come within `radius`.
+
+    Attributes:
+        radius (float): Radius within which residues are nearby.
+        skin (float): Skin distance added to the radius for candidate pairs.
+        residue_ids (list): Residue ids (chain id, residue id) of residues
+            with selected atoms.
+        n_builds (int): Number of times candidate pairs have been found.
+    '''
+    def __init__(self, atoms, radius=15, selector='all', skin=DEFAULT_SKIN):
+        '''Initialise a VerletList object.
+
+        Args:
+            atoms (AtomTable): Atoms from the first frame (see
+                biostructmap.readers). Coordinates for each frame must be
+                matched to these atoms.
+            radius (float/int): The radius (Angstrom) over which to select
+                nearby residues.
+            selector (str): The atom in each residue with which to compute
+                distances. See `pdbtools.nearby` for details.
+            skin (float/int): Skin distance (Angstrom).
+        '''
+        if not pdbtools.SCIPY_PRESENT:
+            raise ImportError("Scipy is required to find nearby residues "
+                              "over a trajectory.")
+        self.radius = radius
+        self.skin = skin
+        self.n_builds = 0
+        self._atom_indices, self._atom_residue, self.residue_ids = (
+            atoms.select_indices(selector))
+        self._reference = None
+        self._present = None
+        self._first_atoms = None
+        self._second_atoms = None
+        self._pair_starts = None
+        self._order = None
+        self._centre = None
+        self._nearby = None
+
+    def _needs_build(self, coords, present):
+        '''Check if candidate pairs need to be found again.'''
+        if self._reference is None or not np.array_equal(present,
+                                                          self._present):
+            return True
+        displacement = coords[present] - self._reference[present]
+        max_squared = np.einsum('ij,ij->i', displacement, displacement).max(
+            initial=0)
+        return max_squared > (self.skin / 2) ** 2
+
+    def _build(self, coords, present):
+        '''Find candidate atom pairs within `radius + skin`.
+
+        Candidate pairs are sorted by residue pair, so that nearby residues
+        can be found for each frame without sorting.
+        '''
+        from scipy.spatial import cKDTree
+        n_residues = len(self.residue_ids)
+        present_atoms = np.flatnonzero(present)
+        pairs = present_atoms[cKDTree(coords[present_atoms]).query_pairs(
+            self.radius + self.skin, output_type='ndarray')]
+        first = self._atom_residue[pairs[:, 0]]
+        second = self._atom_residue[pairs[:, 1]]
+        # Pairs within a residue are ignored, as every residue is nearby
+        # itself.
+        between = first != second
+        pairs, first, second = pairs[between], first[between], second[between]
+        residue_pairs = (np.minimum(first, second) * n_residues +
+                         np.maximum(first, second))
+        order = np.argsort(residue_pairs, kind='stable')
+        residue_pairs = residue_pairs[order]
+        # Atom indices for each candidate pair are stored separately, as
+        # contiguous arrays are faster to index.
+        self._first_atoms = pairs[order, 0]
+        self._second_atoms = pairs[order, 1]
+        self._pair_starts = np.flatnonzero(np.diff(residue_pairs, prepend=-1))
+        residue_pairs = residue_pairs[self._pair_starts]
+        # Each residue pair is included in both directions, along with self
+        # pairs. These are sorted by the central residue once, and filtered
+        # for each frame.
+        first = residue_pairs // n_residues
+        second = residue_pairs % n_residues
+        residues = np.arange(n_residues)
+        centre = np.concatenate((first, second, residues))
+        nearby = np.concatenate((second, first, residues))
+        self._order = np.lexsort((nearby, centre))
+        self._centre = centre[self._order]
+        self._nearby = nearby[self._order]
+        self._reference = coords
+        self._present = present
+        self.n_builds += 1
+
+    def update(self, coords):
+        '''Find nearby residues for a new set of atom coordinates.
+
+        Args:
+            coords (np.array): An (n_atoms, 3) array of coordinates for all
+                atoms in the first frame (NaN for missing atoms), as given by
+                `readers.iter_model_coords`.
+        Returns:
+            list: Residue ids (chain id, residue id) for all residues.
+            np.array: Index into `indices` of the first nearby residue for each
+                residue.
+            np.array: Indices (into the list of residue ids) of nearby
+                residues, sorted for each residue.
+        '''
+        n_residues = len(self.residue_ids)
+        if not n_residues:
+            return (self.residue_ids, np.zeros(1, dtype='int64'),
+                    np.zeros(0, dtype='int64'))
+        coords = coords[self._atom_indices]
+        present = np.isfinite(coords).all(axis=1)
+        if self._needs_build(coords, present):
+            self._build(coords, present)
+        squared = np.zeros(len(self._first_atoms))
+        for axis in np.ascontiguousarray(coords.T):
+            delta = axis.take(self._first_atoms) - axis.take(self._second_atoms)
+            delta *= delta
+            squared += delta
+        close = squared <= self.radius ** 2
+        if len(close):
+            close_residues = np.logical_or.reduceat(close, self._pair_starts)
+        else:
+            close_residues = close
+        keep = np.concatenate((close_residues, close_residues,
+                               np.ones(n_residues, dtype=bool)))[self._order]
+        indices = self._nearby[keep]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(
+            self._centre[keep], minlength=n_residues))))
+        return self.residue_ids, indptr, indices
+
+
+class Trajectory(object):
+    '''A trajectory stored as a multi-model PDB (or mmCIF) file, with each
+    model giving a single frame.
+
+    Residue identities, sequences and alignments to reference sequences are
+    taken from the first frame, and are shared by all frames. Frames are then
+    read one at a time, so that data can be mapped over trajectories with
+    many thousands of frames.
+
+    Attributes:
+        structure (Structure): Structure object for the first frame.
+        skin (float): Skin distance (Angstrom) used when finding nearby
+            residues (see `VerletList`).
+    '''
+    def __init__(self, pdbfile, pdbname='pdb_file', mmcif=False,
+                 skin=DEFAULT_SKIN):
+        '''Initialise a Trajectory object.
+
+        Args:
+            pdbfile (str/file-object): A filename string or a file-like object
+                that contains a multi-model PDB file.
+            pdbname (str, optional): A descriptive name for the PDB file.
+            mmcif (bool, optional): Set to true if reading a PDBx/mmCIF file.
+                Note that the _atom_site loop of an mmCIF file is read in
+                full, so memory use will depend on the number of frames.
+            skin (float, optional): Skin distance (Angstrom) used when finding
+                nearby residues. Larger values mean candidate pairs are found
+                less often, but more pairs are checked for each frame.
+        '''
+        self.structure = Structure(pdbfile, pdbname=pdbname, mmcif=mmcif)
+        self.skin = skin
+
+    def frames(self):
+        '''Read atom coordinates for each frame in turn.
+
+        Yields:
+            np.array: An (n_atoms, 3) array of coordinates for each frame,
+                matched to the atoms of the first frame (see
+                `Structure.atoms`), with NaN for missing atoms.
+        '''
+        atoms = self.structure.atoms()
+        with open_if_string(self.structure.pdb_file(), 'r') as f:
+            for coords in readers.iter_model_coords(f, atoms,
+                                                    self.structure._mmcif):
+                yield coords
+
+    def nearby_arrays(self, radius=15, atom='all'):
+        '''Find all residues within a radius of each residue, for each frame
+        in turn.
+
+        Args:
+            radius (int/float): Radius within which to find nearby residues for
+                each residue.
+            atom (str): The atom with which to compute distances. See
+                `Structure.nearby` for details.
+
+        Yields:
+            tuple: Nearby residues for each frame, in the format returned by
+                `Structure.nearby_arrays`.
+        '''
+        neighbours = VerletList(self.structure.atoms(), radius, atom,
+                                self.skin)
+        for coords in self.frames():
+            yield neighbours.update(coords)
+
+    def map(self, data, method='default', ref=None, radius=15, selector='all',
+            map_to_dna=False, method_params=None):
+        '''Perform a mapping of some parameter or function over each frame of
+        the trajectory, using a 3D sliding window. See `Structure.map` for
+        details of arguments.
+
+        Mapping functions are passed the Structure object for the first frame,
+        along with nearby residues for the current frame.
+
+        Args:
+            data (dict/object): Data to be mapped over structure.
+            method (str/function): Mapping method.
+            ref (dict): A reference sequence for each chain. Defaults to the
+                sequences of the first frame.
+            radius (int/float, optional): The radius (Angstrom) over which to
+                select nearby residues for inclusion within each 3D window.
+            selector (str, optional): The atom with which to compute distances
+                between residues.
+            map_to_dna (bool, optional): Set True if the mapping method involves
+                aligning to a DNA sequence.
+            method_params (dict): Additional parameters to pass to the mapping
+                method.
+
+        Yields:
+            biostructmap.DataMap: Mapped values for each frame. The frame
+                number (starting from 0) is given by `params['frame']`.
+        '''
+        if method in mapping_methods:
+            method = mapping_methods[method]
+
+        if map_to_dna and ref is None:
+            raise ValueError("Must provide a reference DNA sequence if you "\
+                             "are mapping to DNA.")
+        elif ref is None:
+            ref = self.structure.sequences
+
+        for frame, nearby_arrays in enumerate(self.nearby_arrays(radius,
+                                                                 selector)):
+            residue_map = pdbtools.nearby_arrays_to_dict(*nearby_arrays)
+            results = self.structure._map_windows(residue_map, data, method,
+                                                  ref, map_to_dna,
+                                                  method_params)
+            params = {'radius': radius, 'selector': selector, 'frame': frame}
+            datamap = DataMap(results, structure=self.structure, params=params)
+            datamap.nearby_arrays = nearby_arrays
+            yield datamap
@@ -0,0 +1,454 @@
+"""Tools for writing mapped data to structure files.
+
+Helper module for the biostructmap package. Rather than copying and
+modifying a Bio.PDB structure, data is written by streaming the original
+coordinate records (PDB ATOM/HETATM records or the mmCIF _atom_site loop) and
+rewriting only the columns that hold data. The original records are read
+once, and can then be reused to write any number of data maps.
+"""
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import re
+
+import numpy as np
+
+# Columns (0-indexed, end exclusive) of the B-factor field in PDB ATOM and
+# HETATM records.
+_PDB_B_FACTOR_COLUMNS = (60, 66)
+# Records that hold atom coordinates, or relate to individual atoms.
+_COORDINATE_RECORDS = ('ATOM  ', 'HETATM', 'ANISOU', 'TER', 'SIGATM', 'SIGUIJ')
+# Placeholders for unknown or inapplicable mmCIF values.
+_MMCIF_UNASSIGNED = ('.', '?')
+# Line indices that are not rewritten.
+_NOT_AN_ATOM = -2
+# Line indices for atoms in the first model that have no residue table entry.
+_NO_RESIDUE = -1
+
+
+def _pdb_residue_id(line):
+    '''Get the Bio.PDB residue id for a PDB ATOM or HETATM record.
+
+    Args:
+        line (str): An ATOM or HETATM record.
+    Returns:
+        tuple: Residue id (chain id, (hetero flag, residue number,
+            insertion code)), matching those assigned by Bio.PDB.
+    '''
+    resname = line[17:20].strip()
+    if line.startswith('HETATM'):
+        if resname in ('HOH', 'WAT'):
+            hetero_flag = 'W'
+        else:
+            hetero_flag = 'H_' + resname
+    else:
+        hetero_flag = ' '
+    return (line[21], (hetero_flag, int(line[22:26]), line[26]))
+
+
+def format_b_factor(value):
+    '''Format a value for the PDB B-factor column.
+
+    Args:
+        value (float): Value to write.
+    Returns:
+        str: Value formatted to fit within the B-factor column.
+    Raises:
+        ValueError: If value is too large to fit within the B-factor column.
+    '''
+    formatted = '{0:6.2f}'.format(value)
+    if len(formatted) > _PDB_B_FACTOR_COLUMNS[1] - _PDB_B_FACTOR_COLUMNS[0]:
+        raise ValueError("Value {value} is too large to write to the PDB "
+                         "B-factor column. Try using a smaller "
+                         "scale_factor.".format(value=value))
+    return formatted
+
+
+class PDBTemplate(object):
+    '''Original records from a PDB file, used to write data to the B-factor
+    column of each atom.
+
+    Each ATOM/HETATM record within the first model is matched to a row of a
+    residue table (see biostructmap.residue_table). When writing data, the
+    B-factor field of these records is replaced. All other records (including
+    atoms in subsequent models) are written unchanged.
+
+    Attributes:
+        lines (list): All lines from the original PDB file.
+        rows (np.array): Residue table row for each line.
+    '''
+    def __init__(self, lines, rows):
+        '''Initialise a PDBTemplate object.
+
+        Args:
+            lines (list): All lines from the original PDB file.
+            rows (np.array): Residue table row for each line. Lines that
+                shouldn't be rewritten are given a value of -2, and atoms
+                without a residue table entry are given a value of -1.
+        '''
+        self.lines = lines
+        self.rows = rows
+        # Split atom records around the B-factor field once, so that this
+        # work is shared when writing many data maps.
+        start, end = _PDB_B_FACTOR_COLUMNS
+        self._pieces = []
+        for line, row in zip(lines, rows):
+            if row == _NOT_AN_ATOM:
+                self._pieces.append((line, None, row))
+            else:
+                line_end = line[end:] if len(line) > end else '\n'
+                self._pieces.append((line[:start].ljust(start), line_end, row))
+        # Find the records making up the first model, as well as any records
+        # before (header) and after (trailer) all models.
+        model_lines = [i for i, line in enumerate(lines) if
+                       line.startswith(('MODEL ', 'ENDMDL'))]
+        coordinate_lines = [i for i, line in enumerate(lines) if
+                            line.startswith(_COORDINATE_RECORDS)]
+        if model_lines:
+            self._header_end = model_lines[0]
+            self._model = (model_lines[0] + 1, model_lines[1] if
+                           len(model_lines) > 1 else len(lines))
+            self._trailer_start = model_lines[-1] + 1
+        elif coordinate_lines:
+            self._header_end = coordinate_lines[0]
+            self._model = (coordinate_lines[0], coordinate_lines[-1] + 1)
+            self._trailer_start = coordinate_lines[-1] + 1
+        else:
+            self._header_end = len(lines)
+            self._model = (len(lines), len(lines))
+            self._trailer_start = len(lines)
+
+    @classmethod
+    def from_file(cls, fileobj, row_index):
+        '''Read a PDB file and match atom records to residue table rows.
+
+        Args:
+            fileobj (file-like object): An open PDB file.
+            row_index (dict): Residue table row for each residue id.
+        Returns:
+            PDBTemplate: Template for writing data to the PDB file.
+        '''
+        lines = fileobj.readlines()
+        rows = np.full(len(lines), _NOT_AN_ATOM, dtype='i8')
+        previous_key = None
+        previous_row = _NO_RESIDUE
+        for i, line in enumerate(lines):
+            if line.startswith('ENDMDL'):
+                # Only write data to the first model.
+                break
+            if not line.startswith(('ATOM  ', 'HETATM')):
+                continue
+            key = line[17:27]
+            if key != previous_key:
+                previous_key = key
+                previous_row = row_index.get(_pdb_residue_id(line), _NO_RESIDUE)
+            rows[i] = previous_row
+        return cls(lines, rows)
+
+    def _write_lines(self, fileobj, start, end, formatted, default):
+        '''Write a range of lines, substituting formatted B-factors.'''
+        for prefix, suffix, row in self._pieces[start:end]:
+            if suffix is None:
+                fileobj.write(prefix)
+            elif row >= 0:
+                fileobj.write(prefix + formatted[row] + suffix)
+            else:
+                fileobj.write(prefix + default + suffix)
+
+    def write(self, fileobj, values, default_no_value=0):
+        '''Write PDB records, replacing the B-factor field of each atom.
+
+        Args:
+            fileobj (file-like object): Output file.
+            values (np.array): Value to write for each residue table row,
+                with NaN where there is no value.
+            default_no_value (int/float, optional): Value to write if there is
+                no value for a residue.
+        '''
+        default = format_b_factor(default_no_value)
+        formatted = _format_values(values, default)
+        self._write_lines(fileobj, 0, len(self._pieces), formatted, default)
+
+    def write_models(self, fileobj, values_list, default_no_value=0):
+        '''Write a multi-model PDB file, with the first model of the
+        original file repeated for each set of values.
+
+        Header records are written once, followed by one model for each set
+        of values, and then any trailing records (except MASTER, which would
+        no longer be correct).
+
+        Args:
+            fileobj (file-like object): Output file.
+            values_list (list): A list of arrays, each giving the value to
+                write for each residue table row (NaN where there is no value).
+            default_no_value (int/float, optional): Value to write if there is
+                no value for a residue.
+        '''
+        default = format_b_factor(default_no_value)
+        self._write_lines(fileobj, 0, self._header_end, None, default)
+        for model_number, values in enumerate(values_list, start=1):
+            formatted = _format_values(values, default)
+            fileobj.write('MODEL     {0:>4}\n'.format(model_number))
+            self._write_lines(fileobj, self._model[0], self._model[1],
+                              formatted, default)
+            fileobj.write('ENDMDL\n')
+        for line in self.lines[self._trailer_start:]:
+            if not line.startswith('MASTER'):
+                fileobj.write(line)
+
+
+def _format_values(values, default):
+    '''Format values for the PDB B-factor column, using `default` for
+    missing (NaN) values.'''
+    return [default if np.isnan(value) else format_b_factor(value)
+            for value in values]
+
+
+def _mmcif_value(tokens, fields, names, missing=' '):
+    '''Get the first of several _atom_site values present in a row.'''
+    for name in names:
+        if name in fields:
+            value = tokens[fields[name]]
+            return missing if value in _MMCIF_UNASSIGNED else value
+    return missing
+
+
+def _mmcif_residue_id(tokens, fields):
+    '''Get the Bio.PDB residue id for a row of the mmCIF _atom_site loop.
+
+    Args:
+        tokens (list): Values within an _atom_site row.
+        fields (dict): Index of each _atom_site field, accessed by name.
+    Returns:
+        tuple: Residue id (chain id, (hetero flag, residue number,
+            insertion code)), matching those assigned by Bio.PDB.
+    '''
+    # Unlike Bio.PDB.PDBParser, Bio.PDB.FastMMCIFParser doesn't give water
+    # molecules a separate hetero flag.
+    if tokens[fields['group_PDB']] == 'HETATM':
+        hetero_flag = 'H_' + tokens[fields['label_comp_id']]
+    else:
+        hetero_flag = ' '
+    chain = _mmcif_value(tokens, fields, ('auth_asym_id', 'label_asym_id'))
+    resseq = int(_mmcif_value(tokens, fields, ('auth_seq_id', 'label_seq_id')))
+    icode = _mmcif_value(tokens, fields, ('pdbx_PDB_ins_code',))
+    return (chain, (hetero_flag, resseq, icode))
+
+
+def format_mmcif_value(value):
+    '''Format a value for an mmCIF _atom_site column.
+
+    Unlike the PDB B-factor column, there is no limit on the width of mmCIF
+    values, so values are written with six significant figures.
+
+    Args:
+        value (float): Value to write. If None, the mmCIF placeholder for an
+            unknown value (`?`) is written.
+    Returns:
+        str: Formatted value.
+    '''
+    if value is None:
+        return '?'
+    return '{0:.6g}'.format(value)
+
+
+class MMCIFTemplate(object):
+    '''Original records from an mmCIF file, used to write data to a column of
+    the _atom_site loop.
+
+    Each _atom_site row is matched to a row of a residue table (see
+    biostructmap.residue_table). When writing data, the chosen column of rows
+    within the first model is replaced, keeping the original alignment of all
+    other values. If the column doesn't exist, it is added to the loop. All
+    other lines are written unchanged.
+
+    Note that, as with Bio.PDB.FastMMCIFParser, _atom_site values are
+    expected to be free of whitespace, and each row to be on a single line.
+
+    Attributes:
+        lines (list): All lines from the original mmCIF file.
+        fields (dict): Index of each _atom_site field, accessed by name.
+        rows (np.array): Residue table row for each line.
+        model_index (np.array): Index of the model (in order of appearance)
+            for each _atom_site row, or -1 for all other lines.
+    '''
+    def __init__(self, lines, fields, field_end, rows, model_index):
+        '''Initialise an MMCIFTemplate object.
+
+        Args:
+            lines (list): All lines from the original mmCIF file.
+            fields (dict): Index of each _atom_site field, accessed by name.
+            field_end (int): Index of the line after the last _atom_site
+                field name.
+            rows (np.array): Residue table row for each line. Lines that
+                aren't _atom_site rows are given a value of -2, and atoms
+                without a residue table entry are given a value of -1.
+            model_index (np.array): Index of the model for each
+                _atom_site row, or -1 for all other lines.
+        '''
+        self.lines = lines
+        self.fields = fields
+        self.rows = rows
+        self.model_index = model_index
+        self._field_end = field_end
+        self._atom_lines = np.flatnonzero(rows != _NOT_AN_ATOM)
+        self._pieces = {}
+
+    @classmethod
+    def from_file(cls, fileobj, row_index):
+        '''Read an mmCIF file and match _atom_site rows to residue table rows.
+
+        Args:
+            fileobj (file-like object): An open mmCIF file.
+            row_index (dict): Residue table row for each residue id.
+        Returns:
+            MMCIFTemplate: Template for writing data to the mmCIF file.
+        '''
+        lines = fileobj.readlines()
+        rows = np.full(len(lines), _NOT_AN_ATOM, dtype='i8')
+        model_index = np.full(len(lines), -1, dtype='i8')
+        fields = {}
+        field_end = None
+        models = {}
+        for i, line in enumerate(lines):
+            if line.startswith('_atom_site.'):
+                name_and_value = line.split()
+                if len(name_and_value) != 1:
+                    raise ValueError("Only mmCIF files with an _atom_site "
+                                     "loop are supported.")
+                fields[name_and_value[0][len('_atom_site.'):]] = len(fields)
+                field_end = i + 1
+                continue
+            if field_end is None:
+                continue
+            if line.startswith(('#', 'loop_', '_', 'data_')):
+                break
+            tokens = line.split()
+            if not tokens:
+                continue
+            if len(tokens) != len(fields):
+                raise ValueError("Could not read _atom_site row: "
+                                 "{line}".format(line=line.strip()))
+            if 'pdbx_PDB_model_num' in fields:
+                model = tokens[fields['pdbx_PDB_model_num']]
+            else:
+                model = None
+            model_index[i] = models.setdefault(model, len(models))
+            rows[i] = row_index.get(_mmcif_residue_id(tokens, fields),
+                                    _NO_RESIDUE)
+        if field_end is None:
+            raise ValueError("No _atom_site records found in mmCIF file.")
+        return cls(lines, fields, field_end, rows, model_index)
+
+    def atom_rows(self, model_index=0):
+        '''Get the atom id and residue table row for each atom in a model.
+
+        Args:
+            model_index (int, optional): Index of the model (in order of
+                appearance). Defaults to the first model.
+        Returns:
+            list: A list of (atom id, residue table row) tuples.
+        '''
+        id_index = self.fields['id']
+        return [(self.lines[i].split()[id_index], self.rows[i]) for i in
+                self._atom_lines if self.model_index[i] == model_index]
+
+    def _column_pieces(self, column):
+        '''Split rows of the first model around a column, so that this work
+        is shared when writing many data maps.'''
+        if column in self._pieces:
+            return self._pieces[column]
+        pieces = []
+        field = self.fields.get(column)
+        for i in self._atom_lines:
+            if self.model_index[i] != 0:
+                continue
+            line = self.lines[i]
+            if field is None:
+                pieces.append((i, line.rstrip('\r\n') + ' ', '\n', 0))
+                continue
+            token_spans = [match.span() for match in re.finditer(r'\S+', line)]
+            start, end = token_spans[field]
+            # Pad values to keep following values aligned where possible.
+            if field + 1 < len(token_spans):
+                end = token_spans[field + 1][0] - 1
+            pieces.append((i, line[:start], line[end:], end - start))
+        self._pieces[column] = pieces
+        return pieces
+
+    def write(self, fileobj, values, default_no_value=0,
+              column='B_iso_or_equiv'):
+        '''Write mmCIF records, replacing a column of the _atom_site loop.
+
+        Args:
+            fileobj (file-like object): Output file.
+            values (np.array): Value to write for each residue table row,
+                with NaN where there is no value.
+            default_no_value (int/float, optional): Value to write if there is
+                no value for a residue. If None, `?` is written.
+            column (str, optional): Name of the _atom_site column to write
+                values to. If this column doesn't exist, it is added. Defaults
+                to `B_iso_or_equiv`.
+        '''
+        default = format_mmcif_value(default_no_value)
+        formatted = [default if np.isnan(value) else format_mmcif_value(value)
+                     for value in values]
+        replacements = {}
+        for i, prefix, suffix, width in self._column_pieces(column):
+            row = self.rows[i]
+            value = formatted[row] if row >= 0 else default
+            replacements[i] = prefix + value.ljust(width) + suffix
+        new_column = column not in self.fields
+        for i, line in enumerate(self.lines):
+            if new_column and i == self._field_end:
+                fileobj.write('_atom_site.' + column + '\n')
+            if new_column and self.rows[i] != _NOT_AN_ATOM and i not in replacements:
+                # Atoms in other models are given an unknown value.
+                fileobj.write(line.rstrip('\r\n') + ' ?\n')
+            else:
+                fileobj.write(replacements.get(i, line))
+
+    def write_models(self, fileobj, values_list, default_no_value=0,
+                     column='B_iso_or_equiv'):
+        '''Write a multi-model mmCIF file, with the first model of the
+        original file repeated for each set of values.
+
+        All lines outside of the _atom_site loop are written unchanged. Within
+        the loop, atom ids are renumbered sequentially and models are
+        numbered from 1.
+
+        Args:
+            fileobj (file-like object): Output file.
+            values_list (list): A list of arrays, each giving the value to
+                write for each residue table row (NaN where there is no value).
+            default_no_value (int/float, optional): Value to write if there is
+                no value for a residue. If None, `?` is written.
+            column (str, optional): Name of the _atom_site column to write
+                values to. If this column doesn't exist, it is added.
+        '''
+        default = format_mmcif_value(default_no_value)
+        fields = dict(self.fields)
+        if column not in fields:
+            fields[column] = len(fields)
+        first_model = [(self.lines[i].split(), self.rows[i]) for i in
+                       self._atom_lines if self.model_index[i] == 0]
+        atom_id = itertools.count(1)
+        for i, line in enumerate(self.lines):
+            if self.rows[i] != _NOT_AN_ATOM:
+                if i != self._atom_lines[0]:
+                    continue
+                for model_number, values in enumerate(values_list, start=1):
+                    formatted = [default if np.isnan(value) else
+                                 format_mmcif_value(value) for value in values]
+                    for tokens, row in first_model:
+                        tokens = tokens + ['?'] * (len(fields) - len(tokens))
+                        tokens[fields[column]] = (formatted[row] if row >= 0
+                                                  else default)
+                        tokens[fields['id']] = str(next(atom_id))
+                        if 'pdbx_PDB_model_num' in fields:
+                            tokens[fields['pdbx_PDB_model_num']] = str(model_number)
+                        fileobj.write(' '.join(tokens) + '\n')
+                continue
+            if column not in self.fields and i == self._field_end:
+                fileobj.write('_atom_site.' + column + '\n')
+            fileobj.write(line)
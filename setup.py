@@ -44,11 +44,14 @@ setup(
     author='Andrew Guy',
     tests_require=['pytest'],
     setup_requires=['numpy'],
-    install_requires=['Biopython>=1.66',
+    install_requires=['Biopython>=1.75',
                       'DendroPy>=4.0.3',
                       'numpy'
                      ],
     cmdclass={'test': PyTest},
+    entry_points={
+        'console_scripts': ['biostructmap-batch=biostructmap.batch:main'],
+    },
     author_email='andrewjguy42@gmail.com',
     description='A package for mapping biological data onto protein PDB structures',
     long_description=LONG_DESCRIPTION,
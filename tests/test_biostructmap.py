@@ -1,16 +1,27 @@
 from __future__ import absolute_import, division, print_function
 
+import ast
+import copy
 import io
-from unittest import TestCase
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, mock
 import numpy as np
 from math import log
 
 import Bio.PDB
 from Bio import AlignIO
 from Bio.Seq import Seq
+from Bio.SeqUtils import ProtParamData
 from Bio.PDB.MMCIF2Dict import MMCIF2Dict
 from Bio.PDB.PDBExceptions import PDBConstructionWarning
-from biostructmap import biostructmap, seqtools, gentests, pdbtools
+from biostructmap import (biostructmap, seqtools, gentests, pdbtools, cache,
+                          readers, residue_table, trajectory, batch,
+                          instrument, map_functions)
 from biostructmap.seqtools import (_sliding_window, _sliding_window_var_sites,
                                    _construct_sub_align, check_for_uncertain_bases)
 from biostructmap.gentests import _tajimas_d
@@ -25,6 +36,26 @@ STANDARD_AA_3_LETTERS = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY',
                          'HIS', 'ILE', 'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER',
                          'THR', 'TRP', 'TYR', 'VAL']
 
+# Cached results (eg. from DSSP) are written to a temporary directory, rather
+# than the user's cache directory.
+_CACHE_DIR = None
+_CACHE_PATCHERS = []
+
+def setUpModule():
+    global _CACHE_DIR
+    _CACHE_DIR = tempfile.TemporaryDirectory()
+    _CACHE_PATCHERS.extend([
+        mock.patch.object(cache, 'CACHE_DIR', _CACHE_DIR.name),
+        mock.patch.dict(os.environ, {'BIOSTRUCTMAP_CACHE_DIR': _CACHE_DIR.name})])
+    for patcher in _CACHE_PATCHERS:
+        patcher.start()
+
+def tearDownModule():
+    for patcher in _CACHE_PATCHERS:
+        patcher.stop()
+    del _CACHE_PATCHERS[:]
+    _CACHE_DIR.cleanup()
+
 class TestPdbtools(TestCase):
     def setUp(self):
         self.test_pdb_file = './tests/pdb/1zrl.pdb'
@@ -90,6 +121,119 @@ class TestPdbtools(TestCase):
         result = nearby[test_residue]
         self.assertEqual(result, residues_to_match)
 
+    def test_nearby_residue_arrays_with_mask(self):
+        residue_ids, indptr, indices = pdbtools.nearby_arrays(self.test_model,
+                                                              15, 'CA')
+        nearby = pdbtools.nearby(self.test_model, 15, 'CA')
+        self.assertEqual(pdbtools.nearby_arrays_to_dict(residue_ids, indptr,
+                                                        indices), nearby)
+        mask = np.array([x[1][1] % 2 == 0 for x in residue_ids])
+        filtered = pdbtools.nearby_arrays_to_dict(residue_ids, indptr,
+                                                  indices, mask)
+        self.assertEqual(filtered[('A', (' ', 57, ' '))], None)
+        self.assertEqual(filtered[('A', (' ', 58, ' '))],
+                         {x for x in nearby[('A', (' ', 58, ' '))]
+                          if x[1][1] % 2 == 0})
+
+    def test_atom_reader_matches_bio_pdb(self):
+        for filename, mmcif in [('./tests/pdb/1zrl.pdb', False),
+                                ('./tests/pdb/1as5.pdb', False),
+                                ('./tests/pdb/4nuv.cif', True)]:
+            with open(filename) as f:
+                if mmcif:
+                    atoms = readers.read_mmcif_atoms(f)
+                    bio_structure = Bio.PDB.FastMMCIFParser().get_structure(
+                        'test', filename)
+                else:
+                    atoms = readers.read_pdb_atoms(f)
+                    bio_structure = Bio.PDB.PDBParser().get_structure(
+                        'test', filename)
+            model = bio_structure[0]
+            self.assertEqual(atoms.n_models, len(bio_structure))
+            self.assertEqual(atoms.residue_ids,
+                             [(chain.get_id(), residue.get_id()) for chain in
+                              model for residue in chain])
+            np.testing.assert_array_equal(
+                atoms.coords, [atom.get_coord() for atom in model.get_atoms()])
+            self.assertEqual(list(atoms.names),
+                             [atom.get_id() for atom in model.get_atoms()])
+            for selector in ('all', 'CA', 'CB'):
+                self.assertEqual(pdbtools.nearby(atoms, 10, selector),
+                                 pdbtools.nearby(model, 10, selector))
+            from_atoms = residue_table.ResidueTable.from_atoms(atoms)
+            from_model = residue_table.ResidueTable.from_model(model)
+            for column in ('chain', 'hetflag', 'resseq', 'resname', 'ca',
+                           'centroid', 'bfactor'):
+                if from_atoms[column].dtype.kind == 'f':
+                    np.testing.assert_allclose(from_atoms[column],
+                                               from_model[column])
+                else:
+                    np.testing.assert_array_equal(from_atoms[column],
+                                                  from_model[column])
+
+    def test_atom_reader_point_mutation(self):
+        # Residue 2 is a point mutation, given as GLY (altloc A) and SER
+        # (altloc B). Bio.PDB uses the last residue (SER).
+        records = [
+            ('ALA', ' ', 1, [(' N  ', 0.0), (' CA ', 1.5), (' C  ', 3.0)]),
+            ('GLY', 'A', 2, [(' N  ', 4.0), (' CA ', 5.5), (' C  ', 7.0)]),
+            ('SER', 'B', 2, [(' N  ', 4.2), (' CA ', 5.7), (' C  ', 7.2),
+                             (' CB ', 5.7)]),
+            ('ALA', ' ', 3, [(' N  ', 8.0), (' CA ', 9.5), (' C  ', 11.0)])]
+        lines = []
+        for resname, altloc, resseq, atoms in records:
+            occupancy = {' ': 1.0, 'A': 0.6, 'B': 0.4}[altloc]
+            for name, x in atoms:
+                lines.append(
+                    'ATOM  {0:5d} {1}{2}{3} A{4:4d}    {5:8.3f}{6:8.3f}{7:8.3f}'
+                    '{8:6.2f}{9:6.2f}           {10}\n'.format(
+                        len(lines) + 1, name, altloc, resname, resseq, x,
+                        1.0 if name == ' CB ' else 0.0, 0.0, occupancy, 10.0,
+                        name.strip()[0]))
+        pdb_contents = ''.join(lines) + 'END\n'
+        atoms = readers.read_pdb_atoms(io.StringIO(pdb_contents))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            model = Bio.PDB.PDBParser().get_structure(
+                'test', io.StringIO(pdb_contents))[0]
+        np.testing.assert_allclose(
+            atoms.coords, [atom.get_coord() for atom in model.get_atoms()])
+        self.assertEqual(list(atoms.names),
+                         [atom.get_id() for atom in model.get_atoms()])
+        self.assertEqual(atoms.resnames, ['ALA', 'SER', 'ALA'])
+        self.assertEqual(pdbtools.nearby(atoms, 2), pdbtools.nearby(model, 2))
+        structure = biostructmap.Structure(io.StringIO(pdb_contents))
+        self.assertEqual(structure.sequences['A'], 'ASA')
+
+    def test_structure_is_parsed_lazily(self):
+        structure = biostructmap.Structure('./tests/pdb/1zrl.pdb')
+        structure.nearby(radius=10)
+        structure.residue_table_column('bfactor')
+        self.assertTrue(structure._structure is None)
+        self.assertTrue(isinstance(structure.structure,
+                                   Bio.PDB.Structure.Structure))
+        self.assertEqual(sorted(structure.models), [0])
+
+    def test_model_and_chain_wrappers_are_lazy(self):
+        structure = biostructmap.Structure('./tests/pdb/1as5.pdb')
+        self.assertEqual(sorted(structure.models), list(range(14)))
+        self.assertTrue(3 in structure.models)
+        self.assertFalse(14 in structure.models)
+        model = structure[3]
+        self.assertTrue(structure[3] is model)
+        self.assertEqual(list(structure.models._wrapped), [3])
+        self.assertEqual(list(model.chains._wrapped), [])
+        self.assertEqual([chain.get_id() for chain in model], ['A'])
+        with self.assertRaises(KeyError):
+            structure[14]
+
+    def test_sequence_from_atoms_without_seqres(self):
+        with open('./tests/pdb/1zrl.pdb') as f:
+            lines = [line for line in f if not line.startswith('SEQRES')]
+        structure = biostructmap.Structure(io.StringIO(''.join(lines)))
+        self.assertEqual(structure.sequences['A'],
+                         pdbtools.get_pdb_seq_from_atom(structure[0]['A'].chain))
+
     def test_get_pdb_sequence(self):
         filename = './tests/pdb/1zrl.pdb'
         sequence = pdbtools.get_pdb_seq(filename)
@@ -110,6 +254,21 @@ class TestPdbtools(TestCase):
         with self.assertRaises(IOError):
             pdbtools.get_pdb_seq('not_a_file')
 
+    def test_single_pass_pdb_reader(self):
+        for filename in ['./tests/pdb/1zrl.pdb', './tests/pdb/1as5.pdb']:
+            with open(filename) as f:
+                atoms, sequences, header = readers.read_pdb(f)
+            self.assertEqual(sequences, pdbtools.get_pdb_seq(filename))
+        self.assertEqual(header, {'idcode': '1AS5',
+                                  'structure_method': 'solution nmr',
+                                  'resolution': None})
+        structure = biostructmap.Structure('./tests/pdb/1zrl.pdb')
+        self.assertEqual(structure.header['resolution'], 2.3)
+        structure = biostructmap.Structure('./tests/pdb/4nuv.cif', mmcif=True)
+        self.assertEqual(structure.header, {
+            'idcode': '4NUV', 'structure_method': 'x-ray diffraction',
+            'resolution': 2.6})
+
     def test_get_mmcif_seq(self):
         filename = './tests/pdb/4nuv.cif'
         mmcif_dict = MMCIF2Dict(filename)
@@ -132,6 +291,24 @@ class TestPdbtools(TestCase):
                            'NTQEVVTNVDN')}
         self.assertDictEqual(sequence, to_match)
 
+    def test_single_pass_mmcif_reader(self):
+        filename = './tests/pdb/4nuv.cif'
+        mmcif_dict = MMCIF2Dict(filename)
+        with open(filename) as f:
+            atoms, items = readers.read_mmcif(
+                f, categories=('_entity_poly', '_struct', '_citation_author'))
+        for tag, values in items.items():
+            self.assertEqual(values, mmcif_dict[tag])
+        self.assertTrue('_citation_author.name' in items)
+        self.assertEqual(pdbtools.get_mmcif_canonical_seq(items),
+                         pdbtools.get_mmcif_canonical_seq(mmcif_dict))
+        _, seq_index_to_res_id = pdbtools.mmcif_sequence_to_res_id(mmcif_dict)
+        seq_ids = dict(zip(atoms.residue_ids, atoms.seq_ids.tolist()))
+        for (chain, seq_id), residue_id in seq_index_to_res_id.items():
+            if seq_id is not None:
+                self.assertEqual(seq_ids[residue_id], seq_id)
+        self.assertEqual(seq_ids[('A', ('H_HOH', 724, ' '))], -1)
+
     def test_tajimas_d_on_structure(self):
         #test_sequence_alignment = AlignIO.read('./tests/msa/msa_test_86-104', 'fasta')
         test_sequence_alignment = {('A',): biostructmap.SequenceAlignment(
@@ -319,6 +496,50 @@ class TestSeqtools(TestCase):
         self.assertEqual(forward_match, test_map_forward)
         self.assertEqual(reverse_match, test_map_reverse)
 
+    def test_banded_pairwise_alignment_of_long_sequence(self):
+        ref_seq = str(AlignIO.read('./tests/fasta/eba175_protein.fasta', 'fasta')[0].seq)
+        # Fragment with a 50 residue deletion relative to the reference.
+        comp_seq = ref_seq[100:900] + ref_seq[950:1400]
+        full_forward, full_reverse = seqtools.pairwise_align(comp_seq, ref_seq)
+        self.assertEqual(len(full_forward), 1250)
+        self.assertEqual(full_forward[1], 101)
+        self.assertEqual(full_forward[801], 951)
+        banded_forward, banded_reverse = seqtools.pairwise_align(comp_seq, ref_seq,
+                                                                 band=60)
+        self.assertEqual(full_forward, banded_forward)
+        self.assertEqual(full_reverse, banded_reverse)
+
+    def test_global_pairwise_alignment(self):
+        seq1 = "NAKFGLWV"
+        seq2 = "GSNAKFGLWVDG"
+        test_map_forward, _ = seqtools.pairwise_align(seq1, seq2,
+                                                      end_gaps_free=False)
+        self.assertEqual(test_map_forward, {x: x + 2 for x in range(1, 9)})
+
+    def test_exact_protein_alignment_skips_external_aligner(self):
+        seq1 = "GSNAKFGLWVDGNCEDIPHVNEFPAID"
+        seq2 = "NAKFGLWV"
+        with mock.patch.object(seqtools, 'blast_sequences',
+                               side_effect=AssertionError), \
+             mock.patch.object(seqtools, 'pairwise_align',
+                               side_effect=AssertionError):
+            test_map_forward, test_map_reverse = seqtools.align_protein_sequences(
+                Seq(seq1), seq2)
+            self.assertEqual(test_map_forward, {x + 2: x for x in range(1, 9)})
+            self.assertEqual(test_map_reverse, {x: x + 2 for x in range(1, 9)})
+            test_map_forward, _ = seqtools.align_protein_sequences(seq1, seq1)
+            self.assertEqual(test_map_forward, {x: x for x in range(1, 28)})
+        # Repeated matches are ambiguous and are left to the aligner.
+        self.assertIsNone(seqtools._exact_protein_alignment('NAK', 'NAKGNAK'))
+
+    def test_exact_cds_alignment_skips_exonerate(self):
+        dna = 'GGATGAAATGTAATATTAGTATATATTTTTTT'
+        protein = 'MKCNISIYFF'
+        with mock.patch.object(seqtools, '_align_prot_to_dna_exonerate',
+                               side_effect=AssertionError):
+            result = seqtools.align_protein_to_dna(protein, dna)
+        self.assertEqual(result, {i: (i*3, i*3+1, i*3+2) for i in range(1, 11)})
+
     def test_protein_dna_alignment(self):
         '''Need to account for an intron frameshift when converting from DNA to
         protein sequence.
@@ -492,6 +713,49 @@ class Testbiostructmap(TestCase):
         for i in result.values():
             self.assertTrue(isinstance(i, set))
 
+    def test_structure_nearby_arrays_without_scipy(self):
+        expected = biostructmap.Structure(self.test_file).nearby_arrays(8)
+        count = lambda structure, data, residues, ref: len(residues)
+        expected_map = biostructmap.Structure(self.test_file).map(
+            None, method=count, radius=8, bfactor_range=(0, 100))
+        with mock.patch.object(pdbtools, 'SCIPY_PRESENT', False):
+            structure = biostructmap.Structure(self.test_file)
+            result = structure.nearby_arrays(8)
+            self.assertEqual(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+            np.testing.assert_array_equal(result[2], expected[2])
+            mapping = structure.map(None, method=count, radius=8,
+                                    bfactor_range=(0, 100))
+            self.assertEqual(dict(mapping), dict(expected_map))
+            with self.assertRaises(ImportError):
+                structure.nearby_arrays(8, windows='union')
+
+    def test_structure_nearby_windows_from_all_models(self):
+        structure = biostructmap.Structure(self.test_file)
+        atoms = structure.atoms()
+        coords = structure.model_coords()
+        self.assertEqual(coords.shape, (14, len(atoms), 3))
+        np.testing.assert_array_equal(coords[0], atoms.coords)
+        first_model = structure.nearby(radius=8)
+        union = structure.nearby(radius=8, windows='union')
+        intersection = structure.nearby(radius=8, windows='intersection')
+        self.assertEqual(set(union), set(first_model))
+        for residue, residues in first_model.items():
+            self.assertTrue(intersection[residue] <= residues <= union[residue])
+            self.assertIn(residue, intersection[residue])
+        self.assertNotEqual(union, intersection)
+        _, _, _, frequency = structure.contact_frequencies(radius=8)
+        self.assertTrue(np.all((frequency > 0) & (frequency <= 1)))
+        self.assertEqual(structure.nearby(radius=8, windows=1.0), intersection)
+        with self.assertRaises(ValueError):
+            structure.nearby(radius=8, windows='all')
+        count = lambda structure, data, residues, ref: len(residues)
+        mapping = structure.map(None, method=count, radius=8,
+                                windows='union')
+        self.assertEqual(mapping.params['windows'], 'union')
+        for residue, residues in union.items():
+            self.assertEqual(mapping[residue], len(residues))
+
     def test_rsa_determination(self):
         chain = biostructmap.Structure(self.test_file)[0]['A']
         result = chain.rel_solvent_access()
@@ -524,6 +788,45 @@ class Testbiostructmap(TestCase):
         rsa_mapping = structure.map(data, rsa_range=[0,1])
         self.assertDictEqual(rsa_mapping, mapping)
 
+    def test_mapping_instrumentation(self):
+        structure = biostructmap.Structure(self.test_file)
+        data = {'A': [x for x in range(0, 25)]}
+        mapping = structure.map(data)
+        self.assertIsNone(mapping.stats)
+        self.assertIsNone(structure.map(data, stats=False).stats)
+        events = []
+        stats = instrument.MapStats(
+            n_slowest=3, callback=lambda *event: events.append(event))
+        instrumented = structure.map(data, stats=stats)
+        self.assertTrue(instrumented.stats is stats)
+        self.assertEqual(dict(instrumented), dict(mapping))
+        self.assertIsNone(instrument.active())
+        for stage in ('map', 'nearby', 'reference_numbering', 'windows',
+                      'datamap'):
+            self.assertEqual(stats.calls[stage], 1)
+        self.assertGreaterEqual(stats.timings['map'], stats.timings['windows'])
+        # Nearby residues and reference numbering are reused from the first
+        # call.
+        self.assertEqual(stats.counters['cache.nearby.hit'], 1)
+        self.assertEqual(stats.counters['cache.reference_numbering.hit'], 1)
+        nearby = structure.nearby()
+        self.assertEqual(stats.window_sizes,
+                         [len(residues) for residues in nearby.values()])
+        self.assertEqual(len([event for event in events if
+                              event[0] == 'window']), len(nearby))
+        slowest = stats.slowest_windows
+        self.assertEqual(len(slowest), 3)
+        self.assertEqual([window[2] for window in slowest],
+                         sorted([window[2] for window in slowest],
+                                reverse=True))
+        # Statistics accumulate over calls with the same MapStats object.
+        structure.map(data, radius=5, stats=stats)
+        self.assertEqual(stats.calls['map'], 2)
+        self.assertEqual(stats.counters['cache.nearby.miss'], 1)
+        summary = stats.summary()
+        self.assertEqual(summary['window_sizes']['count'], 2 * len(nearby))
+        self.assertIn('reference_numbering', stats.report())
+
     def test_default_mapping_procedure_with_pairwise(self):
         seqtools.LOCAL_BLAST = False
         structure = biostructmap.Structure(self.test_file)
@@ -564,6 +867,28 @@ class Testbiostructmap(TestCase):
                          set([('A', (' ', 4 , ' ')), ('A', (' ', 13, ' ')),
                               ('A', (' ', 16, ' '))]))
 
+    def test_rsa_filtering_with_shrake_rupley(self):
+        data = {'A': [x for x in range(0, 25)]}
+        structure = biostructmap.Structure(self.test_file)
+        mapping = structure.map(data)
+        filtered_mapping = structure.map(data, rsa_range=[0.2, 1],
+                                         rsa_method='shrake-rupley')
+        self.assertEqual(set(mapping.keys()) - set([x for x in
+                                                    filtered_mapping.keys() if
+                                                    filtered_mapping[x] is not None]),
+                         set([('A', (' ', 4 , ' ')), ('A', (' ', 13, ' ')),
+                              ('A', (' ', 16, ' '))]))
+
+    def test_rsa_falls_back_to_shrake_rupley_without_dssp(self):
+        chain = biostructmap.Structure(self.test_file)[0]['A']
+        with mock.patch.object(biostructmap.Model, '_run_dssp',
+                               side_effect=OSError):
+            with self.assertWarns(UserWarning):
+                result = chain.rel_solvent_access('dssp')
+        self.assertEqual(result, chain.rel_solvent_access('shrake-rupley'))
+        with self.assertRaises(ValueError):
+            chain.rel_solvent_access('naccess')
+
 
     def test_sequence_alignment_instantiation(self):
         test_align = biostructmap.SequenceAlignment(self.test_align)
@@ -615,6 +940,107 @@ class Testbiostructmap(TestCase):
         self.assertDictEqual(_ss_dict_numeric,
                              chain.secondary_structure(numeric_ss_code=True))
 
+    def test_residue_table(self):
+        structure = biostructmap.Structure(self.test_file)
+        table = structure.residue_table()
+        self.assertEqual(len(table), 25)
+        self.assertTrue(np.shares_memory(table.to_numpy(), table['resname']))
+        row = table.index([('A', (' ', 4, ' '))])[0]
+        residue = structure[0]['A'][(' ', 4, ' ')]
+        self.assertEqual(table['resname'][row], residue.get_resname())
+        np.testing.assert_allclose(table['ca'][row], residue['CA'].get_coord())
+        np.testing.assert_allclose(
+            table['centroid'][row],
+            np.mean([atom.get_coord() for atom in residue], axis=0), rtol=1e-5)
+        rsa = structure.residue_table_column('rsa', 'shrake-rupley')
+        self.assertEqual(rsa[row], structure[0]['A'].rel_solvent_access(
+            'shrake-rupley')[(' ', 4, ' ')])
+        self.assertEqual(structure.residue_table_column('seq_position')[row], 4)
+        result = structure.map('kd', method='aa_scale', radius=0)
+        self.assertEqual(result[('A', (' ', 4, ' '))], ProtParamData.kd['C'])
+        # String columns are widened to fit long (eg. mmCIF) chain ids.
+        table = residue_table.ResidueTable._from_arrays(
+            [('LONGCHAIN', ('H_ABCDEFGHIJ', 1, ' ')),
+             ('LONGCHAIN', (' ', 2, ' '))], ['ABCDEF', 'CYS'],
+            np.zeros((2, 3)), np.zeros(0, dtype='int64'), np.zeros((0, 3)),
+            np.zeros(0))
+        self.assertEqual(list(table['chain']), ['LONGCHAIN'] * 2)
+        self.assertEqual(table['hetflag'][0], 'H_ABCDEFGHIJ')
+        self.assertEqual(table['resname'][0], 'ABCDEF')
+        # Residues missing from the structure are read as unknown ('X').
+        structure = mock.Mock(**{'residue_table.return_value': table})
+        with mock.patch.dict(ProtParamData.kd, {'X': 0.0}):
+            self.assertEqual(map_functions._map_amino_acid_scale(
+                structure, 'kd', [('LONGCHAIN', (' ', 2, ' ')),
+                                  ('A', (' ', 999, ' '))], None),
+                ProtParamData.kd['C'] / 2)
+
+    def test_array_backed_data_map(self):
+        structure = biostructmap.Structure(self.test_file)
+        results = {('A', (' ', 4, ' ')): 2, ('A', (' ', 5, ' ')): None,
+                   ('A', (' ', 6, ' ')): 3}
+        data_map = biostructmap.DataMap(results, structure=structure, params={})
+        self.assertEqual(data_map, results)
+        self.assertEqual(list(data_map), list(results))
+        self.assertTrue(isinstance(data_map[('A', (' ', 4, ' '))], int))
+        self.assertFalse(('A', (' ', 7, ' ')) in data_map)
+        array = data_map.to_numpy()
+        self.assertTrue(np.shares_memory(array, data_map.values_array))
+        self.assertTrue(np.isnan(array['value'][1]))
+        residue_ids = structure.residue_table().residue_ids
+        self.assertEqual([residue_ids[x] for x in array['index']], list(results))
+        # Changes made through the dict interface are written to the array.
+        self.assertTrue(isinstance(data_map, dict))
+        data_map[('A', (' ', 5, ' '))] = 4
+        data_map.update({('A', (' ', 7, ' ')): 5})
+        copied = data_map.copy()
+        del data_map[('A', (' ', 4, ' '))]
+        np.testing.assert_array_equal(data_map.values_array, [4, 3, 5])
+        self.assertTrue(isinstance(copied, biostructmap.DataMap))
+        self.assertTrue(copied.structure is structure)
+        np.testing.assert_array_equal(copied.values_array, [2, 4, 3, 5])
+        self.assertEqual(json.loads(json.dumps(
+            biostructmap.DataMap({'a': 1.5}, structure=None, params={}))),
+                         {'a': 1.5})
+        # Non-numeric values and residues without a structure.
+        results = {('A', 1): 'a', ('B', 2): (1, 2)}
+        data_map = biostructmap.DataMap(results, structure=None, params={})
+        self.assertEqual(dict(data_map), results)
+        self.assertEqual(data_map.to_numpy()['value'].dtype, np.dtype('O'))
+
+    def test_property_filtering_procedure(self):
+        data = {'A': [x for x in range(0, 25)]}
+        structure = biostructmap.Structure(self.test_file)
+        filtered_mapping = structure.map(data, secondary_structure='T',
+                                         ss_method='kabsch-sander')
+        self.assertEqual(set(x[1][1] for x in filtered_mapping
+                             if filtered_mapping[x] is not None),
+                         set([7, 8, 15, 17, 18]))
+        residue_ids = [('A', (' ', 1, ' ')), ('A', (' ', 4, ' '))]
+        mean_bfactors = [np.mean([atom.get_bfactor() for atom in
+                                  structure[0]['A'][x[1]]])
+                         for x in residue_ids]
+        mask = structure.residue_mask(residue_ids, bfactor_range=(
+            mean_bfactors[0], mean_bfactors[0]))
+        self.assertEqual(list(mask), [True, mean_bfactors[1] == mean_bfactors[0]])
+
+    def test_kabsch_sander_secondary_structure(self):
+        ss_dict = {1: '-', 2: '-', 3: '-', 4: 'S', 5: 'S',
+                   6: 'S', 7: 'T', 8: 'T', 9: '-', 10: '-',
+                   11: '-', 12: '-', 13: '-', 14: 'T', 15: 'T',
+                   16: '-', 17: 'T', 18: 'T', 19: '-', 20: '-',
+                   21: '-', 22: 'S', 23: '-', 24: '-'}
+        ss_dict = {(' ', x, ' '): y for x, y in ss_dict.items()}
+        structure = biostructmap.Structure(self.test_file)
+        result = structure[0]['A'].secondary_structure(method='kabsch-sander')
+        self.assertDictEqual(ss_dict, result)
+        # Unlike DSSP, the built-in method can be used for every NMR model.
+        for model in structure:
+            result = model['A'].secondary_structure(method='kabsch-sander')
+            self.assertEqual(set(result), set(ss_dict))
+        with self.assertRaises(ValueError):
+            structure[0]['A'].secondary_structure(method='stride')
+
 
 class TestbiostructmapMMCIF(TestCase):
     def setUp(self):
@@ -878,4 +1304,414 @@ class TestOutputWriting(TestCase):
         print(written_lines)
         self.assertEquals(written_lines[0], 'atom_serial,score\n')
         self.assertTrue('952,10\n' in written_lines)
-        
\ No newline at end of file
+
+    def test_writing_to_atom_with_mmcif(self):
+        mock_file = io.StringIO()
+        self.mapped.write_to_atom(mock_file)
+        mock_file.seek(0)
+        written_lines = mock_file.readlines()
+        self.assertEqual(written_lines[0], 'atom_serial,score\n')
+        self.assertTrue('952,10\n' in written_lines)
+
+    def test_writing_to_json(self):
+        mapped = self.structure_pdb.map(data=None, method='count_residues',
+                                        radius=8, selector='CA')
+        json_file = io.StringIO()
+        mapped.write_data_to_json(json_file)
+        records = json.loads(json_file.getvalue())
+        self.assertEqual(len(records), len(mapped))
+        residue = sorted(mapped)[0]
+        self.assertEqual(records[0]['residue'], str(residue))
+        self.assertEqual(records[0]['score'], mapped[residue])
+        # Window contents use the radius and selector of the data map.
+        nearby = self.structure_pdb.nearby(radius=8, atom='CA')[residue]
+        self.assertEqual(ast.literal_eval(records[0]['nearby']), nearby)
+        json_file = io.StringIO()
+        mapped.write_data_to_json(json_file, compact=True)
+        compact = json.loads(json_file.getvalue())
+        self.assertEqual(compact['params'], {'radius': 8, 'selector': 'CA'})
+        residues = [(x[0], (x[1], x[2], x[3])) for x in compact['residues']]
+        self.assertEqual(len(compact['data']), len(mapped))
+        for index, score, nearby_index in compact['data']:
+            self.assertEqual(score, mapped[residues[index]])
+            self.assertEqual({residues[x] for x in nearby_index},
+                             self.structure_pdb.nearby(8, 'CA')[residues[index]])
+
+    def test_writing_to_npz(self):
+        npz_file = io.BytesIO()
+        self.mapped_pdb.write_to_npz(npz_file, ref={'A': self.ref_seq},
+                                     include_nearby=True)
+        npz_file.seek(0)
+        # Load without a structure.
+        loaded = biostructmap.DataMap.from_npz(npz_file)
+        self.assertEqual(loaded, self.mapped_pdb)
+        self.assertEqual(loaded.params, self.mapped_pdb.params)
+        self.assertTrue(loaded.integer)
+        self.assertEqual(loaded.reference_numbering[('A', (' ', 271, ' '))],
+                         ('A', 63))
+        self.assertFalse(('B', (' ', 271, ' ')) in loaded.reference_numbering)
+        residue_ids, indptr, indices = loaded.nearby_arrays
+        nearby = self.structure_pdb.nearby(radius=3)
+        for i, residue in enumerate(residue_ids):
+            self.assertEqual({residue_ids[x] for x in indices[indptr[i]:indptr[i+1]]},
+                             nearby[residue])
+        # Load with a structure, sharing the structure's residue table.
+        npz_file.seek(0)
+        loaded = biostructmap.DataMap.from_npz(npz_file, self.structure_pdb)
+        self.assertEqual(loaded, self.mapped_pdb)
+        self.assertTrue(loaded.residue_ids is self.mapped_pdb.residue_ids)
+        pdb_file = io.StringIO()
+        loaded.write_data_to_pdb_b_factor(fileobj=pdb_file)
+        expected = io.StringIO()
+        self.mapped_pdb.write_data_to_pdb_b_factor(fileobj=expected)
+        self.assertEqual(pdb_file.getvalue(), expected.getvalue())
+
+    def test_reference_numbering_is_memoised(self):
+        structure = biostructmap.Structure(self.test_pdb)
+        ref = {'A': self.ref_seq}
+        with mock.patch.object(structure, '_align_to_reference',
+                               wraps=structure._align_to_reference) as align:
+            first = structure._map_pdb_numbering_to_reference(ref)
+            second = structure._map_pdb_numbering_to_reference(dict(ref))
+            self.assertEqual(align.call_count, 1)
+        self.assertTrue(first is second)
+
+    def test_sequence_index_is_cached(self):
+        structure = biostructmap.Structure('./tests/pdb/1zrl.pdb')
+        with mock.patch.object(pdbtools, 'residue_ids_by_seq_index',
+                               wraps=pdbtools.residue_ids_by_seq_index) as index:
+            structure._map_pdb_numbering_to_reference(structure.sequences)
+            structure.residue_table_column('seq_position')
+            self.assertEqual(index.call_count, 1)
+        self.assertEqual(
+            structure._seq_index_to_residue_id(),
+            pdbtools.match_pdb_residue_num_to_seq(structure[0],
+                                                  structure.sequences))
+
+    def test_writing_to_mmcif(self):
+        chain_id, residue_id = sorted(self.mapped)[0]
+        cif_file = io.StringIO()
+        self.mapped.write_data_to_mmcif(fileobj=cif_file, scale_factor=2)
+        cif_file.seek(0)
+        written = biostructmap.Structure(cif_file, mmcif=True)
+        for atom in written[0][chain_id][residue_id]:
+            self.assertEqual(atom.get_bfactor(),
+                             self.mapped[(chain_id, residue_id)] * 2)
+        # Lines outside of the _atom_site loop are unchanged.
+        original_lines = open(self.test_file).readlines()
+        written_lines = cif_file.getvalue().splitlines(True)
+        self.assertEqual(len(original_lines), len(written_lines))
+        self.assertEqual(
+            [x for x in original_lines if not x.startswith(('ATOM', 'HETATM'))],
+            [x for x in written_lines if not x.startswith(('ATOM', 'HETATM'))])
+        # Values can be written to a new column.
+        cif_file = io.StringIO()
+        self.mapped.write_data_to_mmcif(fileobj=cif_file, default_no_value=None,
+                                        column='biostructmap_score')
+        cif_file.seek(0)
+        mmcif_dict = MMCIF2Dict(cif_file)
+        scores = mmcif_dict['_atom_site.biostructmap_score']
+        self.assertEqual(mmcif_dict['_atom_site.B_iso_or_equiv'][0], '82.22')
+        self.assertEqual(scores[mmcif_dict['_atom_site.id'].index('952')], '10')
+        self.assertTrue('?' in scores)
+        with self.assertRaises(TypeError):
+            self.mapped_pdb.write_data_to_mmcif(fileobj=io.StringIO())
+
+    def test_writing_to_pdb_b_factor(self):
+        parser = Bio.PDB.PDBParser()
+        for mapped in (self.mapped, self.mapped_pdb):
+            pdb_file = io.StringIO()
+            mapped.write_data_to_pdb_b_factor(fileobj=pdb_file, scale_factor=2)
+            pdb_file.seek(0)
+            model = parser.get_structure('test', pdb_file)[0]
+            chain_id, residue_id = sorted(mapped)[0]
+            for atom in model[chain_id][residue_id]:
+                self.assertEqual(atom.get_bfactor(),
+                                 mapped[(chain_id, residue_id)] * 2)
+            # Original structure is not modified.
+            original = mapped.structure[0][chain_id][residue_id]
+            self.assertNotEqual(original['CA'].get_bfactor(),
+                                mapped[(chain_id, residue_id)] * 2)
+        # Streamed output matches output from Bio.PDB.
+        streamed = io.StringIO()
+        self.mapped_pdb.write_data_to_pdb_b_factor(fileobj=streamed)
+        from_pdbio = io.StringIO()
+        self.mapped_pdb._write_b_factor_with_pdbio(
+            from_pdbio, self.mapped_pdb.residue_table_values())
+        streamed.seek(0)
+        from_pdbio.seek(0)
+        self.assertEqual(
+            [(x.get_full_id(), x.get_bfactor()) for x in
+             parser.get_structure('test', streamed).get_atoms()],
+            [(x.get_full_id(), x.get_bfactor()) for x in
+             parser.get_structure('test', from_pdbio).get_atoms()])
+        with self.assertRaises(ValueError):
+            self.mapped_pdb.write_data_to_pdb_b_factor(fileobj=io.StringIO(),
+                                                       scale_factor=1e6)
+
+    def test_writing_many_data_maps(self):
+        parser = Bio.PDB.PDBParser()
+        data_maps = [self.mapped_pdb,
+                     self.structure_pdb.map(data=None, method='count_residues',
+                                            radius=8)]
+        # Multi-model output, with one model per data map.
+        pdb_file = io.StringIO()
+        self.structure_pdb.write_data_maps(data_maps, pdb_file, multi_model=True,
+                                           scale_factor=[1, 2])
+        pdb_file.seek(0)
+        structure = parser.get_structure('test', pdb_file)
+        self.assertEqual(len(structure), 2)
+        chain_id, residue_id = sorted(self.mapped_pdb)[0]
+        for model, data_map, scale in zip(structure, data_maps, [1, 2]):
+            self.assertEqual(model[chain_id][residue_id]['CA'].get_bfactor(),
+                             data_map[(chain_id, residue_id)] * scale)
+        # Separate output files match those written for each map.
+        outputs = [io.StringIO(), io.StringIO()]
+        self.structure_pdb.write_data_maps(data_maps, outputs)
+        for data_map, output in zip(data_maps, outputs):
+            expected = io.StringIO()
+            data_map.write_data_to_pdb_b_factor(fileobj=expected)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+        with self.assertRaises(ValueError):
+            self.structure_pdb.write_data_maps([self.mapped], io.StringIO(),
+                                               multi_model=True)
+        # Multi-model mmCIF output.
+        cif_file = io.StringIO()
+        self.structure.write_data_maps([self.mapped, self.mapped], cif_file,
+                                       multi_model=True, scale_factor=[1, 2])
+        cif_file.seek(0)
+        written = biostructmap.Structure(cif_file, mmcif=True)
+        chain_id, residue_id = sorted(self.mapped)[0]
+        for model, scale in zip(written, [1, 2]):
+            self.assertEqual(model[chain_id][residue_id]['CA'].get_bfactor(),
+                             self.mapped[(chain_id, residue_id)] * scale)
+
+
+
+class TestTrajectory(TestCase):
+    def setUp(self):
+        # Build a short trajectory by displacing atoms in the first model.
+        with open('./tests/pdb/1as5.pdb', 'r') as f:
+            atom_lines = []
+            for line in f:
+                if line.startswith('ENDMDL'):
+                    break
+                if line.startswith(('ATOM', 'HETATM')):
+                    atom_lines.append(line)
+        rng = np.random.RandomState(0)
+        coords = np.array([[float(line[i:i+8]) for i in (30, 38, 46)] for
+                           line in atom_lines])
+        self.frame_coords = []
+        output = io.StringIO()
+        for frame in range(6):
+            coords = coords + rng.uniform(-0.05, 0.05, coords.shape)
+            self.frame_coords.append(coords)
+            output.write('MODEL     {0:>4}\n'.format(frame + 1))
+            for line, xyz in zip(atom_lines, coords):
+                output.write('{0}{1:8.3f}{2:8.3f}{3:8.3f}{4}'.format(
+                    line[:30], xyz[0], xyz[1], xyz[2], line[54:]))
+            output.write('ENDMDL\n')
+        output.write('END\n')
+        self.test_file = io.StringIO(output.getvalue())
+
+    def test_verlet_list_matches_nearby_arrays(self):
+        traj = trajectory.Trajectory(self.test_file)
+        atoms = traj.structure.atoms()
+        frames = list(traj.frames())
+        self.assertEqual(len(frames), 6)
+        np.testing.assert_allclose(frames[-1], self.frame_coords[-1],
+                                   atol=1e-3)
+        for skin, n_builds in ((2.0, 1), (0, 6)):
+            neighbours = trajectory.VerletList(atoms, radius=8, skin=skin)
+            for coords in frames:
+                result = neighbours.update(coords)
+                frame_atoms = copy.copy(atoms)
+                frame_atoms.coords = coords
+                expected = pdbtools.nearby_arrays(frame_atoms, 8)
+                self.assertEqual(result[0], expected[0])
+                np.testing.assert_array_equal(result[1], expected[1])
+                np.testing.assert_array_equal(result[2], expected[2])
+            self.assertEqual(neighbours.n_builds, n_builds)
+        # No candidate pairs, so each residue is only nearby itself.
+        neighbours = trajectory.VerletList(atoms, radius=1, selector='CA',
+                                           skin=0)
+        residue_ids, indptr, indices = neighbours.update(frames[0])
+        np.testing.assert_array_equal(indptr, np.arange(len(residue_ids) + 1))
+        np.testing.assert_array_equal(indices, np.arange(len(residue_ids)))
+
+    def test_trajectory_map(self):
+        traj = trajectory.Trajectory(self.test_file, skin=1.0)
+        count = lambda structure, data, residues, ref: len(residues)
+        frame_nearby = list(traj.nearby_arrays(radius=8))
+        for frame, mapped in enumerate(traj.map(None, method=count,
+                                                radius=8)):
+            self.assertEqual(mapped.params['frame'], frame)
+            self.assertTrue(mapped.structure is traj.structure)
+            residue_ids, indptr, _ = frame_nearby[frame]
+            for i, residue in enumerate(residue_ids):
+                self.assertEqual(mapped[residue], indptr[i+1] - indptr[i])
+        self.assertEqual(frame, 5)
+
+class TestBatch(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.manifest = os.path.join(self.output_dir.name, 'manifest.jsonl')
+        entries = [{'structure': os.path.abspath('./tests/pdb/1as5.pdb'),
+                    'methods': ['count_residues'], 'radii': [5, 8]},
+                   {'structure': 'missing.pdb', 'methods': ['count_residues']},
+                   {'structure': os.path.abspath('./tests/pdb/1zrl.pdb'),
+                    'alignment': os.path.abspath('./tests/msa/MSA_test.fsa'),
+                    'methods': ['nucleotide_diversity'], 'radii': [5],
+                    'map_to_dna': True}]
+        with open(self.manifest, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def test_batch_checkpoints_and_resume(self):
+        output_dir = os.path.join(self.output_dir.name, 'results')
+        # Align without external programs.
+        with mock.patch.object(seqtools, 'LOCAL_BLAST', False), \
+             mock.patch.object(seqtools, 'LOCAL_EXONERATE', False):
+            summary = batch.run_batch(self.manifest, output_dir, processes=1,
+                                      log=None)
+            alignment = biostructmap.SequenceAlignment(
+                './tests/msa/MSA_test.fsa')
+            expected = biostructmap.Structure('./tests/pdb/1zrl.pdb').map(
+                {('A',): alignment}, method='nucleotide_diversity',
+                ref={'A': str(alignment[0].seq)}, radius=5, map_to_dna=True)
+        self.assertEqual((summary['completed'], summary['skipped'],
+                          summary['failed']), (3, 0, 1))
+        tasks = batch.read_manifest(self.manifest)
+        loaded = biostructmap.DataMap.from_npz(
+            batch.checkpoint_path(tasks[-1], output_dir))
+        self.assertTrue(any(value is not None for value in loaded.values()))
+        self.assertEqual(dict(loaded), dict(expected))
+        structure = biostructmap.Structure('./tests/pdb/1as5.pdb')
+        for task in tasks[:2]:
+            loaded = biostructmap.DataMap.from_npz(
+                batch.checkpoint_path(task, output_dir))
+            expected = structure.map(None, method='count_residues',
+                                     radius=task['radius'])
+            self.assertEqual(dict(loaded), dict(expected))
+        # Completed tasks are skipped when the batch is run again.
+        log = io.StringIO()
+        with mock.patch.object(sys, 'stderr', log):
+            exit_code = batch.main([self.manifest, '-o', output_dir,
+                                    '-p', '2'])
+        self.assertEqual(exit_code, 1)
+        self.assertIn('Completed 0 tasks (1 failed, 3 skipped)',
+                      log.getvalue())
+
+class TestDsspCache(TestCase):
+    def setUp(self):
+        self.test_file = './tests/pdb/1as5.pdb'
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patcher = mock.patch.object(cache, 'CACHE_DIR', self.cache_dir.name)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache_dir.cleanup()
+
+    def test_cache_eviction(self):
+        disk_cache = cache.DiskCache('test', max_entries=2)
+        disk_cache.set('a', 1)
+        disk_cache.set('b', {'x': 2})
+        self.assertEqual(disk_cache.get('a'), 1)
+        # Make 'b' the least recently used entry.
+        os.utime(disk_cache._entry_path('b'), (0, 0))
+        disk_cache.set('c', 3)
+        self.assertEqual(disk_cache.get('a'), 1)
+        self.assertEqual(disk_cache.get('b'), None)
+        self.assertEqual(disk_cache.get('c'), 3)
+        # Entries that can't be unpickled are misses, and are removed.
+        with open(disk_cache._entry_path('a'), 'wb') as f:
+            f.write(b'cbiostructmap.cache\nNoSuchClass\n.')
+        self.assertEqual(disk_cache.get('a', 'missing'), 'missing')
+        self.assertFalse('a' in disk_cache)
+
+    def test_structure_snapshot(self):
+        structure = biostructmap.Structure(self.test_file, pdbname='1as5')
+        nearby = structure.nearby(radius=5)
+        rsa = structure[0]['A'].rel_solvent_access('shrake-rupley')
+        structure.save_snapshot()
+        snapshot_file = io.BytesIO()
+        structure.save_snapshot(snapshot_file)
+        with mock.patch.object(biostructmap, 'PDBParser',
+                               side_effect=AssertionError):
+            for snapshot in (None, io.BytesIO(snapshot_file.getvalue())):
+                restored = biostructmap.Structure.from_snapshot(
+                    self.test_file, pdbname='1as5', snapshot=snapshot)
+                self.assertTrue(restored[0].parent() is restored)
+                self.assertEqual(restored.sequences, structure.sequences)
+                self.assertEqual(restored.nearby(radius=5), nearby)
+                with mock.patch.object(biostructmap.sasa,
+                                       'relative_solvent_accessibility',
+                                       side_effect=AssertionError):
+                    self.assertEqual(
+                        restored[0]['A'].rel_solvent_access('shrake-rupley'), rsa)
+        # A snapshot is not used if the file has changed.
+        with open(self.test_file, 'r') as f:
+            contents = f.read().replace('1.00  0.00', '1.00  1.00', 1)
+        changed = biostructmap.Structure.from_snapshot(
+            io.StringIO(contents), snapshot=io.BytesIO(snapshot_file.getvalue()))
+        self.assertEqual(changed._nearby, {})
+        # Nor is a snapshot referring to classes that no longer exist.
+        header = pickle.dumps((biostructmap._content_hash(self.test_file, False),
+                               biostructmap.SNAPSHOT_VERSION))
+        stale = io.BytesIO(header + b'cbiostructmap.readers\nNoSuchTable\n.')
+        restored = biostructmap.Structure.from_snapshot(self.test_file,
+                                                        snapshot=stale)
+        self.assertEqual(restored._nearby, {})
+        self.assertEqual(restored.sequences, structure.sequences)
+
+    def test_warm_cache_skips_dssp(self):
+        structure = biostructmap.Structure(self.test_file)
+        model = structure[0]
+        residue_id = (' ', 5, ' ')
+        cache_key = pdbtools.model_coordinate_hash(model.model)
+        cache.DiskCache('dssp').set(
+            cache_key, {('A', residue_id): (5, 'C', 'T', 0.5, -60.0, -45.0)})
+        # Identical coordinates from a file-like object give the same key.
+        with open(self.test_file, 'r') as f:
+            structure = biostructmap.Structure(io.StringIO(f.read()))
+        chain = structure[0]['A']
+        with mock.patch.object(biostructmap.Model, '_run_dssp',
+                               side_effect=AssertionError):
+            self.assertEqual(chain.rel_solvent_access(), {residue_id: 0.5})
+            self.assertEqual(chain.secondary_structure(), {residue_id: 'T'})
+
+    def test_dssp_returns_dssp_object(self):
+        model = biostructmap.Structure(self.test_file)[0]
+        residue_id = (' ', 5, ' ')
+        dssp = {('A', residue_id): (5, 'C', 'T', 0.5, -60.0, -45.0)}
+        with mock.patch.object(biostructmap, 'DSSP',
+                               return_value=dssp) as run_dssp:
+            self.assertTrue(model.dssp() is dssp)
+            self.assertEqual(model['A'].rel_solvent_access('dssp'),
+                             {residue_id: 0.5})
+        self.assertEqual(run_dssp.call_count, 1)
+        cache_key = pdbtools.model_coordinate_hash(model.model)
+        self.assertEqual(cache.DiskCache('dssp').get(cache_key), dssp)
+
+class TestImports(TestCase):
+    def test_heavy_dependencies_are_imported_when_required(self):
+        # Run in a new interpreter, as other tests import these modules.
+        modules = ['scipy', 'dendropy', 'Bio.Blast']
+        code = ("import json, sys\n"
+                "import biostructmap\n"
+                "imported = [m for m in {0!r} if m in sys.modules]\n"
+                "biostructmap.Structure('./tests/pdb/1as5.pdb').nearby(5)\n"
+                "print(json.dumps([imported, 'scipy' in sys.modules]))"
+                ).format(modules)
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=repo_dir)
+        imported, scipy_imported = json.loads(output.decode('utf-8'))
+        self.assertEqual(imported, [])
+        # Scipy is optional, but is imported when finding nearby residues.
+        if pdbtools.SCIPY_PRESENT:
+            self.assertTrue(scipy_imported)